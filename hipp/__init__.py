@@ -1,11 +1,29 @@
-import hipp.batch
-import hipp.core
-import hipp.dataquery
-import hipp.geospatial
-import hipp.image
-import hipp.io
-import hipp.math
-import hipp.plot
-import hipp.qc
-import hipp.tools
-import hipp.utils
+"""
+Submodules are imported on first attribute access, e.g. hipp.core, so that importing
+hipp does not load the dependencies of submodules that are not used.
+"""
+
+import importlib
+
+__all__ = ['batch',
+           'core',
+           'daemon',
+           'dataquery',
+           'geospatial',
+           'image',
+           'io',
+           'math',
+           'pipeline',
+           'plot',
+           'qc',
+           'tools',
+           'utils',
+           'workqueue']
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('hipp.' + name)
+    raise AttributeError("module 'hipp' has no attribute " + repr(name))
+
+def __dir__():
+    return sorted(set(list(globals()) + __all__))
@@ -1,12 +1,17 @@
+import concurrent.futures
 import cv2
 import glob
+import heapq
+import itertools
 import numpy as np
 import os
-import sys
 import pandas as pd
 from pathlib import Path
+import psutil
 from skimage import transform as tf
+from tqdm import tqdm
 
+import hipp.batch
 import hipp.core
 import hipp.image
 import hipp.io
@@ -23,7 +28,8 @@ def image_restitution(df_detected,
                       image_square_dim = 10800,
                       interpolation_order = 3,
                       output_directory = 'input_data/preprocessed_images/',
-                      qc = True):
+                      qc = True,
+                      qc_writer = None):
 
     """
     Computes affine transformation between detected coordinates and true coordinates true,
@@ -36,6 +42,8 @@ def image_restitution(df_detected,
     3: Bi-cubic
     4: Bi-quartic
     5: Bi-quintic
+    
+    QC plots are saved in the background by qc_writer, a hipp.qc.QCWriter, if provided.
     """
                       
     # TODO add logging
@@ -128,7 +136,7 @@ def image_restitution(df_detected,
 
         if transform_image or crop_image:
             image_file = df_detected[image_file_name_column_name].iloc[index]
-            image_array = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+            image_array = hipp.io.read_image(image_file)
 
         if transform_image or transform_coords:
             # remove nan values
@@ -242,7 +250,7 @@ def image_restitution(df_detected,
             qc_df = pd.concat(qc_dataframes,axis=1)
             qc_df.index = qc_df[image_file_name_column_name].str[-12:-4]
             
-            hipp.plot.plot_restitution_qc(qc_df)
+            hipp.plot.plot_restitution_qc(qc_df, qc_writer = qc_writer)
         
 def iter_detect_fiducials(image_files_directory = 'input_data/raw_images/',
                           image_file_name_column_name = 'fileName',
@@ -251,13 +259,16 @@ def iter_detect_fiducials(image_files_directory = 'input_data/raw_images/',
                           template_high_res_zoomed_file = None,
                           midside_fiducials=False,
                           corner_fiducials=False,
-                          qc=True):
+                          qc=True,
+                          qc_writer=None):
     
     """
     Function to iteratively detect fiducial markers in a set of images and return as pandas.DataFrame.
                            
     Ensure that the templates correspond to either the fiducial markers at the midside or corners. 
     Specify flag accordingly.
+    
+    QC chips are written in the background by qc_writer, a hipp.qc.QCWriter, if provided.
     """
     
     images = sorted(glob.glob(os.path.join(image_files_directory,'*'+image_files_extension)))
@@ -268,7 +279,7 @@ def iter_detect_fiducials(image_files_directory = 'input_data/raw_images/',
     quality_scores = []
     
     for image_file in images:
-        image_array = cv2.imread(image_file,cv2.IMREAD_GRAYSCALE)
+        image_array = hipp.io.read_image(image_file)
         
         # Subset image array into window slices to speed up template matching
         if midside_fiducials:
@@ -298,7 +309,8 @@ def iter_detect_fiducials(image_files_directory = 'input_data/raw_images/',
                                                                 matches,
                                                                 template_high_res_zoomed_file,
                                                                 labels=labels,
-                                                                qc=qc)
+                                                                qc=qc,
+                                                                qc_writer=qc_writer)
                           
         fiducial_locations.append(subpixel_fiducial_locations)
         quality_scores.append(subpixel_quality_scores)
@@ -317,6 +329,369 @@ def iter_detect_fiducials(image_files_directory = 'input_data/raw_images/',
                      axis=1)
     return df
     
+def compute_proxy_crop_parameters(images,
+                                  detected_df,
+                                  buffer_distance = 250,
+                                  threshold_px = 50,
+                                  missing_proxy = None,
+                                  verbose = True):
+    """
+    Computes principal points and final square dimensions for a set of images from
+    detected fiducial marker proxies.
+    
+    Raises ValueError if no distance between fiducial proxies could be computed.
+    """
+    proxy_locations_df = hipp.core.nan_offset_fiducial_proxies(detected_df,
+                                                               threshold_px = threshold_px,
+                                                               missing_proxy = missing_proxy)
+    
+    result = hipp.core.compute_principal_point_from_proxies(proxy_locations_df,
+                                                            verbose=verbose)
+    principal_points, distances, intersection_angles = result
+
+    if np.isnan(np.nanmin(distances)):
+        raise ValueError("""Could not compute distance between any fiducial proxies and principal point. 
+        Detection likely failed. Check your inputs.""")
+    
+    image_square_dim = int(round((np.nanmin(distances))/2))*2 # ensure half is non float for array index slicing
+
+    new_image_square_dim = hipp.core.validate_square_dim(images,
+                                                         buffer_distance,
+                                                         principal_points,
+                                                         image_square_dim)
+    
+    if new_image_square_dim and missing_proxy:
+        print('Missing_proxy set to', missing_proxy)
+        print('Adjusting final image dimensions to minimum viable size from',
+              image_square_dim, 'to', new_image_square_dim)
+        print('Check qc plots for:')
+        for i in images:
+            print(i)
+        image_square_dim = new_image_square_dim
+        
+    elif new_image_square_dim:
+        msg = '\n'.join(['WARNING: Irregular final image dimensions detected',
+                         'Likely due to missing fiducial marker on a side of the images.',
+                         'Check qc plots for:'])
+        print(msg)
+        for i in images:
+            print(i)
+        if not missing_proxy:
+            msg = '\n'.join(['Consider reprocessing by setting missing_proxy option to left, top, right, or bottom',
+                             'to improve principal point detection.'])
+            print(msg)
+    
+    return proxy_locations_df, principal_points, distances, intersection_angles, image_square_dim
+
+def find_roll_template_directories(images,
+                                   template_directory,
+                                   template_selector = None):
+    """
+    Groups EE images by roll and finds the template directory matching each roll name.
+    
+    With a hipp.core.TemplateSelector as template_selector, the template set for rolls 
+    without a matching template directory is selected by scoring all template sets on 
+    downsampled sample frames of the roll.
+    
+    Returns dictionary of roll name -> (image files, template directory). The template
+    directory is None if no match was found.
+    """
+    rolls = sorted(set([Path(i).stem[:-4] for i in images]))
+    template_dirs = [t for t in Path(template_directory).iterdir() if t.is_dir()]
+    
+    roll_templates = {}
+    for r in rolls:
+        template_dir = None
+        for t in template_dirs:
+            if r in t.as_posix():
+                template_dir = t.as_posix()
+        images_tmp = [Path(img).as_posix() for img in images if r in Path(img).stem]
+        if not template_dir and template_selector:
+            template_dir = template_selector.select(r, images_tmp)
+        roll_templates[r] = (images_tmp, template_dir)
+    
+    return roll_templates
+
+def schedule_roll_preprocessing(roll_templates,
+                                buffer_distance = 250,
+                                threshold_px = 50,
+                                stretch_histogram = True,
+                                clahe_enhancement = True,
+                                output_directory = 'input_data/cropped_images',
+                                verbose = True,
+                                missing_proxy = None,
+                                qc_plots = True,
+                                qc_plots_output_directory = 'qc/proxy_detection',
+                                max_workers = None,
+                                streaming_statistics = False,
+                                streaming_min_samples = 5,
+                                streaming_tolerance_px = 2,
+                                roll_callback = None,
+                                qc_writer = None):
+    """
+    Detects fiducial marker proxies, crops images and plots qc for several rolls using one 
+    shared pool of workers.
+    
+    Stages are interleaved across rolls. Cropping tasks of a roll are prioritized over 
+    detection tasks of later rolls, so the detection of the next roll runs while the 
+    previous roll is cropped. QC plots are rendered in a separate process pool, as 
+    matplotlib is not thread safe, or sampled and written by qc_writer, a hipp.qc.QCWriter,
+    if provided.
+    
+    A roll that fails, for example due to missing templates or failed detection, is 
+    reported and skipped without stopping the other rolls.
+    
+    With streaming_statistics, proxy statistics are accumulated per roll as detections
+    arrive, see hipp.core.StreamingRollStatistics. Once the statistics are stable, images 
+    are cropped with provisional parameters while detection continues. When detection for 
+    the roll completes, the final parameters are computed as in batch mode and only the
+    images whose parameters changed are cropped again.
+    
+    roll_templates is the output of hipp.batch.find_roll_template_directories().
+    
+    roll_callback is optionally called with the roll name and its results once all 
+    images of the roll are cropped, for example to store results as rolls complete.
+    
+    Returns a dictionary of per roll results and a dictionary of failed rolls with the reason.
+    """
+    if not max_workers:
+        max_workers = max(psutil.cpu_count(logical=True)-1, 1)
+    
+    results = {}
+    failed  = {}
+    rolls   = {}
+    
+    # queued tasks are ordered by (stage priority, roll order, submission order)
+    queue = []
+    counter = itertools.count()
+    def push(priority, roll_index, task, function, *args, **kwargs):
+        heapq.heappush(queue, (priority, roll_index, next(counter),
+                               task, function, args, kwargs))
+    
+    for roll_index, (r, (images_tmp, template_dir)) in enumerate(roll_templates.items()):
+        if not template_dir:
+            failed[r] = 'No matching templates found in provided template directory'
+            print('No matching templates found for',r,'in provided template directory')
+            continue
+        if not images_tmp:
+            continue
+        print('Templates found for roll',r)
+        rolls[r] = {'index'        : roll_index,
+                    'images'       : images_tmp,
+                    'template_dir' : template_dir,
+                    'detections'   : [],
+                    'remaining'    : len(images_tmp),
+                    'final'        : None,
+                    'cropping'     : {},
+                    'cropped'      : {},
+                    'deferred'     : [],
+                    'stats'        : None,
+                    'done'         : False,
+                    # progress bar steps, one detection and crop per image plus recrops
+                    'steps'        : 2*len(images_tmp),
+                    'completed'    : 0}
+        if streaming_statistics:
+            rolls[r]['stats'] = hipp.core.StreamingRollStatistics(threshold_px = threshold_px,
+                                                                  missing_proxy = missing_proxy,
+                                                                  min_samples = streaming_min_samples,
+                                                                  tolerance_px = streaming_tolerance_px)
+        templates = hipp.core.load_midside_fiducial_proxy_templates(template_dir)
+        for image_file in images_tmp:
+            push(1, roll_index, (r, 'detect', image_file, None),
+                 hipp.core.detect_fiducial_proxies,
+                 image_file, templates, buffer_distance=buffer_distance)
+    
+    if not rolls:
+        return results, failed
+    
+    Path(output_directory).mkdir(parents=True, exist_ok=True)
+    
+    plot_pool = None
+    if qc_plots:
+        if not qc_writer:
+            plot_pool = concurrent.futures.ProcessPoolExecutor(max_workers=psutil.cpu_count(logical=False))
+        print("Plotting proxy detection QC plots at", qc_plots_output_directory)
+    
+    def roll_failed(r, reason):
+        if r not in failed:
+            failed[r] = reason
+            results.pop(r, None)
+            print('WARNING: Processing failed for roll', r)
+            print(reason)
+            # queued tasks of the roll are skipped, tasks in flight still complete
+            in_flight_steps = sum([1 for task in in_flight.values() if task[0] == r and task[1] != 'plot'])
+            pbar.total -= rolls[r]['steps'] - rolls[r]['completed'] - in_flight_steps
+            pbar.refresh()
+    
+    def submit_crop(r, image_file, crop_parameters):
+        roll = rolls[r]
+        if image_file in roll['cropped']:
+            # crop parameters changed after the image was cropped
+            roll['steps'] += 1
+            pbar.total += 1
+            pbar.refresh()
+        roll['cropping'][image_file] = crop_parameters
+        principal_point, image_square_dim = crop_parameters
+        push(0, roll['index'], (r, 'crop', image_file, crop_parameters),
+             hipp.core.crop_image_from_file,
+             (image_file, principal_point),
+             image_square_dim,
+             buffer_distance=buffer_distance,
+             output_directory=output_directory,
+             stretch_histogram = stretch_histogram,
+             clahe_enhancement = clahe_enhancement)
+    
+    def frame_detected(r, result):
+        roll = rolls[r]
+        roll['detections'].append(result)
+        roll['remaining'] -= 1
+        
+        if roll['stats'] is not None:
+            roll['stats'].add(result)
+            roll['deferred'].append(result[2])
+            deferred = []
+            for image_file in roll['deferred']:
+                crop_parameters = roll['stats'].crop_parameters(image_file)
+                if crop_parameters:
+                    submit_crop(r, image_file, crop_parameters)
+                else:
+                    deferred.append(image_file)
+            roll['deferred'] = deferred
+        
+        if roll['remaining'] == 0:
+            roll_detected(r)
+    
+    def roll_detected(r):
+        roll = rolls[r]
+        detected_df = pd.DataFrame(roll['detections'],
+                                   columns=['match_locations',
+                                            'scores',
+                                            'file_names']).sort_values(by=['file_names']).reset_index(drop=True)
+        images_tmp = list(detected_df['file_names'].values)
+        
+        proxy_locations_df, principal_points, distances, intersection_angles, image_square_dim = \
+        hipp.batch.compute_proxy_crop_parameters(images_tmp,
+                                                 detected_df,
+                                                 buffer_distance = buffer_distance,
+                                                 threshold_px = threshold_px,
+                                                 missing_proxy = missing_proxy,
+                                                 verbose = verbose)
+        
+        results[r] = {'template_directory'  : roll['template_dir'],
+                      'detected_df'         : detected_df,
+                      'proxy_locations_df'  : proxy_locations_df,
+                      'principal_points'    : principal_points,
+                      'distances'           : distances,
+                      'intersection_angles' : intersection_angles,
+                      'image_square_dim'    : image_square_dim}
+        
+        roll['final'] = {f : (tuple([int(x) for x in pp]), image_square_dim)
+                         for f, pp in zip(images_tmp, principal_points)}
+        
+        print("Cropping images for roll", r, "to square with dimensions", str(image_square_dim))
+        requeued = 0
+        for image_file, crop_parameters in roll['final'].items():
+            if image_file in roll['cropping']:
+                # compared against final parameters once the provisional crop completes
+                continue
+            if image_file in roll['cropped']:
+                if roll['cropped'][image_file] == crop_parameters:
+                    continue
+                requeued += 1
+            submit_crop(r, image_file, crop_parameters)
+        if requeued:
+            print('Recropping', requeued, 'images for roll', r, 'with updated crop parameters')
+        
+        if qc_plots and qc_writer:
+            hipp.plot.iter_plot_proxies(images_tmp,
+                                        proxy_locations_df,
+                                        principal_points,
+                                        buffer_distance  = buffer_distance,
+                                        output_directory = qc_plots_output_directory,
+                                        qc_writer = qc_writer)
+        elif plot_pool:
+            locations_no_buffer        = proxy_locations_df.iloc[:,1:] - buffer_distance
+            locations_no_buffer        = locations_no_buffer.values.tolist()
+            principal_points_no_buffer = np.array(principal_points) - buffer_distance
+            for i in zip(images_tmp,locations_no_buffer,principal_points_no_buffer):
+                future = plot_pool.submit(hipp.plot.plot_proxies, i, qc_plots_output_directory)
+                in_flight[future] = (r, 'plot', i[0], None)
+        
+        roll_cropped(r)
+    
+    def frame_cropped(r, image_file, crop_parameters):
+        roll = rolls[r]
+        del roll['cropping'][image_file]
+        roll['cropped'][image_file] = crop_parameters
+        if roll['final']:
+            final_crop_parameters = roll['final'][image_file]
+            if final_crop_parameters != crop_parameters:
+                submit_crop(r, image_file, final_crop_parameters)
+            roll_cropped(r)
+    
+    def roll_cropped(r):
+        roll = rolls[r]
+        if not roll['cropping'] and roll['cropped'] == roll['final'] and not roll['done']:
+            roll['done'] = True
+            if verbose:
+                print("Cropped images for roll", r, "at:", output_directory)
+            if roll_callback:
+                roll_callback(r, results[r])
+    
+    total = sum([v['steps'] for v in rolls.values()])
+    in_flight = {}
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    
+    with tqdm(total=total) as pbar:
+        while queue or in_flight:
+            # keep the pool saturated without committing queued tasks to a fixed order
+            while queue and len(in_flight) < 2*max_workers:
+                priority, roll_index, _, task, function, args, kwargs = heapq.heappop(queue)
+                if task[0] in failed:
+                    continue
+                future = pool.submit(function, *args, **kwargs)
+                in_flight[future] = task
+            
+            if not in_flight:
+                break
+            
+            done, _ = concurrent.futures.wait(in_flight,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                r, stage, image_file, crop_parameters = in_flight.pop(future)
+                if stage != 'plot':
+                    rolls[r]['completed'] += 1
+                    pbar.update(1)
+                if r in failed:
+                    continue
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if stage == 'plot':
+                        print('WARNING: QC plot failed for', image_file, '-', e)
+                    else:
+                        roll_failed(r, ' '.join(['Exception during', stage, 'of', image_file+':', repr(e)]))
+                    continue
+                
+                try:
+                    if stage == 'detect':
+                        frame_detected(r, result)
+                    elif stage == 'crop':
+                        frame_cropped(r, image_file, crop_parameters)
+                except Exception as e:
+                    roll_failed(r, str(e))
+    
+    pool.shutdown()
+    if plot_pool:
+        plot_pool.shutdown()
+    
+    if failed:
+        print('WARNING: Processing failed for', len(failed), 'of', len(roll_templates), 'rolls:')
+        for r, reason in failed.items():
+            print(r, '-', reason)
+    
+    return results, failed
+
 def preprocess_with_fiducial_proxies(image_directory,
                                      template_directory,
                                      buffer_distance=250,
@@ -331,7 +706,15 @@ def preprocess_with_fiducial_proxies(image_directory,
                                      qc_df_output_directory='qc/proxy_detection_data_frames',
                                      qc_plots=True,
                                      qc_plots_output_directory='qc/proxy_detection',
-                                     EE_find_matching_template = False):
+                                     EE_find_matching_template = False,
+                                     max_workers = None,
+                                     streaming_statistics = False,
+                                     results_store = None,
+                                     triage = False,
+                                     duplicate_index = None,
+                                     EE_select_template = False,
+                                     template_selection_cache = 'qc/template_selection.json',
+                                     qc_writer = None):
     """
     Detects fiducial marker proxies at midside left, top, right, and bottom positions.
     
@@ -340,116 +723,99 @@ def preprocess_with_fiducial_proxies(image_directory,
     
     Requires at least two fiducial marker proxies to approximate principal point.
     
+    With EE_find_matching_template, images are grouped by roll and all rolls are processed
+    in a shared pool of workers, see hipp.batch.schedule_roll_preprocessing(). Rolls that fail
+    are reported and skipped. The returned image_square_dim is that of the last roll.
+    None is returned if no roll, or without EE_find_matching_template the image directory,
+    could be processed.
+    Set streaming_statistics to start cropping each roll before its detection has finished.
+    
     To read in and examine QC dataframe use pandas.read_pickle('proxy_locations_df.pd'), 
     for example.
+    
+    With results_store, a directory, per image results are also appended to a columnar
+    hipp.io.ResultsStore as each roll completes. Without EE_find_matching_template, 
+    all images are stored under the name of the image directory as roll.
+    
+    With triage, blank, damaged or non-frame scans are identified from thumbnail statistics
+    and excluded before detection, see hipp.qc.triage_frames(). Rejected images are listed
+    in rejected_frames.csv in qc_df_output_directory. With a hipp.qc.DuplicateIndex as
+    duplicate_index, near duplicates of indexed or earlier frames are rejected as well.
+    duplicate_index requires triage.
+    
+    With EE_select_template, rolls that do not match a template directory by name are
+    assigned the best scoring template set in template_directory, see 
+    hipp.core.TemplateSelector. Decisions are cached in template_selection_cache.
+    
+    With a hipp.qc.QCWriter as qc_writer, QC plots are sampled and written in the background
+    by the writer. Close the writer to wait for all plots to be written.
     """
+    if duplicate_index is not None and not triage:
+        raise ValueError('duplicate_index requires triage = True')
+    
     images = sorted(Path(image_directory).glob('*tif'))
     
+    if triage:
+        images, rejected_df = hipp.qc.triage_frames(images, 
+                                                    max_workers = max_workers,
+                                                    verbose = verbose,
+                                                    duplicate_index = duplicate_index)
+        if len(rejected_df):
+            Path(qc_df_output_directory).mkdir(parents=True, exist_ok=True)
+            rejected_df.to_csv(os.path.join(qc_df_output_directory,'rejected_frames.csv'), index=False)
+            print('Excluded', len(rejected_df), 'images after triage. See', 
+                  os.path.join(qc_df_output_directory,'rejected_frames.csv'))
+    
+    roll_callback = None
+    if results_store:
+        store = hipp.io.ResultsStore(results_store)
+        run = store.new_run()
+        def roll_callback(r, result):
+            store.append_roll(r,
+                              result['detected_df'],
+                              result['proxy_locations_df'],
+                              result['principal_points'],
+                              result['distances'],
+                              result['intersection_angles'],
+                              result['image_square_dim'],
+                              run = run)
+    
     if EE_find_matching_template:
-        detected_df_list = []
-        proxy_locations_df_list = []
-        principal_points_list = []
-        distances_list = []
-        intersection_angles_list = []
+        template_selector = None
+        if EE_select_template:
+            template_selector = hipp.core.TemplateSelector(template_directory,
+                                                           cache_file = template_selection_cache,
+                                                           buffer_distance = buffer_distance,
+                                                           verbose = verbose)
+        roll_templates = hipp.batch.find_roll_template_directories(images, 
+                                                                   template_directory,
+                                                                   template_selector = template_selector)
         
-        # find matching EE template based on roll name
-        rolls = sorted(set([Path(i).stem[:-4] for i in images]))
-        template_dirs = [t for t in Path(template_directory).iterdir() if t.is_dir()]
-        
-        for r in rolls:
-            template_dir = None
-            images_tmp = [img for img in images if r in img.stem]
-            for t in template_dirs:
-                if r in t.as_posix():
-                    template_dir = t.as_posix()
-            if not template_dir:
-                print('No matching templates found for',r,'in provided template directory')
-                sys.exit(1) 
-            
-            print('Templates found for roll',r)
-            images_tmp = [img.as_posix() for img in images if r in img.stem]
-            templates = hipp.core.load_midside_fiducial_proxy_templates(template_dir)
-            detected_df = hipp.core.iter_detect_fiducial_proxies(images_tmp,
-                                                                 templates,
+        results, failed = hipp.batch.schedule_roll_preprocessing(roll_templates,
                                                                  buffer_distance = buffer_distance,
-                                                                 verbose         = verbose)
-            
-
-            proxy_locations_df = hipp.core.nan_offset_fiducial_proxies(detected_df,
-                                                                       threshold_px = threshold_px,
-                                                                       missing_proxy = missing_proxy)
-            
-            result = hipp.core.compute_principal_point_from_proxies(proxy_locations_df,
-                                                                    verbose=verbose)
-
-            principal_points, distances, intersection_angles = result
-
-            if np.isnan(np.nanmin(distances)):
-                print("""Could not compute distance between any fiducial proxies and principal point. 
-                Detection likely failed. Check your inputs.""")
-                sys.exit(1)
-                
-            image_square_dim = int(round((np.nanmin(distances))/2))*2 # ensure half is non float for array index slicing
-
-            new_image_square_dim = hipp.core.validate_square_dim(images_tmp,
-                                                                 buffer_distance,
-                                                                 principal_points,
-                                                                 image_square_dim)
-            
-            if new_image_square_dim and missing_proxy:
-                print('Missing_proxy set to', missing_proxy)
-                print('Adjusting final image dimensions to minimum viable size from',
-                      image_square_dim, 'to', new_image_square_dim)
-                print('Check qc plots for:')
-                for i in images_tmp:
-                    print(i)
-                image_square_dim = new_image_square_dim
-                
-            elif new_image_square_dim:
-                msg = '\n'.join(['WARNING: Irregular final image dimensions detected',
-                                 'Likely due to missing fiducial marker on a side of the images.',
-                                 'Check qc plots for:'])
-                print(msg)
-                for i in images_tmp:
-                    print(i)
-                if not missing_proxy:
-                    msg = '\n'.join(['Consider reprocessing by setting missing_proxy option to left, top, right, or bottom',
-                                     'to improve principal point detection.'])
-                    print(msg)
-            
-            print("Cropping images to square with dimensions", str(image_square_dim))
-            hipp.core.iter_crop_image_from_file(images_tmp,
-                                                principal_points,
-                                                image_square_dim,
-                                                output_directory = output_directory,
-                                                buffer_distance  = buffer_distance,
-                                                stretch_histogram = stretch_histogram,
-                                                clahe_enhancement = clahe_enhancement,
-                                                verbose = verbose)
-
-                
-            if qc_plots:
-                print("Plotting proxy detection QC plots at", qc_plots_output_directory)
-                hipp.plot.iter_plot_proxies(images_tmp,
-                                            proxy_locations_df,
-                                            principal_points,
-                                            buffer_distance  = buffer_distance,
-                                            output_directory = qc_plots_output_directory,
-                                            verbose=verbose)
-                      
-            detected_df_list.append(detected_df)
-            proxy_locations_df_list.append(proxy_locations_df)
-            principal_points_list.extend(principal_points)
-            distances_list.extend(distances)
-            intersection_angles_list.extend(intersection_angles)
-                      
-        detected_df = pd.concat(detected_df_list)
-        proxy_locations_df = pd.concat(proxy_locations_df_list)
-        principal_points = principal_points_list
-        distances = distances_list
-        intersection_angles = intersection_angles_list
+                                                                 threshold_px = threshold_px,
+                                                                 stretch_histogram = stretch_histogram,
+                                                                 clahe_enhancement = clahe_enhancement,
+                                                                 output_directory = output_directory,
+                                                                 verbose = verbose,
+                                                                 missing_proxy = missing_proxy,
+                                                                 qc_plots = qc_plots,
+                                                                 qc_plots_output_directory = qc_plots_output_directory,
+                                                                 max_workers = max_workers,
+                                                                 streaming_statistics = streaming_statistics,
+                                                                 roll_callback = roll_callback,
+                                                                 qc_writer = qc_writer)
+        if not results:
+            print('No rolls were processed successfully.')
+            return None
         
-    
+        rolls = sorted(results.keys())
+        detected_df = pd.concat([results[r]['detected_df'] for r in rolls])
+        proxy_locations_df = pd.concat([results[r]['proxy_locations_df'] for r in rolls])
+        principal_points = [p for r in rolls for p in results[r]['principal_points']]
+        distances = [d for r in rolls for d in results[r]['distances']]
+        intersection_angles = [a for r in rolls for a in results[r]['intersection_angles']]
+        image_square_dim = results[rolls[-1]]['image_square_dim']
               
     else:
         images = [img.as_posix() for img in images]
@@ -458,39 +824,18 @@ def preprocess_with_fiducial_proxies(image_directory,
                                                              templates,
                                                              buffer_distance = buffer_distance,
                                                              verbose         = verbose)
-
-        proxy_locations_df = hipp.core.nan_offset_fiducial_proxies(detected_df,
-                                                                   threshold_px = threshold_px,
-                                                                   missing_proxy = missing_proxy)
-        result = hipp.core.compute_principal_point_from_proxies(proxy_locations_df,
-                                                                verbose=verbose)
-        principal_points, distances, intersection_angles = result
-        image_square_dim = int(round((np.nanmin(distances))/2))*2 # ensure half is non float for array index slicing
-        
-        new_image_square_dim = hipp.core.validate_square_dim(images,
-                                                             buffer_distance,
-                                                             principal_points,
-                                                             image_square_dim)
-        if new_image_square_dim and missing_proxy:
-            print('Missing_proxy set to', missing_proxy)
-            print('Adjusting final image dimensions to minimum viable size from',
-                  image_square_dim, 'to', new_image_square_dim)
-            print('Check qc plots for:')
-            for i in images:
-                print(i)
-            image_square_dim = new_image_square_dim
-
-        elif new_image_square_dim:
-            msg = '\n'.join(['WARNING: Irregular final image dimensions detected',
-                             'Likely due to missing fiducial marker on a side of the images.',
-                             'Check qc plots for:'])
-            print(msg)
-            for i in images:
-                print(i)
-            if not missing_proxy:
-                msg = '\n'.join(['Consider reprocessing by setting missing_proxy option to left, top, right, or bottom',
-                                 'to improve principal point detection.'])
-                print(msg)
+        try:
+            result = hipp.batch.compute_proxy_crop_parameters(images,
+                                                              detected_df,
+                                                              buffer_distance = buffer_distance,
+                                                              threshold_px = threshold_px,
+                                                              missing_proxy = missing_proxy,
+                                                              verbose = verbose)
+        except ValueError as e:
+            # reported like failed rolls with EE_find_matching_template
+            print('WARNING: Processing failed for', Path(image_directory).name, '-', e)
+            return None
+        proxy_locations_df, principal_points, distances, intersection_angles, image_square_dim = result
                 
         print("Cropping images to square with dimensions", str(image_square_dim))
         hipp.core.iter_crop_image_from_file(images,
@@ -501,10 +846,6 @@ def preprocess_with_fiducial_proxies(image_directory,
                                             stretch_histogram = stretch_histogram,
                                             clahe_enhancement = clahe_enhancement,
                                             verbose = verbose)
-        if np.isnan(np.nanmin(distances)):
-            print("""Could not compute distance between any fiducial proxies and principal point. 
-            Detection likely failed. Check your inputs.""")
-            sys.exit(1)
         if qc_plots:
             print("Plotting proxy detection QC plots at", qc_plots_output_directory)
             hipp.plot.iter_plot_proxies(images,
@@ -512,7 +853,16 @@ def preprocess_with_fiducial_proxies(image_directory,
                                         principal_points,
                                         buffer_distance  = buffer_distance,
                                         output_directory = qc_plots_output_directory,
-                                        verbose=verbose)      
+                                        verbose=verbose,
+                                        qc_writer = qc_writer)      
+        if roll_callback:
+            roll_callback(Path(image_directory).name,
+                          {'detected_df'         : detected_df,
+                           'proxy_locations_df'  : proxy_locations_df,
+                           'principal_points'    : principal_points,
+                           'distances'           : distances,
+                           'intersection_angles' : intersection_angles,
+                           'image_square_dim'    : image_square_dim})
     if qc_df:
         print("Saving proxy detection QC dataframes to", qc_df_output_directory)
         p = Path(qc_df_output_directory)
@@ -525,5 +875,3 @@ def preprocess_with_fiducial_proxies(image_directory,
 
     
     return image_square_dim
-                                        
-                                        
\ No newline at end of file
@@ -1,24 +1,24 @@
+import bisect
 import cv2
 from collections.abc import Iterable
 import concurrent
 import glob
+import json
 import numpy as np
 import os
 import pandas as pd
 import pathlib
 import psutil
 import shutil
+import threading
 from tqdm import tqdm
-from scipy.signal import find_peaks
-import matplotlib.pyplot as plt
-import rasterio
+import warnings
 
 import hipp.core
 import hipp.image
 import hipp.io
 import hipp.math
 import hipp.qc
-import hipp.tools
 import hipp.utils
 
 """
@@ -58,21 +58,57 @@ def compute_principal_points(fiducial_locations_df, quality_scores_df):
     for i in np.arange(0,4):
         median_score = quality_scores_df.iloc[:,i].median()
         median_scores.append(median_score)
-
+    
+    locations = np.array(fiducial_locations_df.iloc[:,:4].values.tolist(), dtype=float)
+    scores    = quality_scores_df.iloc[:,:4].values.astype(float)
+    
+    principal_point_array = hipp.core.compute_principal_points_from_fiducial_array(locations,
+                                                                                  scores,
+                                                                                  median_scores)
     principal_points = []
-    for i in range(len(quality_scores_df)):
-        
-        subpixel_fiducial_locations = fiducial_locations_df.iloc[i].values
-        subpixel_quality_scores = quality_scores_df.iloc[i].values
-
-        principal_point = hipp.core.compute_principal_point(subpixel_fiducial_locations, 
-                                                            subpixel_quality_scores, 
-                                                            median_scores)
-        principal_points.append([principal_point])
+    for principal_point in principal_point_array:
+        if np.isnan(principal_point).any():
+            principal_points.append([None])
+        else:
+            principal_points.append([(principal_point[0], principal_point[1])])
         
     principal_points_df = pd.DataFrame(principal_points,columns=['principal_point'])
     
     return principal_points_df
+
+def compute_principal_points_from_fiducial_array(locations,
+                                                 scores,
+                                                 median_scores = None,
+                                                 threshold = 0.01):
+    """
+    Vectorized equivalent of hipp.core.compute_principal_point() for all images at once.
+    
+    locations is a stack of subpixel fiducial marker locations with shape (N, 4, 2), 
+    ordered left, top, right, bottom (or top left, top right, bottom right, bottom left 
+    for corner fiducials) in y,x. scores has shape (N, 4). median_scores default to the 
+    median score per fiducial marker position over all images.
+    
+    Returns principal points with shape (N, 2), with np.nan where no pair of diametrically 
+    opposed fiducial markers passed the score evaluation.
+    """
+    locations = np.asarray(locations, dtype=float)
+    scores    = np.asarray(scores, dtype=float)
+    if median_scores is None:
+        median_scores = np.nanmedian(scores, axis=0)
+    median_scores = np.asarray(median_scores, dtype=float)
+    
+    passed = (median_scores - scores) < threshold
+    
+    # midpoints between diametrically opposed fiducial markers
+    estimates = np.stack([(locations[:,0] + locations[:,2]) / 2,
+                          (locations[:,1] + locations[:,3]) / 2], axis=1)
+    valid     = np.stack([passed[:,0] & passed[:,2],
+                          passed[:,1] & passed[:,3]], axis=1)
+    
+    estimates[~valid] = np.nan
+    principal_points = _mean_of_estimates(estimates[:,0], estimates[:,1])
+    
+    return principal_points
     
 def compute_mean_midside_corner_principal_point(df_corner, df_midside):
     df = pd.concat([pd.DataFrame(df_midside.principal_point.to_list(), columns=['midside_y',
@@ -85,65 +121,36 @@ def compute_mean_midside_corner_principal_point(df_corner, df_midside):
     return df
     
 def compute_principal_point_from_proxies(df, verbose=True):
-    distances = []
-    principal_points = []
-    intersection_angles = []
     verbose=False
-
-    for index, row in df.iterrows():
+    
+    keys = ['left_y',   'left_x',
+            'top_y',    'top_x',
+            'right_y',  'right_x',
+            'bottom_y', 'bottom_x']
+    locations = df[keys].values.astype(float).reshape(-1,4,2)
+    
+    result = hipp.core.compute_principal_points_from_proxy_array(locations)
+    principal_point_array, distance_array, intersection_angle_array = result
+    
+    principal_points = []
+    for file_name, principal_point, intersection_angle in zip(df['file_names'].values,
+                                                              principal_point_array,
+                                                              intersection_angle_array):
         if verbose:
-            print('Computing principal point for:', row['file_names'])
-        p1 = (row['left_y'], row['left_x'])
-        p2 = (row['right_y'], row['right_x'])
-        principal_point_LR = hipp.math.midpoint(p1[1], p1[0], p2[1], p2[0])
-        distances.append(hipp.math.distance(p1,p2))
-
-        p1 = (row['top_y'], row['top_x'])
-        p2 = (row['bottom_y'], row['bottom_x'])
-        principal_point_TB = hipp.math.midpoint(p1[1], p1[0], p2[1], p2[0])
-        distances.append(hipp.math.distance(p1,p2))
-        
-        # if no diametrically opposing proxies are found
-        # use first viable combination of left/right x or top/bottom y
-        # to estimate position
-        if np.isnan(principal_point_LR).any() and np.isnan(principal_point_TB).any():
-        
-            if np.isnan(principal_point_LR).any():
-                principal_point_LR = (row['left_y'], row['top_x'])
-            if np.isnan(principal_point_LR).any():
-                principal_point_LR = (row['left_y'], row['bottom_x'])
-            if np.isnan(principal_point_LR).any():
-                principal_point_LR = (row['right_y'], row['top_x'])
-            if np.isnan(principal_point_LR).any():
-                principal_point_LR = (row['right_y'], row['bottom_x'])
-        
-            if np.isnan(principal_point_LR).any():
-            
-                if np.isnan(principal_point_TB).any():
-                    principal_point_TB = (row['left_y'], row['top_x'])
-                if np.isnan(principal_point_TB).any():
-                    principal_point_TB = (row['left_y'], row['bottom_x'])
-                if np.isnan(principal_point_TB).any():
-                    principal_point_TB = (row['right_y'], row['top_x'])
-                if np.isnan(principal_point_TB).any():
-                    principal_point_TB = (row['right_y'], row['bottom_x'])
-                
-        if np.isnan(principal_point_LR).any() and np.isnan(principal_point_TB).any():
+            print('Computing principal point for:', file_name)
+        
+        if np.isnan(principal_point).any():
 #             if verbose:
-            print('WARNING: Unable to estimate principal point for:', row['file_names'])
+            print('WARNING: Unable to estimate principal point for:', file_name)
             print('WARNING: Using mean principal point estimate from image set instead.')
             principal_point = (np.nan,np.nan)
             principal_points.append(principal_point)
         else:
-            principal_point = tuple(map(np.nanmean, zip(*(principal_point_TB, principal_point_LR))))
             principal_point = np.array([int(round(x)) for x in principal_point])
             principal_points.append(principal_point)
             if verbose:
                 print('Principal point estimated at:', str(principal_point))
         
-        proxy_locations    = np.array(list(zip(row.values[1::2], row.values[2::2])))
-        intersection_angle = hipp.qc.compute_opposing_fiducial_intersection_angle(proxy_locations)
-        intersection_angles.append(intersection_angle)
         if verbose:
             if not np.isnan(intersection_angle) and verbose:
                 print('Intersection angle at principal point:', str(intersection_angle))
@@ -153,9 +160,124 @@ def compute_principal_point_from_proxies(df, verbose=True):
     # Use mean principal point estimate from image set to replace instance where < 2 proxies were found.
     df_tmp = pd.DataFrame(principal_points)
     principal_points = list(df_tmp.fillna(df_tmp.mean().round().astype(int)).astype(int).values)
+    
+    distances = distance_array.ravel().tolist()
+    intersection_angles = intersection_angle_array.tolist()
         
     return principal_points, distances, intersection_angles
 
+def _mean_of_estimates(a, b):
+    """
+    Elementwise mean of two estimates ignoring np.nan, computed as np.mean() of 
+    two values would.
+    """
+    with np.errstate(invalid='ignore'):
+        return np.where(np.isnan(a), b, np.where(np.isnan(b), a, (a + b) / 2))
+
+def compute_principal_points_from_proxy_array(locations):
+    """
+    Vectorized equivalent of hipp.core.estimate_principal_point_from_proxies() for all
+    images at once.
+    
+    locations is a stack of fiducial marker proxy locations with shape (N, 4, 2), ordered
+    left, top, right, bottom in y,x.
+    
+    Returns principal points with shape (N, 2), with np.nan where no estimate is possible,
+    distances between left/right and top/bottom proxies with shape (N, 2) and 
+    intersection angles at principal point with shape (N,).
+    """
+    locations = np.asarray(locations, dtype=float)
+    left, top, right, bottom = locations[:,0], locations[:,1], locations[:,2], locations[:,3]
+    
+    principal_points_LR = (left + right) / 2
+    principal_points_TB = (top + bottom) / 2
+    
+    distances = np.stack([np.sqrt(np.square(right[:,0] - left[:,0]) + np.square(right[:,1] - left[:,1])),
+                          np.sqrt(np.square(bottom[:,0] - top[:,0]) + np.square(bottom[:,1] - top[:,1]))], axis=1)
+    
+    # if no diametrically opposing proxies are found
+    # use first viable combination of left/right y and top/bottom x
+    # to estimate position
+    candidates = np.stack([np.stack([left[:,0],  top[:,1]],    axis=1),
+                           np.stack([left[:,0],  bottom[:,1]], axis=1),
+                           np.stack([right[:,0], top[:,1]],    axis=1),
+                           np.stack([right[:,0], bottom[:,1]], axis=1)], axis=1)
+    viable   = ~np.isnan(candidates).any(axis=2)
+    fallback = np.isnan(principal_points_LR).any(axis=1) & \
+               np.isnan(principal_points_TB).any(axis=1) & \
+               viable.any(axis=1)
+    first    = np.argmax(viable, axis=1)
+    principal_points_LR[fallback] = candidates[fallback, first[fallback]]
+    
+    invalid = np.isnan(principal_points_LR).any(axis=1) & np.isnan(principal_points_TB).any(axis=1)
+    principal_points = _mean_of_estimates(principal_points_TB, principal_points_LR)
+    principal_points[invalid] = np.nan
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m1 = (right[:,1] - left[:,1]) / (right[:,0] - left[:,0])
+        m2 = (bottom[:,1] - top[:,1]) / (bottom[:,0] - top[:,0])
+        intersection_angles = np.abs(np.degrees(np.arctan((m2 - m1) / (1 + m1 * m2))))
+    
+    return principal_points, distances, intersection_angles
+
+def estimate_principal_point_from_proxies(row):
+    """
+    Estimates principal point for a single image from fiducial marker proxy locations,
+    as returned per row by hipp.core.nan_offset_fiducial_proxies().
+    
+    Returns principal point (np.nan, np.nan if it can not be estimated), distances between 
+    left/right and top/bottom proxies, and intersection angle at principal point.
+    """
+    distances = []
+    
+    p1 = (row['left_y'], row['left_x'])
+    p2 = (row['right_y'], row['right_x'])
+    principal_point_LR = hipp.math.midpoint(p1[1], p1[0], p2[1], p2[0])
+    distances.append(hipp.math.distance(p1,p2))
+
+    p1 = (row['top_y'], row['top_x'])
+    p2 = (row['bottom_y'], row['bottom_x'])
+    principal_point_TB = hipp.math.midpoint(p1[1], p1[0], p2[1], p2[0])
+    distances.append(hipp.math.distance(p1,p2))
+    
+    # if no diametrically opposing proxies are found
+    # use first viable combination of left/right x or top/bottom y
+    # to estimate position
+    if np.isnan(principal_point_LR).any() and np.isnan(principal_point_TB).any():
+    
+        if np.isnan(principal_point_LR).any():
+            principal_point_LR = (row['left_y'], row['top_x'])
+        if np.isnan(principal_point_LR).any():
+            principal_point_LR = (row['left_y'], row['bottom_x'])
+        if np.isnan(principal_point_LR).any():
+            principal_point_LR = (row['right_y'], row['top_x'])
+        if np.isnan(principal_point_LR).any():
+            principal_point_LR = (row['right_y'], row['bottom_x'])
+    
+        if np.isnan(principal_point_LR).any():
+        
+            if np.isnan(principal_point_TB).any():
+                principal_point_TB = (row['left_y'], row['top_x'])
+            if np.isnan(principal_point_TB).any():
+                principal_point_TB = (row['left_y'], row['bottom_x'])
+            if np.isnan(principal_point_TB).any():
+                principal_point_TB = (row['right_y'], row['top_x'])
+            if np.isnan(principal_point_TB).any():
+                principal_point_TB = (row['right_y'], row['bottom_x'])
+            
+    if np.isnan(principal_point_LR).any() and np.isnan(principal_point_TB).any():
+        principal_point = (np.nan,np.nan)
+    else:
+        principal_point = tuple(map(np.nanmean, zip(*(principal_point_TB, principal_point_LR))))
+    
+    proxy_locations    = np.array([(row['left_y'],   row['left_x']),
+                                   (row['top_y'],    row['top_x']),
+                                   (row['right_y'],  row['right_x']),
+                                   (row['bottom_y'], row['bottom_x'])])
+    intersection_angle = hipp.qc.compute_opposing_fiducial_intersection_angle(proxy_locations)
+    
+    return principal_point, distances, intersection_angle
+
 def validate_square_dim(image_files,
                         buffer_distance,
                         principal_points,
@@ -164,9 +286,10 @@ def validate_square_dim(image_files,
     new_square_dims = []
 
     for i,v in enumerate(image_files):
-        ds = rasterio.open(v)
-        h = ds.height + buffer_distance *2
-        w = ds.width + buffer_distance *2
+        # shape in the orientation detection and cropping use, see hipp.io.read_image()
+        height, width = hipp.io.read_image_shape(v)
+        h = height + buffer_distance *2
+        w = width + buffer_distance *2
         pp_h = principal_points[i][0] + buffer_distance/2
         pp_w = principal_points[i][1] + buffer_distance/2
 
@@ -193,10 +316,12 @@ def create_fiducial_template(image_file,
     p = pathlib.Path(output_directory)
     p.mkdir(parents=True, exist_ok=True)
     
-    image_array = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+    image_array = hipp.io.read_image(image_file)
 
     if isinstance(df,type(None)):
-        df = hipp.tools.point_picker(image_file)
+        # interactive tools require holoviews and panel
+        from hipp import tools
+        df = tools.point_picker(image_file)
 
     fiducial = (df.x[0],df.y[0])
     
@@ -216,13 +341,16 @@ def create_midside_fiducial_proxies_template(image_file,
                                              output_directory = 'input_data/fiducials',
                                              buffer_distance = 250,
                                              threshold= 50):
+    import matplotlib.pyplot as plt
     
     p = pathlib.Path(output_directory)
     p.mkdir(parents=True, exist_ok=True)
     
-    image_array = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+    image_array = hipp.io.read_image(image_file)
+    statistics = hipp.image.read_image_statistics(image_file, image_array = image_array)
     
-    n, bins, patches = plt.hist(image_array.ravel()[::40],bins=256,range=(0,256))
+    n = statistics['histogram']
+    plt.stairs(n, np.arange(257), fill=True)
 #     plt.close()
     
 #     p = find_peaks(n,prominence=1, width=1, height=n.max()/3)
@@ -241,7 +369,8 @@ def create_midside_fiducial_proxies_template(image_file,
     if isinstance(df,type(None)):
         print('Select inner most point to crop from for midside fiducial marker proxies,')
         print('in order from Left - Top - Right - Bottom.')
-        df = hipp.tools.point_picker(image_file,
+        from hipp import tools
+        df = tools.point_picker(image_file,
                                 point_count = 4)
     
     df = df + buffer_distance
@@ -315,7 +444,7 @@ def crop_image_from_file(image_file_principal_point_tuple,
     
     image_file, principal_point = image_file_principal_point_tuple
     
-    image_array = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+    image_array = hipp.io.read_image(image_file)
     image_array = hipp.core.pad_image(image_array,
                                       buffer_distance = buffer_distance)
     
@@ -432,18 +561,42 @@ def detect_fiducial_proxies(image_file,
                             templates,
                             buffer_distance=250):
 
-    image_array = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+    image_array = hipp.io.read_image(image_file)
 #     image_array = cv2.imread(image_file,cv2.IMREAD_COLOR)
 #     image_array = image_array[:,:,0]
+
+    matches, quality_scores = hipp.core.detect_fiducial_proxies_in_array(image_array,
+                                                                         templates,
+                                                                         buffer_distance = buffer_distance,
+                                                                         image_file = image_file)
     
-#     n, bins, patches = plt.hist(image_array.ravel()[::40],bins=256,range=(0,256))
-#     plt.close()
+    return matches, quality_scores, image_file
+
+def detect_fiducial_proxies_in_array(image_array,
+                                     templates,
+                                     buffer_distance=250,
+                                     image_file=None):
+    """
+    Detects fiducial marker proxies in an image array already in memory.
+    
+    Pass image_file if image_array is the image as read by hipp.io.read_image(), to reuse 
+    its cached statistics, see hipp.image.read_image_statistics().
+    
+    Returns proxy locations in padded image coordinates and quality scores.
+    """
+    
+#     n = hipp.image.compute_image_statistics(image_array)['histogram']
 #     p = find_peaks(n,prominence=10, width=1, height=n.max()/3)
 #     threshold = p[1]['right_bases'][0]
 #     image_array = hipp.image.threshold_and_add_noise(image_array, threshold=threshold)
     
     image_array = hipp.image.clahe_equalize_image(image_array)
-    image_array = hipp.image.img_linear_stretch(image_array)
+    statistics = None
+    if image_file is not None:
+        statistics = hipp.image.read_image_statistics(image_file, 
+                                                      image_array = image_array,
+                                                      clahe_enhancement = True)
+    image_array = hipp.image.img_linear_stretch(image_array, statistics = statistics)
 #     image_array = hipp.image.threshold_and_add_noise(image_array)
     
     image_array = hipp.core.pad_image(image_array,
@@ -487,12 +640,19 @@ def detect_fiducial_proxies(image_file,
 
     matches = [left_fiducial,top_fiducial,right_fiducial,bottom_fiducial]
     
-    return matches, quality_scores, image_file
+    return matches, quality_scores
 
 def detect_high_res_fiducial(fiducial_crop_high_res_file,
                              template_high_res_zoomed_file,
                              distance_from_loc=200,
-                             qc=True):
+                             qc=True,
+                             qc_writer=None):
+    """
+    Detects fiducial marker in high resolution crop.
+    
+    With qc, the matched fiducial is written to qc/fiducial_detection/, in the background
+    and sampled by score if a hipp.qc.QCWriter is passed as qc_writer.
+    """
     
     fiducial_crop_high_res_array = cv2.imread(fiducial_crop_high_res_file,cv2.IMREAD_GRAYSCALE)
     template_high_res_zoomed_array = cv2.imread(template_high_res_zoomed_file,cv2.IMREAD_GRAYSCALE)
@@ -517,7 +677,10 @@ def detect_high_res_fiducial(fiducial_crop_high_res_file,
         image_array = image_array[y_T:y_B, x_L:x_R]
         
         out = os.path.join(output_directory,file_name+file_extension)
-        cv2.imwrite(out,image_array)
+        if qc_writer:
+            qc_writer.submit(cv2.imwrite, out, image_array, score = quality_score)
+        else:
+            cv2.imwrite(out,image_array)
     
     return match_location, quality_score
     
@@ -530,7 +693,8 @@ def detect_subpixel_fiducial_coordinates(image_file,
                                          distance_from_loc = 200,
                                          factor = 8,
                                          cleanup=True,
-                                         qc=True):
+                                         qc=True,
+                                         qc_writer=None):
     
     output_directory  ='tmp/fiducial_crop'
     p = pathlib.Path(output_directory)
@@ -554,7 +718,8 @@ def detect_subpixel_fiducial_coordinates(image_file,
         match_location_high_res, quality_score = hipp.core.detect_high_res_fiducial(fiducial_crop_high_res_file,
                                                                      template_high_res_zoomed_file,
                                                                      distance_from_loc=distance_from_loc,
-                                                                     qc=qc)
+                                                                     qc=qc,
+                                                                     qc_writer=qc_writer)
 
         y,x = ((match_location_high_res[0]+int(distance_from_loc/2))/factor,
                (match_location_high_res[1]+int(distance_from_loc/2))/factor)
@@ -617,7 +782,7 @@ def iter_crop_image_from_file(images,
     p.mkdir(parents=True, exist_ok=True)
 
     with tqdm(total=len(images)) as pbar:
-        pool = concurrent.futures.ThreadPoolExecutor(max_workers=psutil.cpu_count(logical=True)-1)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(psutil.cpu_count(logical=True)-1, 1))
 
         future = {pool.submit(hipp.core.crop_image_from_file,
                               img_pp,
@@ -638,7 +803,7 @@ def iter_detect_fiducial_proxies(images,
                                  verbose=False):
     print("Detecting fiducial proxies...")
     with tqdm(total=len(images)) as pbar:
-        pool = concurrent.futures.ThreadPoolExecutor(max_workers=psutil.cpu_count(logical=True)-1)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(psutil.cpu_count(logical=True)-1, 1))
         future = {pool.submit(hipp.core.detect_fiducial_proxies,
                               image_file,
                               templates,
@@ -717,38 +882,83 @@ def merge_midside_df_corner_df(df_corner=None,
         df_corner = hipp.core.split_position_tuples(df_corner)
         return df_corner
 
-def nan_low_scoring_fiducial_matches(df,threshold=0.01):
+def nan_low_scoring_fiducial_matches(df,
+                                     threshold = 0.01,
+                                     method = 'threshold',
+                                     n_mad = 5,
+                                     group_by_roll = False):
     """
-    Replaces fiducial marker positions that received a low score with np.nan in place.
+    Replaces fiducial marker positions that received a low score with np.nan.
     A low score is determined by the difference between the median score for a given fidcuial marker position
     accross all images and a given score exceeding the threshold.
+    
+    method 'mad' instead flags scores more than n_mad scaled median absolute deviations below 
+    the median, see hipp.core.robust_outlier_mask(). If group_by_roll is True, median scores
+    are computed per roll, derived from the file names in the first column.
     """
     df = df.copy()
-    for i in np.arange(1,5):
-        fiducials = df.iloc[:,i].values
-        corresponding_scores = df.iloc[:,i+4].values
-        
-        median_score = np.median(corresponding_scores)
-        
-        for index,value in enumerate(corresponding_scores):
-            if median_score-value > threshold:
-                fiducials[index]= np.nan
+    scores = df.iloc[:,5:9].values.astype(float)
+    
+    groups = None
+    if group_by_roll:
+        groups = hipp.core.roll_from_file_names(df.iloc[:,0].values)
+    
+    if method == 'threshold':
+        mask = hipp.core.robust_outlier_mask(scores,
+                                             threshold = threshold,
+                                             groups = groups,
+                                             side = 'low')
+    else:
+        mask = hipp.core.robust_outlier_mask(scores,
+                                             n_mad = n_mad,
+                                             groups = groups,
+                                             side = 'low')
+    
+    for i in range(4):
+        df.iloc[mask[:,i], i+1] = np.nan
     return df
 
 def nan_offset_fiducial_proxies(iter_detect_fiducial_proxies_df,
                                 threshold_px = 50,
-                                missing_proxy=None):
+                                missing_proxy = None,
+                                method = 'threshold',
+                                n_mad = 5,
+                                min_offset_px = 5,
+                                group_by_roll = False):
+    """
+    Replaces fiducial marker proxy positions offset from the median position by more 
+    than threshold_px with np.nan.
+    
+    method 'mad' instead flags positions more than n_mad scaled median absolute deviations
+    and at least min_offset_px from the median, see hipp.core.robust_outlier_mask(). 
+    If group_by_roll is True, median positions are computed per roll, derived from the 
+    file names.
+    """
     
     df = pd.DataFrame(list(iter_detect_fiducial_proxies_df['match_locations'].values), 
                       columns=['left','top','right','bottom'])
     df.insert(0, 'file_names', iter_detect_fiducial_proxies_df['file_names'])
     df = hipp.core.split_position_tuples(df,skip=1)
     
-    for key in df.keys()[1:]:
-        offsets = df[key] - np.median(df[key])
-        for index, value in enumerate(offsets):
-            if abs(value) > threshold_px: # nan if offset from median position
-                df.loc[df.index == index, key] = np.nan
+    keys = df.keys()[1:]
+    locations = df[keys].values.astype(float)
+    
+    groups = None
+    if group_by_roll:
+        groups = hipp.core.roll_from_file_names(df['file_names'].values)
+    
+    if method == 'threshold':
+        mask = hipp.core.robust_outlier_mask(locations,
+                                             threshold = threshold_px,
+                                             groups = groups)
+    else:
+        mask = hipp.core.robust_outlier_mask(locations,
+                                             n_mad = n_mad,
+                                             min_deviation = min_offset_px,
+                                             groups = groups)
+    
+    locations[mask] = np.nan
+    df[keys] = locations
     
     if missing_proxy   == 'left':
         df[['left_y'  ,   'left_x']]   = (np.nan,np.nan)
@@ -760,6 +970,73 @@ def nan_offset_fiducial_proxies(iter_detect_fiducial_proxies_df,
         df[['bottom_y',   'bottom_x']] = (np.nan,np.nan)
         
     return df
+
+def robust_outlier_mask(values,
+                        threshold = None,
+                        n_mad = None,
+                        min_deviation = 0,
+                        groups = None,
+                        side = 'both'):
+    """
+    Flags outliers in each column of a 2D array relative to the column median, 
+    optionally computed per group of rows (e.g. per roll).
+    
+    With threshold, values deviating from the median by more than threshold are flagged.
+    As with np.median, no values are flagged in a column (or group) that contains np.nan.
+    
+    With n_mad, values deviating from the median by more than n_mad median absolute 
+    deviations (scaled to a standard deviation) and by more than min_deviation are flagged.
+    np.nan is ignored when computing the statistics.
+    
+    side 'both' flags deviations in either direction, 'low' only values below the median.
+    
+    Returns boolean array with the shape of values.
+    """
+    values = np.asarray(values, dtype=float)
+    
+    if n_mad is None:
+        medians = _column_medians(values, groups, skipna=False)
+        limit = threshold
+    else:
+        medians = _column_medians(values, groups, skipna=True)
+        mad = _column_medians(np.abs(values - medians), groups, skipna=True)
+        limit = np.maximum(n_mad * 1.4826 * mad, min_deviation)
+    
+    if side == 'low':
+        deviations = medians - values
+    else:
+        deviations = np.abs(values - medians)
+    
+    with np.errstate(invalid='ignore'):
+        mask = deviations > limit
+    return mask
+
+def _column_medians(values, groups=None, skipna=False):
+    """
+    Column medians broadcast to the shape of values, per group of rows if groups are given.
+    """
+    if groups is None:
+        with warnings.catch_warnings():
+            # all np.nan columns
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            if skipna:
+                medians = np.nanmedian(values, axis=0)
+            else:
+                medians = np.median(values, axis=0)
+        return np.broadcast_to(medians, values.shape)
+    
+    df = pd.DataFrame(values)
+    codes, _ = pd.factorize(np.asarray(groups))
+    medians = df.groupby(codes).transform('median').to_numpy(copy=True)
+    if not skipna:
+        medians[df.isna().groupby(codes).transform('any').values] = np.nan
+    return medians
+
+def roll_from_file_names(file_names):
+    """
+    Returns roll name for EE image file names, e.g. AR1ROLLA001 for AR1ROLLA0010001.tif.
+    """
+    return np.array([os.path.splitext(os.path.basename(f))[0][:-4] for f in file_names])
     
 def pad_image(image_array,
               buffer_distance = 250):
@@ -789,12 +1066,523 @@ def split_position_tuples(df,skip=1):
     df = df.copy()
     keys = df.keys().values[skip:]
 
+    split = []
     for key in keys:
         df_clean = pd.DataFrame(df[key].tolist(), 
                           index=df.index, 
                           columns=[key+'_y', key+'_x'])
+        split.append(df_clean)
 
-        df = pd.concat([df,df_clean],axis=1)
+    df = pd.concat([df]+split,axis=1)
 
     df = df.drop(keys, axis = 1)
-    return df
\ No newline at end of file
+    return df
+
+class StreamingRollStatistics:
+    """
+    Running fiducial marker proxy statistics for a single roll.
+    
+    Maintains the median proxy positions used by hipp.core.nan_offset_fiducial_proxies()
+    and the minimum distance between opposing proxies used to define the final square
+    image dimensions, updated as each detection from hipp.core.detect_fiducial_proxies()
+    arrives. Once the medians are stable, provisional crop parameters can be computed for 
+    a frame without waiting for detection on the rest of the roll.
+    
+    Positions and distances are kept in sorted order as they are added, so medians are 
+    looked up directly and the minimum distance is found by scanning the smallest 
+    distances for one whose proxies are not offset from the medians.
+    
+    The square dimension is committed the first time crop parameters are requested after
+    it stayed the same for min_samples detections, so all provisionally cropped frames of 
+    a roll share the same dimensions and likely match the final dimensions.
+    """
+    keys = ['left_y',   'left_x',
+            'top_y',    'top_x',
+            'right_y',  'right_x',
+            'bottom_y', 'bottom_x']
+    
+    def __init__(self,
+                 threshold_px = 50,
+                 missing_proxy = None,
+                 min_samples = 5,
+                 tolerance_px = 2):
+        self.threshold_px  = threshold_px
+        self.missing_proxy = missing_proxy
+        self.min_samples   = min_samples
+        self.tolerance_px  = tolerance_px
+        self.file_names    = []
+        self.image_square_dim = None
+        self._index        = {}
+        self._locations    = np.empty((64, 8))
+        self._sorted       = [[] for k in self.keys]
+        self._nan_counts   = np.zeros(8, dtype=int)
+        # (distance, row) between left/right and top/bottom proxies
+        self._distances    = [[], []]
+        self._medians      = []
+        self._square_dims  = []
+    
+    def __len__(self):
+        return len(self.file_names)
+    
+    def add(self, detection):
+        """
+        Adds output of hipp.core.detect_fiducial_proxies() for one image.
+        """
+        match_locations, scores, file_name = detection
+        n = len(self.file_names)
+        if n == len(self._locations):
+            self._locations = np.concatenate([self._locations, np.empty_like(self._locations)])
+        location = np.array(match_locations, dtype=float).ravel()
+        self._locations[n] = location
+        self._index[file_name] = n
+        self.file_names.append(file_name)
+        
+        for i, value in enumerate(location):
+            if np.isnan(value):
+                self._nan_counts[i] += 1
+            else:
+                bisect.insort(self._sorted[i], value)
+        
+        proxies = location.reshape(4,2)
+        for i, (a, b) in enumerate([(0, 2), (1, 3)]):
+            distance = np.sqrt(np.square(proxies[b] - proxies[a]).sum())
+            if not np.isnan(distance):
+                bisect.insort(self._distances[i], (distance, n))
+        
+        self._medians.append(self.medians())
+        with np.errstate(invalid='ignore'):
+            minimum_distance = self.minimum_distance()
+        self._square_dims.append(None if np.isnan(minimum_distance) else 
+                                 int(round(minimum_distance/2))*2)
+    
+    def medians(self):
+        """
+        Median proxy positions, np.nan where a position is missing as with np.median.
+        """
+        medians = np.full(8, np.nan)
+        for i, values in enumerate(self._sorted):
+            if values and not self._nan_counts[i]:
+                middle = len(values) // 2
+                if len(values) % 2:
+                    medians[i] = values[middle]
+                else:
+                    medians[i] = (values[middle-1] + values[middle]) / 2
+        return medians
+    
+    def is_stable(self):
+        """
+        Medians are stable once at least min_samples detections were added and 
+        no median position moved by more than tolerance_px over the last min_samples
+        detections.
+        """
+        if len(self._medians) <= self.min_samples:
+            return False
+        recent = np.array(self._medians[-(self.min_samples+1):])
+        return bool((np.abs(recent - recent[-1]) <= self.tolerance_px).all())
+    
+    def is_square_dim_stable(self):
+        """
+        The square dimension is stable once it did not change over the last min_samples
+        detections.
+        """
+        if len(self._square_dims) <= self.min_samples:
+            return False
+        recent = self._square_dims[-(self.min_samples+1):]
+        return recent[-1] is not None and recent.count(recent[-1]) == len(recent)
+    
+    def _valid(self, locations, medians):
+        with np.errstate(invalid='ignore'):
+            valid = ~(np.abs(locations - medians) > self.threshold_px)
+        if self.missing_proxy:
+            index = self.keys.index(self.missing_proxy+'_y')
+            valid[..., index:index+2] = False
+        return valid
+    
+    def proxy_locations(self):
+        """
+        Returns proxy locations as numpy.array of shape (N, 8), with positions offset from
+        the current median positions by more than threshold_px replaced with np.nan.
+        """
+        locations = self._locations[:len(self)].copy()
+        locations[~self._valid(locations, self.medians())] = np.nan
+        return locations
+    
+    def minimum_distance(self):
+        medians = self.medians()
+        minimum = np.nan
+        for i, (a, b) in enumerate([(0, 2), (1, 3)]):
+            columns = [2*a, 2*a+1, 2*b, 2*b+1]
+            for distance, row in self._distances[i]:
+                if self._valid(self._locations[row, columns], medians[columns]).all():
+                    minimum = np.nanmin([minimum, distance])
+                    break
+        return minimum
+    
+    def crop_parameters(self, file_name, require_stable=True):
+        """
+        Returns provisional principal point and square dimensions to crop an image with.
+        
+        Returns None if the statistics or the square dimension are not stable yet or no 
+        distance between opposing proxies could be computed.
+        """
+        if require_stable and not self.is_stable():
+            return None
+        
+        if not self.image_square_dim:
+            if require_stable and not self.is_square_dim_stable():
+                return None
+            with np.errstate(invalid='ignore'):
+                minimum_distance = self.minimum_distance()
+            if np.isnan(minimum_distance):
+                return None
+            self.image_square_dim = int(round(minimum_distance/2))*2
+        
+        medians = self.medians()
+        location = self._locations[self._index[file_name]].copy()
+        location[~self._valid(location, medians)] = np.nan
+        principal_point, _, _ = hipp.core.estimate_principal_point_from_proxies(dict(zip(self.keys, location)))
+        
+        if np.isnan(principal_point).any():
+            # use mean principal point estimate from frames detected so far
+            estimates, _, _ = hipp.core.compute_principal_points_from_proxy_array(
+                                  self.proxy_locations().reshape(-1,4,2))
+            estimates = estimates[~np.isnan(estimates).any(axis=1)]
+            if estimates.size == 0:
+                return None
+            estimates = np.array([[int(round(x)) for x in p] for p in estimates])
+            principal_point = tuple(np.round(estimates.mean(axis=0)).astype(int))
+        else:
+            principal_point = tuple([int(round(x)) for x in principal_point])
+        
+        return principal_point, self.image_square_dim
+
+
+class TemplateBank:
+    """
+    Keeps midside fiducial marker proxy templates in memory.
+    
+    Template sets are loaded with hipp.core.load_midside_fiducial_proxy_templates() the 
+    first time they are requested and reused afterwards. With a template library directory,
+    containing one sub directory per template set, templates can be looked up by roll name
+    as done for EE imagery by hipp.batch.find_roll_template_directories().
+    """
+    def __init__(self, template_directory):
+        self.template_directory = template_directory
+        self._templates = {}
+        self._lock = threading.Lock()
+    
+    def get(self, template_directory=None):
+        """
+        Returns templates in template_directory, or in the bank's template directory if None.
+        """
+        template_directory = pathlib.Path(template_directory or self.template_directory).as_posix()
+        with self._lock:
+            if template_directory not in self._templates:
+                templates = hipp.core.load_midside_fiducial_proxy_templates(template_directory)
+                self._templates[template_directory] = templates
+            return self._templates[template_directory]
+    
+    def template_directories(self):
+        return sorted([t.as_posix() for t in pathlib.Path(self.template_directory).iterdir() if t.is_dir()])
+    
+    def find_template_directory(self, roll):
+        """
+        Returns the template set directory matching the roll name, or None.
+        """
+        template_dir = None
+        for t in self.template_directories():
+            if roll in t:
+                template_dir = t
+        return template_dir
+    
+    def for_roll(self, roll):
+        """
+        Returns templates matching the roll name, or None if there is no matching template set.
+        """
+        template_dir = self.find_template_directory(roll)
+        if template_dir:
+            return self.get(template_dir)
+
+    def template_sets(self):
+        """
+        Returns all directories in the template library that contain a template set.
+        """
+        template_dirs = set()
+        for extension in ['.tif', '.jpg']:
+            for l_path in pathlib.Path(self.template_directory).rglob('L' + extension):
+                template_dirs.add(l_path.parent.as_posix())
+        return sorted(template_dirs)
+
+    def score(self,
+              template_directory,
+              image_arrays,
+              downsample = 4,
+              buffer_distance = 250):
+        """
+        Scores a template set on images already downsampled by factor downsample.
+
+        Templates and buffer_distance are downsampled by the same factor. Returns the mean
+        quality score of all proxy matches, or np.nan if the templates do not fit the images.
+        """
+        templates = [cv2.resize(t,
+                                (max(t.shape[1] // downsample, 1), max(t.shape[0] // downsample, 1)),
+                                interpolation = cv2.INTER_AREA) for t in self.get(template_directory)]
+        scores = []
+        for image_array in image_arrays:
+            try:
+                matches, quality_scores = hipp.core.detect_fiducial_proxies_in_array(image_array,
+                                                                                     templates,
+                                                                                     buffer_distance = buffer_distance // downsample)
+            except cv2.error:
+                # template larger than search window
+                return np.nan
+            scores.extend(quality_scores)
+        if not scores:
+            return np.nan
+        return float(np.mean(scores))
+
+
+class TemplateSelector:
+    """
+    Selects the best template set in a template library for each roll.
+
+    Every template set found in the library, see hipp.core.TemplateBank.template_sets(), is
+    scored on n_samples frames of the roll read at 1/downsample resolution and the set with
+    the highest mean quality score is selected. Full resolution detection then only runs
+    once, with the selected set.
+
+    Decisions are kept per roll and, with cache_file, saved as JSON so that later runs
+    reuse them without scoring again. Delete the roll entry or the file to select again.
+    """
+    def __init__(self,
+                 template_bank,
+                 cache_file = None,
+                 n_samples = 3,
+                 downsample = 4,
+                 buffer_distance = 250,
+                 min_score = 0.5,
+                 verbose = True):
+        if not isinstance(template_bank, TemplateBank):
+            template_bank = TemplateBank(template_bank)
+        self.template_bank   = template_bank
+        self.cache_file      = cache_file
+        self.n_samples       = n_samples
+        self.downsample      = downsample
+        self.buffer_distance = buffer_distance
+        self.min_score       = min_score
+        self.verbose         = verbose
+        self.decisions       = {}
+        self._lock           = threading.Lock()
+
+        if cache_file and os.path.exists(cache_file):
+            with open(cache_file) as f:
+                self.decisions = json.load(f)
+
+    def sample_frames(self, image_files):
+        """
+        Returns n_samples image files evenly spaced through the roll.
+        """
+        image_files = sorted([pathlib.Path(i).as_posix() for i in image_files])
+        if len(image_files) <= self.n_samples:
+            return image_files
+        index = np.linspace(0, len(image_files) - 1, self.n_samples).round().astype(int)
+        return [image_files[i] for i in index]
+
+    def scores(self, image_files):
+        """
+        Returns dictionary of template directory -> score on sample frames of image_files.
+        """
+        image_arrays = [hipp.qc.read_frame_thumbnail(i, decimation = self.downsample)
+                        for i in self.sample_frames(image_files)]
+        return {t: self.template_bank.score(t,
+                                            image_arrays,
+                                            downsample = self.downsample,
+                                            buffer_distance = self.buffer_distance)
+                for t in self.template_bank.template_sets()}
+
+    def select(self, roll, image_files):
+        """
+        Returns the template directory selected for roll, or None if no template set scored
+        at least min_score.
+        """
+        with self._lock:
+            if roll in self.decisions:
+                return self.decisions[roll]['template_directory']
+
+        scores = self.scores(image_files)
+        valid = {t: s for t, s in scores.items() if not np.isnan(s)}
+        template_dir = None
+        if valid:
+            best = max(valid, key=valid.get)
+            if valid[best] >= self.min_score:
+                template_dir = best
+        if self.verbose:
+            print('Selected template set', template_dir, 'for roll', roll)
+
+        with self._lock:
+            self.decisions[roll] = {'template_directory': template_dir,
+                                    'scores': {t: (None if np.isnan(s) else s) for t, s in scores.items()},
+                                    'sample_frames': self.sample_frames(image_files),
+                                    'downsample': self.downsample}
+            self.save()
+        return template_dir
+
+    def save(self):
+        if not self.cache_file:
+            return
+        directory = os.path.dirname(self.cache_file)
+        if directory:
+            pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.decisions, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.cache_file)
+
+    def for_roll(self, roll, image_files):
+        """
+        Returns templates selected for roll, or None.
+        """
+        template_dir = self.select(roll, image_files)
+        if template_dir:
+            return self.template_bank.get(template_dir)
+
+
+class FrameDetections:
+    """
+    Array-backed detection results for a set of frames.
+    
+    Holds k detected positions per frame as a float32 array of shape (N, k, 2) in y,x,
+    float32 quality scores of shape (N, k), the file names and integer roll codes into 
+    roll_names. Positions that were not detected or were rejected are np.nan.
+    
+    Converts to and from the DataFrames returned by hipp.core.iter_detect_fiducial_proxies()
+    (one tuple column per detection) and hipp.core.split_position_tuples() 
+    (one _y and _x column per position). The split DataFrame shares memory with the 
+    positions array.
+    """
+    def __init__(self,
+                 file_names,
+                 locations,
+                 scores = None,
+                 rolls = None,
+                 keys = ['left','top','right','bottom']):
+        self.file_names = np.asarray(file_names, dtype=object)
+        self.locations  = np.asarray(locations, dtype=np.float32)
+        if self.locations.ndim != 3:
+            self.locations = self.locations.reshape(len(self.file_names), -1, 2)
+        self.keys       = list(keys)[:self.locations.shape[1]]
+        
+        if scores is None:
+            scores = np.full(self.locations.shape[:2], np.nan)
+        self.scores = np.asarray(scores, dtype=np.float32).reshape(self.locations.shape[:2])
+        
+        if rolls is None:
+            rolls = hipp.core.roll_from_file_names(self.file_names)
+        codes, roll_names = pd.factorize(np.asarray(rolls))
+        self.roll_codes = codes.astype(np.int32)
+        self.roll_names = np.asarray(roll_names, dtype=object)
+        
+        self._index = None
+    
+    def __len__(self):
+        return len(self.file_names)
+    
+    def __getitem__(self, selection):
+        """
+        Returns FrameDetections for a boolean mask, index array or slice of frames.
+        """
+        if isinstance(selection, (int, np.integer)):
+            selection = [selection]
+        return hipp.core.FrameDetections(self.file_names[selection],
+                                         self.locations[selection],
+                                         self.scores[selection],
+                                         self.roll_names[self.roll_codes[selection]],
+                                         self.keys)
+    
+    @property
+    def rolls(self):
+        return self.roll_names[self.roll_codes]
+    
+    def index(self, file_name):
+        """
+        Returns the row of a file name.
+        """
+        if self._index is None:
+            self._index = {f: i for i, f in enumerate(self.file_names)}
+        return self._index[file_name]
+    
+    def roll(self, roll):
+        """
+        Returns FrameDetections for a single roll.
+        """
+        return self[self.rolls == roll]
+    
+    def iter_rolls(self):
+        """
+        Yields roll name and FrameDetections for each roll.
+        """
+        for code, roll in enumerate(self.roll_names):
+            yield roll, self[self.roll_codes == code]
+    
+    @classmethod
+    def from_dataframe(cls,
+                       df,
+                       locations = 'match_locations',
+                       scores = 'scores',
+                       file_names = 'file_names',
+                       keys = ['left','top','right','bottom']):
+        """
+        Creates FrameDetections from a DataFrame with a list of position tuples and scores 
+        per frame, as returned by hipp.core.iter_detect_fiducial_proxies().
+        """
+        try:
+            positions = np.array(df[locations].tolist(), dtype=np.float32)
+        except (TypeError, ValueError):
+            # positions that were not detected
+            positions = np.array([[(np.nan, np.nan) if p is None else p for p in frame] 
+                                  for frame in df[locations].values], dtype=np.float32)
+        frame_scores = None
+        if scores in df:
+            frame_scores = np.array(df[scores].tolist(), dtype=np.float32)
+        return cls(df[file_names].values,
+                   positions,
+                   frame_scores,
+                   keys = keys)
+    
+    @classmethod
+    def from_split_dataframe(cls,
+                             df,
+                             keys = ['left','top','right','bottom'],
+                             file_names = 'file_names'):
+        """
+        Creates FrameDetections from a DataFrame with _y and _x columns per position, 
+        as returned by hipp.core.split_position_tuples() or 
+        hipp.core.nan_offset_fiducial_proxies().
+        """
+        columns = [key + suffix for key in keys for suffix in ['_y', '_x']]
+        return cls(df[file_names].values,
+                   df[columns].to_numpy(dtype=np.float32),
+                   keys = keys)
+    
+    def to_dataframe(self):
+        """
+        Returns DataFrame with columns match_locations, scores and file_names, as returned 
+        by hipp.core.iter_detect_fiducial_proxies().
+        """
+        locations = self.locations.astype(float).tolist()
+        return pd.DataFrame({'match_locations': [[tuple(p) for p in frame] for frame in locations],
+                             'scores':          self.scores.astype(float).tolist(),
+                             'file_names':      self.file_names})
+    
+    def to_split_dataframe(self):
+        """
+        Returns DataFrame with a file_names column and _y and _x columns per position, 
+        as returned by hipp.core.split_position_tuples(). The position columns are a view 
+        of the positions array.
+        """
+        columns = [key + suffix for key in self.keys for suffix in ['_y', '_x']]
+        df = pd.DataFrame(self.locations.reshape(len(self), -1),
+                          columns = columns,
+                          copy = False)
+        df.insert(0, 'file_names', self.file_names)
+        return df
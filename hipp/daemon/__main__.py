@@ -0,0 +1,49 @@
+import argparse
+
+import hipp.daemon
+
+"""
+Command line interface to run hipp.daemon.WatchFolderDaemon.
+
+    python -m hipp.daemon input_data/raw_images input_data/fiducials -o input_data/cropped_images
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description='Watch a directory and preprocess new images with fiducial marker proxies.')
+    parser.add_argument('input_directory',
+                        help='directory receiving raw images')
+    parser.add_argument('template_directory',
+                        help='fiducial marker proxy templates, or template library with --EE_find_matching_template')
+    parser.add_argument('-o', '--output_directory', default='input_data/cropped_images')
+    parser.add_argument('--extension', default='.tif')
+    parser.add_argument('--EE_find_matching_template', action='store_true')
+    parser.add_argument('--buffer_distance', type=int, default=250)
+    parser.add_argument('--threshold_px', type=int, default=50)
+    parser.add_argument('--missing_proxy', default=None, choices=['left', 'top', 'right', 'bottom'])
+    parser.add_argument('--image_square_dim', type=int, default=None)
+    parser.add_argument('--min_samples', type=int, default=5)
+    parser.add_argument('--poll_interval', type=float, default=1)
+    parser.add_argument('--max_workers', type=int, default=None)
+    parser.add_argument('--log_file', default=None,
+                        help='csv file to append processed images and crop parameters to')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args()
+    
+    daemon = hipp.daemon.WatchFolderDaemon(args.input_directory,
+                                           args.template_directory,
+                                           output_directory = args.output_directory,
+                                           image_files_extension = args.extension,
+                                           EE_find_matching_template = args.EE_find_matching_template,
+                                           buffer_distance = args.buffer_distance,
+                                           threshold_px = args.threshold_px,
+                                           missing_proxy = args.missing_proxy,
+                                           image_square_dim = args.image_square_dim,
+                                           min_samples = args.min_samples,
+                                           poll_interval = args.poll_interval,
+                                           max_workers = args.max_workers,
+                                           log_file = args.log_file,
+                                           verbose = not args.quiet)
+    daemon.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+import concurrent.futures
+import os
+import pandas as pd
+import pathlib
+import psutil
+import threading
+import time
+
+import hipp.core
+
+"""
+Library for long running processes that preprocess images as they arrive.
+"""
+
+class WatchFolderDaemon:
+    """
+    Watches an input directory and preprocesses each new image with fiducial marker proxies.
+    
+    Templates and the worker pool are kept in memory for the lifetime of the daemon.
+    Each new image is detected and cropped as soon as it is completely written, using the 
+    roll statistics accumulated so far, see hipp.core.StreamingRollStatistics. Images that 
+    arrive before the statistics of their roll are stable are held back and cropped once 
+    they are. Parameters are not revised for images that were already cropped.
+    
+    With EE_find_matching_template, template_directory is a library with one sub directory
+    per roll, matched by roll name as in hipp.batch.preprocess_with_fiducial_proxies().
+    
+    Run from the command line with python -m hipp.daemon, or in python with
+    
+        daemon = hipp.daemon.WatchFolderDaemon('input_data/raw_images', 'input_data/fiducials')
+        daemon.run()
+    """
+    def __init__(self,
+                 input_directory,
+                 template_directory,
+                 output_directory = 'input_data/cropped_images',
+                 image_files_extension = '.tif',
+                 EE_find_matching_template = False,
+                 buffer_distance = 250,
+                 threshold_px = 50,
+                 missing_proxy = None,
+                 stretch_histogram = True,
+                 clahe_enhancement = True,
+                 image_square_dim = None,
+                 min_samples = 5,
+                 tolerance_px = 2,
+                 poll_interval = 1,
+                 max_workers = None,
+                 log_file = None,
+                 verbose = True):
+        
+        self.input_directory           = input_directory
+        self.output_directory          = output_directory
+        self.image_files_extension     = image_files_extension
+        self.EE_find_matching_template = EE_find_matching_template
+        self.buffer_distance           = buffer_distance
+        self.threshold_px              = threshold_px
+        self.missing_proxy             = missing_proxy
+        self.stretch_histogram         = stretch_histogram
+        self.clahe_enhancement         = clahe_enhancement
+        self.image_square_dim          = image_square_dim
+        self.min_samples               = min_samples
+        self.tolerance_px              = tolerance_px
+        self.poll_interval             = poll_interval
+        self.log_file                  = log_file
+        self.verbose                   = verbose
+        
+        if not max_workers:
+            max_workers = max(psutil.cpu_count(logical=True)-1, 1)
+        
+        pathlib.Path(output_directory).mkdir(parents=True, exist_ok=True)
+        
+        self.template_bank = hipp.core.TemplateBank(template_directory)
+        self.pool          = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.statistics    = {}
+        self.results       = []
+        self.failed        = {}
+        
+        self._sizes     = {}
+        self._submitted = set()
+        self._arrival   = {}
+        self._held      = {}
+        self._pending   = 0
+        self._lock      = threading.RLock()
+        
+        if not EE_find_matching_template:
+            # fail early on a bad template directory
+            self.template_bank.get()
+    
+    def roll(self, image_file):
+        if self.EE_find_matching_template:
+            return pathlib.Path(image_file).stem[:-4]
+    
+    def templates(self, roll):
+        if self.EE_find_matching_template:
+            return self.template_bank.for_roll(roll)
+        return self.template_bank.get()
+    
+    def poll(self):
+        """
+        Submits images that completed writing since the last poll. 
+        
+        An image is considered complete once its size did not change between two polls.
+        Returns list of submitted image files.
+        """
+        submitted = []
+        image_files = sorted(pathlib.Path(self.input_directory).glob('*'+self.image_files_extension))
+        for image_file in image_files:
+            image_file = image_file.as_posix()
+            if image_file in self._submitted:
+                continue
+            try:
+                size = os.path.getsize(image_file)
+            except OSError:
+                continue
+            if size > 0 and self._sizes.get(image_file) == size:
+                self._submitted.add(image_file)
+                self._arrival[image_file] = time.time()
+                self._submit_detection(image_file)
+                submitted.append(image_file)
+            self._sizes[image_file] = size
+        return submitted
+    
+    def run(self, 
+            stop_event = None,
+            timeout = None):
+        """
+        Polls the input directory until interrupted, stop_event is set or timeout seconds passed.
+        """
+        print('Watching', self.input_directory, 'for new images.')
+        start = time.time()
+        try:
+            while not (stop_event and stop_event.is_set()):
+                self.poll()
+                if timeout and time.time() - start > timeout:
+                    break
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print('Stopping.')
+        finally:
+            self.shutdown()
+        return self.results_df()
+    
+    def shutdown(self):
+        """
+        Waits for submitted images, crops images still held back and stops the worker pool.
+        """
+        self.wait()
+        with self._lock:
+            for roll in list(self._held):
+                self._release(roll, require_stable=False)
+        self.wait()
+        self.pool.shutdown()
+    
+    def wait(self):
+        while True:
+            with self._lock:
+                if self._pending == 0:
+                    return
+            time.sleep(0.05)
+    
+    def results_df(self):
+        return pd.DataFrame(self.results, columns=['file_name',
+                                                   'roll',
+                                                   'principal_point',
+                                                   'image_square_dim',
+                                                   'output_file',
+                                                   'latency_s'])
+    
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
+    
+    def _fail(self, image_file, reason):
+        with self._lock:
+            self.failed[image_file] = reason
+        print('WARNING: Processing failed for', image_file, '-', reason)
+    
+    def _submit_detection(self, image_file):
+        roll = self.roll(image_file)
+        try:
+            templates = self.templates(roll)
+        except Exception as e:
+            self._fail(image_file, repr(e))
+            return
+        if templates is None:
+            self._fail(image_file, 'No matching templates found for roll '+str(roll))
+            return
+        with self._lock:
+            self._pending += 1
+        future = self.pool.submit(hipp.core.detect_fiducial_proxies,
+                                  image_file,
+                                  templates,
+                                  buffer_distance = self.buffer_distance)
+        future.add_done_callback(lambda f, i=image_file: self._detected(f, i))
+    
+    def _detected(self, future, image_file):
+        try:
+            detection = future.result()
+        except Exception as e:
+            self._fail(image_file, repr(e))
+            self._done()
+            return
+        
+        roll = self.roll(image_file)
+        with self._lock:
+            if roll not in self.statistics:
+                self.statistics[roll] = hipp.core.StreamingRollStatistics(threshold_px = self.threshold_px,
+                                                                          missing_proxy = self.missing_proxy,
+                                                                          min_samples = self.min_samples,
+                                                                          tolerance_px = self.tolerance_px)
+            self.statistics[roll].add(detection)
+            self._held.setdefault(roll, []).append(image_file)
+            self._release(roll)
+        self._done()
+    
+    def _release(self, roll, require_stable=True):
+        # expects self._lock to be held
+        held = []
+        for image_file in self._held.get(roll, []):
+            crop_parameters = self.statistics[roll].crop_parameters(image_file,
+                                                                    require_stable = require_stable)
+            if not crop_parameters:
+                held.append(image_file)
+                continue
+            principal_point, image_square_dim = crop_parameters
+            image_square_dim = self.image_square_dim or image_square_dim
+            self._pending += 1
+            future = self.pool.submit(hipp.core.crop_image_from_file,
+                                      (image_file, principal_point),
+                                      image_square_dim,
+                                      output_directory = self.output_directory,
+                                      buffer_distance = self.buffer_distance,
+                                      stretch_histogram = self.stretch_histogram,
+                                      clahe_enhancement = self.clahe_enhancement)
+            future.add_done_callback(lambda f, i=image_file, r=roll, p=principal_point, d=image_square_dim: 
+                                     self._cropped(f, i, r, p, d))
+        
+        if held and not require_stable:
+            for image_file in held:
+                self._fail(image_file, 'Unable to estimate principal point')
+            held = []
+        self._held[roll] = held
+    
+    def _cropped(self, future, image_file, roll, principal_point, image_square_dim):
+        try:
+            out = future.result()
+        except Exception as e:
+            self._fail(image_file, repr(e))
+            self._done()
+            return
+        
+        latency = time.time() - self._arrival[image_file]
+        result = (image_file, roll, principal_point, image_square_dim, out, latency)
+        with self._lock:
+            self.results.append(result)
+            if self.log_file:
+                pd.DataFrame([result], columns=self.results_df().columns).to_csv(self.log_file,
+                                                                                 mode='a',
+                                                                                 index=False,
+                                                                                 header=not os.path.exists(self.log_file))
+        if self.verbose:
+            print(out, 'in', str(round(latency, 2)), 's')
+        self._done()
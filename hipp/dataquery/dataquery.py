@@ -1,6 +1,8 @@
+import collections
 import cv2
 import concurrent
 import glob
+import hashlib
 import json
 import os
 import pathlib
@@ -9,12 +11,17 @@ import pandas as pd
 import psutil
 import requests
 import sys
+import threading
 import time
-import urllib
+import zlib
 import shutil
+import sqlite3
+import urllib.parse
 from tqdm import tqdm
 
+import hipp.image
 import hipp.io
+import hipp.qc
 import hipp.utils
 
 
@@ -24,30 +31,523 @@ Library query and download historical image data from public archives.
 
 ### GENERIC FUNCTIONS
 
+class DownloadError(IOError):
+    """
+    Raised when a download is incomplete or does not match the expected size or checksum.
+    """
+
+class DecompressionError(DownloadError):
+    """
+    Raised when data downloaded with decompress is not a valid gzip stream. Not retried.
+    """
+
+class ConcurrencyController:
+    """
+    Adapts the number of concurrent downloads to maximise aggregate throughput, AIMD style.
+    
+    Every interval seconds, while more transfers are waiting than the limit allows, the 
+    limit is increased by one as long as aggregate throughput improves by more than 
+    tolerance. Once it stops improving, the limit steps back by one and is held for 
+    hold_intervals before probing again. Throttling responses (429, 503) and connection 
+    errors multiply the limit by decrease right away, at most once per interval.
+    
+    Transfers to one host are limited to host_limits[host], or per_host_limit, and the 
+    aggregate rate to max_bandwidth bytes per second.
+    
+        controller = hipp.dataquery.ConcurrencyController(max_limit = 16, max_bandwidth = 50e6)
+        hipp.dataquery.thread_downloads(output_directory, urls, file_names, controller = controller)
+    """
+    throttle_status_codes = [429, 503]
+    
+    def __init__(self,
+                 initial_limit  = 2,
+                 min_limit      = 1,
+                 max_limit      = 16,
+                 per_host_limit = None,
+                 host_limits    = None,
+                 max_bandwidth  = None,
+                 interval       = 2,
+                 tolerance      = 0.05,
+                 decrease       = 0.5,
+                 hold_intervals = 5,
+                 verbose        = False):
+        self.limit          = initial_limit
+        self.min_limit      = min_limit
+        self.max_limit      = max_limit
+        self.per_host_limit = per_host_limit
+        self.host_limits    = host_limits or {}
+        self.max_bandwidth  = max_bandwidth
+        self.interval       = interval
+        self.tolerance      = tolerance
+        self.decrease       = decrease
+        self.hold_intervals = hold_intervals
+        self.verbose        = verbose
+        
+        self.active      = 0
+        self.waiting     = 0
+        self.host_active = collections.Counter()
+        self.total_bytes = 0
+        self.connection_rates = collections.deque(maxlen = 100)
+        self.history     = []
+        
+        self._condition    = threading.Condition()
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_congestion = 0
+        self._window_demand = 0
+        self._last_rate    = None
+        self._last_change  = 0
+        self._hold         = 0
+        self._next_send    = time.monotonic()
+        self._last_decrease = -np.inf
+    
+    def _host_limit(self, host):
+        return self.host_limits.get(host, self.per_host_limit)
+    
+    def acquire(self, url):
+        """
+        Waits for a free slot for url and returns its host, to be passed to release().
+        """
+        host = urllib.parse.urlparse(url).netloc
+        host_limit = self._host_limit(host)
+        with self._condition:
+            self.waiting += 1
+            self._window_demand = max(self._window_demand, self.active + self.waiting)
+            while self.active >= self.limit or (host_limit and self.host_active[host] >= host_limit):
+                self._condition.wait(timeout = self.interval)
+                self._update()
+            self.waiting -= 1
+            self.active += 1
+            self.host_active[host] += 1
+        return host
+    
+    def release(self, 
+                host, 
+                nbytes = 0, 
+                elapsed = None, 
+                congestion = False):
+        """
+        Releases the slot of a transfer of nbytes in elapsed seconds. congestion indicates 
+        the transfer was throttled or the connection failed.
+        """
+        with self._condition:
+            self.active -= 1
+            self.host_active[host] -= 1
+            if nbytes and elapsed:
+                self.connection_rates.append(nbytes / elapsed)
+            if congestion:
+                self._window_congestion += 1
+                if time.monotonic() - self._last_decrease >= self.interval:
+                    self._decrease()
+            self._update()
+            self._condition.notify_all()
+    
+    def transferred(self, nbytes):
+        """
+        Records nbytes received and waits as needed to stay below max_bandwidth.
+        """
+        wait_time = 0
+        with self._condition:
+            self.total_bytes += nbytes
+            self._window_bytes += nbytes
+            self._update()
+            if self.max_bandwidth:
+                now = time.monotonic()
+                self._next_send = max(self._next_send, now) + nbytes / self.max_bandwidth
+                wait_time = self._next_send - now
+        if wait_time > 0:
+            time.sleep(wait_time)
+    
+    def _set_limit(self, limit, rate = None):
+        if self.verbose and limit != self.limit:
+            print('Download concurrency', self.limit, '->', limit, 
+                  'at', round(rate / 1e6, 2) if rate is not None else '-', 'MB/s')
+        if limit > self.limit:
+            self._condition.notify_all()
+        self.limit = limit
+        self.history.append((time.monotonic(), limit, rate))
+    
+    def _decrease(self):
+        self._set_limit(max(self.min_limit, int(self.limit * self.decrease)))
+        self._last_change   = -1
+        self._hold          = self.hold_intervals
+        self._last_decrease = time.monotonic()
+    
+    def _update(self):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return
+        
+        rate = self._window_bytes / elapsed
+        limit = self.limit
+        if self._window_congestion:
+            # decreased when the congestion was reported
+            self._last_change = 0
+        elif self._hold:
+            self._hold -= 1
+            self._last_change = 0
+        elif self._window_demand > self.limit:
+            if self._last_change > 0 and rate <= self._last_rate * (1 + self.tolerance):
+                limit = max(self.min_limit, self.limit - 1)
+                self._last_change = -1
+                self._hold = self.hold_intervals
+            elif self.limit < self.max_limit:
+                limit = self.limit + 1
+                self._last_change = 1
+            else:
+                self._last_change = 0
+        else:
+            self._last_change = 0
+        self._set_limit(limit, rate)
+        
+        self._last_rate         = rate
+        self._window_start      = now
+        self._window_bytes      = 0
+        self._window_congestion = 0
+        self._window_demand     = self.active + self.waiting
+    
+    def stats(self):
+        """
+        Returns the current limit, the aggregate rate of the last interval and the median 
+        rate of recent transfers, in bytes per second.
+        """
+        with self._condition:
+            return {'limit'           : self.limit,
+                    'active'          : self.active,
+                    'total_bytes'     : self.total_bytes,
+                    'rate'            : self._last_rate,
+                    'connection_rate' : np.median(self.connection_rates) if self.connection_rates else None}
+
+class DownloadEngine:
+    """
+    Downloads files over a pool of HTTP keep-alive connections shared between threads.
+    
+    Data is streamed to <output_file>.part and renamed to output_file once complete and 
+    verified, so output_file is never left truncated. If the connection drops, the download 
+    is retried with exponential backoff and resumed from the end of the .part file with an 
+    HTTP Range request. Servers that ignore Range requests are downloaded from the start.
+    
+    The size is verified against expected_size or the size reported by the server, and the 
+    checksum, e.g. an md5 hex digest, against checksum as the data streams in.
+    
+    With decompress, gzip compressed data is decompressed as it streams in and only the
+    decompressed file is written. Size and checksum then refer to the compressed data and
+    interrupted downloads restart from the beginning, as the decompressor state is lost.
+    Data that is not gzip compressed raises DecompressionError without retrying.
+    
+    With a hipp.dataquery.ConcurrencyController, each attempt waits for a slot and reports 
+    its throughput and throttling, see ConcurrencyController.
+    
+        engine = hipp.dataquery.DownloadEngine(max_workers = 5)
+        engine.download(url, 'input_data/image.tif', checksum = md5)
+    """
+    def __init__(self,
+                 max_workers = 5,
+                 timeout = 60,
+                 retries = 5,
+                 backoff = 1,
+                 max_backoff = 60,
+                 chunk_size = 256*1024,
+                 overwrite = False,
+                 controller = None):
+        self.timeout     = timeout
+        self.retries     = retries
+        self.backoff     = backoff
+        self.max_backoff = max_backoff
+        self.chunk_size  = chunk_size
+        self.overwrite   = overwrite
+        self.controller  = controller
+        self._local      = threading.local()
+        
+        if controller:
+            max_workers = max(max_workers, controller.max_limit)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = max_workers,
+                                                pool_maxsize = max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    
+    def download(self,
+                 url,
+                 output_file,
+                 expected_size = None,
+                 checksum = None,
+                 checksum_algorithm = 'md5',
+                 decompress = False):
+        """
+        Downloads url to output_file and returns output_file.
+        
+        Existing output files are kept unless overwrite is set. Raises DownloadError or 
+        requests.exceptions.RequestException once all retries failed. Client errors, 
+        except 408 and 429, are not retried.
+        """
+        if os.path.exists(output_file) and not self.overwrite:
+            return output_file
+        
+        for attempt in range(self.retries + 1):
+            host = self.controller.acquire(url) if self.controller else None
+            self._local.received = 0
+            start = time.monotonic()
+            congestion = False
+            try:
+                return self._download(url,
+                                      output_file,
+                                      expected_size = expected_size,
+                                      checksum = checksum,
+                                      checksum_algorithm = checksum_algorithm,
+                                      decompress = decompress)
+            except (requests.exceptions.RequestException, DownloadError) as e:
+                status_code = getattr(getattr(e, 'response', None), 'status_code', None)
+                congestion = status_code in ConcurrencyController.throttle_status_codes or \
+                             isinstance(e, (requests.exceptions.ConnectionError,
+                                            requests.exceptions.ChunkedEncodingError,
+                                            requests.exceptions.Timeout))
+                if status_code and 400 <= status_code < 500 and status_code not in [408, 429]:
+                    raise
+                if isinstance(e, DecompressionError):
+                    raise
+                if attempt == self.retries:
+                    raise
+                wait_time = min(self.backoff * 2**attempt, self.max_backoff)
+                print('WARNING: Download of', url, 'failed -', e)
+                print('Retry', str(attempt+1)+'/'+str(self.retries), 'in', wait_time, 'seconds.')
+            finally:
+                if self.controller:
+                    self.controller.release(host,
+                                            self._local.received,
+                                            time.monotonic() - start,
+                                            congestion = congestion)
+            time.sleep(wait_time)
+    
+    def _download(self,
+                  url,
+                  output_file,
+                  expected_size = None,
+                  checksum = None,
+                  checksum_algorithm = 'md5',
+                  decompress = False):
+        part_file = output_file + '.part'
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        
+        decompressor = None
+        if decompress:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            offset = 0
+        
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=' + str(offset) + '-'
+        
+        with self.session.get(url, headers = headers, stream = True, timeout = self.timeout) as r:
+            if r.status_code == 416:
+                # part file is not a prefix of the file on the server
+                os.remove(part_file)
+                raise DownloadError('Partial download of ' + url + ' is invalid, restarting.')
+            r.raise_for_status()
+            
+            if offset and r.status_code != 206:
+                offset = 0
+            total_size = expected_size
+            if not total_size:
+                if r.status_code == 206 and '/' in r.headers.get('Content-Range', ''):
+                    total_size = r.headers['Content-Range'].split('/')[-1]
+                elif 'Content-Length' in r.headers:
+                    total_size = r.headers['Content-Length']
+                total_size = int(total_size) if total_size and total_size != '*' else None
+            
+            hasher = None
+            if checksum:
+                hasher = hashlib.new(checksum_algorithm)
+                if offset:
+                    with open(part_file, 'rb') as f:
+                        for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                            hasher.update(chunk)
+            
+            size = offset
+            try:
+                with open(part_file, 'ab' if offset else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size = self.chunk_size):
+                        size += len(chunk)
+                        self._local.received += len(chunk)
+                        if self.controller:
+                            self.controller.transferred(len(chunk))
+                        if hasher:
+                            hasher.update(chunk)
+                        if decompressor:
+                            try:
+                                data = decompressor.decompress(chunk)
+                                # gzip files may hold several members, decompressed in turn
+                                while decompressor.eof and decompressor.unused_data:
+                                    unused_data = decompressor.unused_data
+                                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                                    data += decompressor.decompress(unused_data)
+                                chunk = data
+                            except zlib.error as e:
+                                raise DecompressionError('Unable to decompress ' + url + ' - ' + str(e))
+                        f.write(chunk)
+                    if decompressor:
+                        f.write(decompressor.flush())
+            except DecompressionError:
+                os.remove(part_file)
+                raise
+        
+        if total_size and size < total_size:
+            raise DownloadError('Incomplete download of ' + url + ', received ' + 
+                                str(size) + ' of ' + str(total_size) + ' bytes.')
+        if total_size and size > total_size:
+            os.remove(part_file)
+            raise DownloadError('Download of ' + url + ' is larger than ' + str(total_size) + ' bytes.')
+        if hasher and hasher.hexdigest().lower() != checksum.lower():
+            os.remove(part_file)
+            raise DownloadError('Checksum mismatch for ' + url + '.')
+        if decompressor and not decompressor.eof:
+            raise DownloadError('Incomplete gzip stream from ' + url + '.')
+        
+        os.replace(part_file, output_file)
+        return output_file
+
 def download_image(output_directory, 
                    payload,
-                   default_img_ext = '.tif'):
+                   default_img_ext = '.tif',
+                   engine = None,
+                   checksum = None,
+                   decompress = False):
     url, file_name = payload
     path_name, base_name, ext = hipp.io.split_file(os.path.abspath(file_name))
+    # only gzip compressed files are decompressed
+    decompress = decompress and (ext == '.gz' or urllib.parse.urlparse(url).path.endswith('.gz'))
+    if decompress and ext == '.gz':
+        path_name, base_name, ext = hipp.io.split_file(os.path.join(path_name, base_name))
     if ext == '':
         output_file = os.path.join(output_directory, base_name + default_img_ext)
     else:
         output_file = os.path.join(output_directory, base_name + ext)
-    urllib.request.urlretrieve(url,output_file)
+    if engine is None:
+        engine = DownloadEngine(max_workers = 1)
+    engine.download(url, output_file, checksum = checksum, decompress = decompress)
     return output_file
 
-def thread_downloads(output_directory, urls, file_names, max_workers=5):
+def thread_downloads(output_directory, 
+                     urls, 
+                     file_names, 
+                     max_workers = 5,
+                     checksums = None,
+                     engine = None,
+                     decompress = False,
+                     controller = None):
+    """
+    Downloads urls to file_names in output_directory with a shared hipp.dataquery.DownloadEngine.
+    
+    checksums are optional md5 hex digests, one per url. Downloads that fail after all 
+    retries are reported and skipped. Returns list of downloaded files.
+    
+    With decompress, .gz files are decompressed while downloading, in parallel across
+    files, and written without the .gz suffix. Other files are downloaded as they are.
+    
+    With a hipp.dataquery.ConcurrencyController, the number of concurrent downloads adapts
+    between its min_limit and max_limit instead of being fixed at max_workers. A controller
+    is used through the engine, if one is given.
+    """
+    if engine is None:
+        engine = DownloadEngine(max_workers = max_workers, controller = controller)
+    if engine.controller:
+        # threads wait on the controller for a slot
+        max_workers = engine.controller.max_limit
+    if checksums is None:
+        checksums = [None] * len(urls)
+    
+    results = []
     with tqdm(total=len(urls)) as pbar:
         pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
-        future_to_url = {pool.submit(download_image,
-                                     output_directory,
-                                     x): x for x in zip(urls, file_names)}
-        results=[]
+        future_to_url = {}
+        for url, file_name, checksum in zip(urls, file_names, checksums):
+            future = pool.submit(download_image,
+                                 output_directory,
+                                 (url, file_name),
+                                 engine = engine,
+                                 checksum = checksum,
+                                 decompress = decompress)
+            future_to_url[future] = url
         for future in concurrent.futures.as_completed(future_to_url):
-            r = future.result()
-            results.append(r)
+            try:
+                results.append(future.result())
+            except (requests.exceptions.RequestException, DownloadError) as e:
+                print('WARNING: Download failed for', future_to_url[future], '-', e)
             pbar.update(1)
-#             print('Download complete for:',r)
+        pool.shutdown()
+    return results
+
+def hash_browse_image(url, 
+                      timeout = 60):
+    """
+    Downloads a low resolution browse image and returns its perceptual hash, 
+    see hipp.image.perceptual_hash(). Returns None if the download or decoding failed.
+    """
+    try:
+        r = requests.get(url, timeout = timeout)
+        r.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print('WARNING: Unable to download browse image', url, '-', e)
+        return None
+    image_array = cv2.imdecode(np.frombuffer(r.content, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image_array is None:
+        return None
+    return hipp.image.perceptual_hash(image_array)
+
+def flag_duplicate_browse_images(urls,
+                                 keys,
+                                 duplicate_index = None,
+                                 max_distance = 6,
+                                 max_workers = 5):
+    """
+    Flags near duplicate images from their browse images before downloading the full 
+    resolution scans, e.g. the same negative scanned under different entity IDs.
+    
+    keys identify the images, e.g. entityIds. Images are compared against each other 
+    in the given order and against those already in the hipp.qc.DuplicateIndex, 
+    if provided. Images that are not duplicates are added to the index.
+    
+    Returns DataFrame with columns key, phash, duplicate_of and distance. duplicate_of 
+    is None for unique images and images without browse image.
+    """
+    if duplicate_index is None:
+        duplicate_index = hipp.qc.DuplicateIndex(max_distance = max_distance)
+    
+    with tqdm(total=len(urls)) as pbar:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(hash_browse_image, url) for url in urls]
+            for future in concurrent.futures.as_completed(futures):
+                pbar.update(1)
+    
+    rows = []
+    for key, future in zip(keys, futures):
+        image_hash = future.result()
+        duplicate_of, distance = None, None
+        if image_hash is not None:
+            matches = duplicate_index.add(key, image_hash)
+            if matches:
+                duplicate_of, distance = matches[0]
+            image_hash = '{:016x}'.format(image_hash)
+        rows.append([key, image_hash, duplicate_of, distance])
+    
+    df = pd.DataFrame(rows, columns = ['key', 'phash', 'duplicate_of', 'distance'])
+    n = df['duplicate_of'].notna().sum()
+    if n:
+        print(n, 'of', len(df), 'images are near duplicates.')
+    return df
+
+def EE_browse_urls(scenes):
+    """
+    Returns dictionary of entityId -> browse image url from scene-search results, 
+    for scenes with a browse image.
+    """
+    urls = {}
+    for scene in scenes:
+        browse = scene.get('browse') or []
+        if browse and browse[0].get('browsePath'):
+            urls[scene['entityId']] = browse[0]['browsePath']
+    return urls
 
 def EE_download_images_to_disk(
     apiKey,
@@ -61,7 +561,43 @@ def EE_download_images_to_disk(
     invert_color = False,
     overwrite = False,
     prime_for_download_later = False,
+    decompress_stream = False,
+    stream = False,
 ):
+    """
+    Stages and downloads images and calibration reports for entityIds from EarthExplorer.
+    
+    With decompress_stream, gzip compressed scans are decompressed while they download,
+    so the .tif.gz files are never written to disk.
+    
+    Image data is not rewritten after download. The TIFF origin is normalized in the tags 
+    and the original orientation, and inversion with invert_color, are recorded in an 
+    image manifest that is applied when reading with hipp.io.read_image().
+    
+    With stream, high resolution scans are downloaded as soon as each one is staged, 
+    instead of after the whole batch is staged, see EE_stream_downloads().
+    """
+    if stream and not prime_for_download_later:
+        images_directory              = os.path.join(output_directory, 
+                                                     images_directory_suffix)
+        calibration_reports_directory = os.path.join(output_directory,
+                                                     calibration_reports_directory_suffix) 
+        if not pathlib.Path(images_directory).is_dir() or overwrite:
+            print('Downloading high resolution images as they are staged with', max_workers, 'workers.') 
+            print('Temporary files written to', output_directory) 
+            files = EE_stream_downloads(apiKey, 
+                                        entityIds, 
+                                        output_directory = output_directory,
+                                        max_workers = max_workers,
+                                        decompress = decompress_stream)
+            if not files:
+                print("Something went wrong.",'\nNo images downloaded.')
+                return None, None, None
+            _EE_organize_downloads(output_directory,
+                                   images_directory,
+                                   calibration_reports_directory,
+                                   invert_color = invert_color)
+        return images_directory, calibration_reports_directory, 0.025
 
     urls = []
     filenames = []
@@ -129,117 +665,187 @@ def EE_download_images_to_disk(
                 output_directory, 
                 urls, 
                 filenames, 
-                max_workers=max_workers
+                max_workers=max_workers,
+                decompress=decompress_stream
             )                       
-
-            images = sorted(list(pathlib.Path(output_directory).glob('*tif*')))
-            print(len(images), 'images downloaded.')
-            if images[0].as_posix()[-7:] == '.tif.gz':
-                hipp.io.gzip_dir(output_directory)
-
-            hipp.io.move_files(output_directory, images_directory, '.tif')
-            hipp.io.move_files(output_directory, calibration_reports_directory, '.pdf')
-
-            print('Images in:', images_directory)
-            print('Calibration reports in:', calibration_reports_directory)
-
-            if invert_color:
-                print('Correcting origin for all images.')
-                print('Inverting color for all images.\n')
-            else:
-                print('Correcting origin for all images.\n')
-            def fix_grid_org(f):
-                im = cv2.imread(f)
-                if invert_color:
-                    im = np.max(im) - im
-                cv2.imwrite(f, im)
-
-            original_raw_tif_files = glob.glob(os.path.join(images_directory, '*.tif'))
-            with tqdm(total=len(urls)) as pbar:
-                pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
-                reorged_futures = {pool.submit(fix_grid_org, x): x for x in original_raw_tif_files}
-                for future in concurrent.futures.as_completed(reorged_futures):
-                    r = future.result()
-                    pbar.update(1)
+            _EE_organize_downloads(output_directory,
+                                   images_directory,
+                                   calibration_reports_directory,
+                                   invert_color = invert_color)
         return images_directory, calibration_reports_directory, pixel_pitch
 
     else:
         print("Something went wrong.",'\nNo images staged after 2 minutes.')
         return None, None, None
     
-def EE_convert_api_responses_to_dataframe(scenes):
-    # Reference: https://lta.cr.usgs.gov/DD/aerial_single_frame.html
-    # dictionary relating the field names used by the EE API
-    # to the HIPP/HSfM preferred column names
-    api_to_hsfm_field_name_dict = {
-        'Entity  ID':                       'entityId',
-        'Agency':                           'agency',
-        'Project':                          'project',
-        'Roll':                             'roll',
-        'Frame':                            'frame',
-        'Recording Technique':              'recordingTechnique',
-        'Acquisition Date':                 'acquisitionDate',
-        'High Resolution Download Avail':   'hi_res_available',
-        'Image Type':                       'imageType',
-        'Quality':                          'quality',
-        'Flying Height in Feet':            'altitudesFeet',
-        'Photo ID':                         'imageId',
-        'Focal Length':                     'focalLength',
-        'Center Latitude dec':              'centerLat',
-        'Center Longitude dec':             'centerLon',
-        'NW Corner Lat dec':                'NWlat',
-        'NW Corner Long dec':               'NWlon',
-        'NE Corner Lat dec':                'NElat',
-        'NE Corner Long dec':               'NElon',
-        'SE Corner Lat dec':                'SElat',
-        'SE Corner Long dec':               'SElon',
-        'SW Corner Lat dec':                'SWlat',
-        'SW Corner Long dec':               'SWlon',
-    }
-
-    #Iterate over api results creating a dataframe for each and appending into one dataframe
-    scenes_df = pd.DataFrame()
-    for scene in scenes:
-        #This pandas work converts the tidy format of the API response to a column-organized dataframe
-        one_scene_df = pd.DataFrame(scene['metadata'])
-        one_scene_df = one_scene_df[one_scene_df.fieldName.isin(api_to_hsfm_field_name_dict.keys())]
-        one_scene_df = one_scene_df[['fieldName', 'value']].set_index(
-            'fieldName'
-            ).transpose().rename_axis(
-                None, 
-                axis = 1
-            ).reset_index(drop=True)
-        scenes_df = pd.concat([scenes_df, one_scene_df])
-        scenes_df = scenes_df.reset_index(drop=True)
+def _EE_organize_downloads(output_directory,
+                           images_directory,
+                           calibration_reports_directory,
+                           invert_color = False):
+    images = sorted(list(pathlib.Path(output_directory).glob('*tif*')))
+    print(len(images), 'images downloaded.')
+    if images and images[0].as_posix()[-7:] == '.tif.gz':
+        hipp.io.gzip_dir(output_directory)
+
+    hipp.io.move_files(output_directory, images_directory, '.tif')
+    hipp.io.move_files(output_directory, calibration_reports_directory, '.pdf')
+
+    print('Images in:', images_directory)
+    print('Calibration reports in:', calibration_reports_directory)
+
+    if invert_color:
+        print('Correcting origin for all images.')
+        print('Inverting color for all images when read.\n')
+    else:
+        print('Correcting origin for all images.\n')
+    
+    # Only the TIFF orientation tag is rewritten. Orientation and polarity are recorded
+    # in the image manifest and applied by hipp.io.read_image().
+    manifest = {}
+    original_raw_tif_files = sorted(glob.glob(os.path.join(images_directory, '*.tif')))
+    for f in tqdm(original_raw_tif_files):
+        manifest[os.path.basename(f)] = {'orientation' : hipp.io.normalize_tiff_origin(f),
+                                         'invert'      : invert_color}
+    hipp.io.write_image_manifest(images_directory, manifest)
+
+# Reference: https://lta.cr.usgs.gov/DD/aerial_single_frame.html
+# dictionary relating the field names used by the EE API
+# to the HIPP/HSfM preferred column names
+EE_api_to_hsfm_field_name_dict = {
+    'Entity  ID':                       'entityId',
+    'Agency':                           'agency',
+    'Project':                          'project',
+    'Roll':                             'roll',
+    'Frame':                            'frame',
+    'Recording Technique':              'recordingTechnique',
+    'Acquisition Date':                 'acquisitionDate',
+    'High Resolution Download Avail':   'hi_res_available',
+    'Image Type':                       'imageType',
+    'Quality':                          'quality',
+    'Flying Height in Feet':            'altitudesFeet',
+    'Photo ID':                         'imageId',
+    'Focal Length':                     'focalLength',
+    'Center Latitude dec':              'centerLat',
+    'Center Longitude dec':             'centerLon',
+    'NW Corner Lat dec':                'NWlat',
+    'NW Corner Long dec':               'NWlon',
+    'NE Corner Lat dec':                'NElat',
+    'NE Corner Long dec':               'NElon',
+    'SE Corner Lat dec':                'SElat',
+    'SE Corner Long dec':               'SElon',
+    'SW Corner Lat dec':                'SWlat',
+    'SW Corner Long dec':               'SWlon',
+}
 
+# numeric HIPP/HSfM columns
+EE_hsfm_convert_dict = {
+    'altitudesFeet': float,
+    'focalLength': float,
+    'centerLat': float,
+    'centerLon': float,
+    'NWlat': float,
+    'NWlon': float,
+    'NElat': float,
+    'NElon': float,
+    'SElat': float,
+    'SElon': float,
+    'SWlat': float,
+    'SWlon': float
+}
+
+def EE_convert_api_responses_to_dataframe(scenes,
+                                          parquet_file = None,
+                                          batch_size = 10000):
+    """
+    Converts scene-search results with full metadata to a DataFrame with one row per scene
+    and the HIPP/HSfM column names, see EE_api_to_hsfm_field_name_dict.
+    
+    Mapped metadata fields are collected per column in a single pass over the scenes.
+    Columns appear in the order the fields are first found, fields missing from a scene 
+    are NaN.
+    
+    With parquet_file, scenes, which may be any iterable such as a generator over result 
+    pages, are converted in batches of batch_size and written to parquet_file as they are 
+    converted, without keeping all scenes in memory. Object columns are stored as strings.
+    Returns parquet_file in that case.
+    """
+    if parquet_file:
+        return EE_write_scenes_parquet(scenes, parquet_file, batch_size = batch_size)
+    
+    scenes = list(scenes)
+    n = len(scenes)
+    columns = {}
+    for i, scene in enumerate(scenes):
+        for field in scene['metadata']:
+            column = columns.get(field['fieldName'])
+            if column is None:
+                if field['fieldName'] not in EE_api_to_hsfm_field_name_dict:
+                    continue
+                column = columns[field['fieldName']] = [np.nan] * n
+            column[i] = field['value']
+    
     #Rename column names to the HIPP/HSfM preferred column names
-    scenes_df = scenes_df.rename(api_to_hsfm_field_name_dict, axis=1)
+    scenes_df = pd.DataFrame({EE_api_to_hsfm_field_name_dict[k] : v for k, v in columns.items()},
+                             index = pd.RangeIndex(n),
+                             dtype = object)
     #Clean up the combined dataframe
 
     #get rid of the mm part of the "focalLength" column and make it a float
-    scenes_df['focalLength'] = scenes_df['focalLength'].apply(lambda s: s.split(' ')[0])
+    if 'focalLength' in scenes_df:
+        scenes_df['focalLength'] = scenes_df['focalLength'].apply(lambda s: s.split(' ')[0])
 
     #Make numeric columns type float
-    convert_dict = {
-        'altitudesFeet': float,
-        'focalLength': float,
-        'centerLat': float,
-        'centerLon': float,
-        'NWlat': float,
-        'NWlon': float,
-        'NElat': float,
-        'NElon': float,
-        'SElat': float,
-        'SElon': float,
-        'SWlat': float,
-        'SWlon': float
-    }
-    
-    scenes_df = scenes_df.astype(convert_dict)
-
-    scenes_df = scenes_df.reset_index(drop=True)
+    scenes_df = scenes_df.astype({k : v for k, v in EE_hsfm_convert_dict.items() if k in scenes_df})
 
     return scenes_df
+
+def EE_write_scenes_parquet(scenes,
+                            parquet_file,
+                            batch_size = 10000):
+    """
+    Converts scene-search results in batches of batch_size scenes, see 
+    EE_convert_api_responses_to_dataframe(), and writes each batch to parquet_file as a 
+    row group. The file has a column for every field in EE_api_to_hsfm_field_name_dict,
+    stored as float64 for the numeric columns in EE_hsfm_convert_dict and as strings 
+    otherwise, so fields missing from some batches are kept. Returns parquet_file.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    pathlib.Path(parquet_file).parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = str(parquet_file) + '.tmp'
+    schema = pa.schema([(c, pa.float64() if c in EE_hsfm_convert_dict else pa.string())
+                        for c in EE_api_to_hsfm_field_name_dict.values()])
+    writer = None
+    try:
+        for batch in _batches(scenes, batch_size):
+            scenes_df = EE_convert_api_responses_to_dataframe(batch)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_file, schema)
+            scenes_df = scenes_df.reindex(columns = schema.names)
+            for c in schema.names:
+                if schema.field(c).type == pa.string():
+                    scenes_df[c] = [v if v is None or isinstance(v, str) or v != v else str(v) 
+                                    for v in scenes_df[c]]
+            writer.write_table(pa.Table.from_pandas(scenes_df, schema = schema, preserve_index = False))
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        print('No scenes to write.')
+        return None
+    os.replace(tmp_file, parquet_file)
+    return parquet_file
+
+def _batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
     
 def EE_login(username,
              password,
@@ -259,7 +865,10 @@ def EE_pre_select_images(apiKey,
                    metadataType = 'full', #'summary', None
                    maxResults   = 2,
                    datasetName  = 'aerial_combin',
-                   serviceUrl   = 'https://m2m.cr.usgs.gov/api/api/json/stable/'):
+                   serviceUrl   = 'https://m2m.cr.usgs.gov/api/api/json/stable/',
+                   complete     = False,
+                   max_workers  = 5,
+                   cache        = None):
     """
     Example inputs:
     xmin       = -114.5
@@ -268,29 +877,329 @@ def EE_pre_select_images(apiKey,
     ymax       = 49.2
     start_date = '1966-01-01'
     end_date   = '1966-12-10'     
+    
+    With complete, all scenes are returned regardless of maxResults, see EE_search_scenes().
+    
+    With cache, a hipp.dataquery.SceneSearchCache, results are read from and stored in the 
+    cache, including sub-regions of previously searched bounds and time ranges.
     """
-    print('Max records requested:',maxResults)
+    if not complete:
+        print('Max records requested:',maxResults)
     print('Bounds:\n  xmin', xmin,'\n  ymin', ymin,'\n  xmax',xmax,'\n  ymax',ymax)
     print('Time range:', startDate,'to', endDate)
     
+    query = (xmin,ymin,xmax,ymax,startDate,endDate)
+    if complete:
+        maxResults = None
+    results = None
+    if cache:
+        results = cache.get(*query,
+                            metadataType = metadataType,
+                            datasetName  = datasetName,
+                            maxResults   = maxResults)
+        if results is not None:
+            print('Records read from cache:', cache.cache_file)
+    
+    if results is None and complete:
+        results, search_complete = EE_search_scenes(apiKey,
+                                                    *query,
+                                                    metadataType    = metadataType,
+                                                    datasetName     = datasetName,
+                                                    max_workers     = max_workers,
+                                                    return_complete = True,
+                                                    serviceUrl      = serviceUrl)
+        if cache:
+            cache.put(results, *query,
+                      metadataType = metadataType,
+                      datasetName  = datasetName,
+                      complete     = search_complete)
+    
+    elif results is None:
+        datasetSearchParameters = EE_scene_search_payload(*query,
+                                                          metadataType = metadataType,
+                                                          maxResults   = maxResults,
+                                                          datasetName  = datasetName)
+        scenes = EE_request(apiKey, "scene-search", datasetSearchParameters, serviceUrl)
+        results = scenes['results']
+        if cache:
+            cache.put(results, *query,
+                      metadataType = metadataType,
+                      datasetName  = datasetName,
+                      maxResults   = maxResults,
+                      complete     = scenes['recordsReturned'] < maxResults or \
+                                     scenes.get('totalHits') == scenes['recordsReturned'])
+    
+    print('Records returned:', len(results))
+    if len(results) == maxResults:
+        print("maxResults set to:", maxResults, 
+              'Increase this parameter to obtain additional records. API max 50,000.')
+    
+    results_df = EE_convert_api_responses_to_dataframe(results)
+    return results_df
+
+def EE_scene_search_payload(xmin,ymin,xmax,ymax,
+                            startDate,endDate,
+                            metadataType = 'full',
+                            maxResults   = 2,
+                            datasetName  = 'aerial_combin',
+                            startingNumber = None):
     spatialFilter =  {'filterType' : "mbr",
                       'lowerLeft'  : {'latitude' : ymin, 'longitude' : xmax},
                       'upperRight' : {'latitude' : ymax, 'longitude' : xmin}}
     acquisitionFilter = {'start' : startDate, 'end' : endDate}
-    datasetSearchParameters = {'datasetName' : datasetName,
-                               'maxResults' : maxResults,
-                               'sceneFilter' : {'spatialFilter'     : spatialFilter,
-                                                'acquisitionFilter' : acquisitionFilter},
-                               'metadataType': metadataType}
-    scenes = EE_sendRequest(serviceUrl + "scene-search", datasetSearchParameters, apiKey)
-    print('Records returned:', scenes['recordsReturned'])
-    if scenes['recordsReturned'] == maxResults:
-        print("maxResults set to:", maxResults, 
-              'Increase this parameter to obtain additional records. API max 50,000.')
+    payload = {'datasetName' : datasetName,
+               'maxResults' : maxResults,
+               'sceneFilter' : {'spatialFilter'     : spatialFilter,
+                                'acquisitionFilter' : acquisitionFilter},
+               'metadataType': metadataType}
+    if startingNumber:
+        payload['startingNumber'] = startingNumber
+    return payload
+
+def EE_search_scenes(apiKey,
+                     xmin,ymin,xmax,ymax,
+                     startDate,endDate,
+                     metadataType  = 'full',
+                     datasetName   = 'aerial_combin',
+                     max_results   = 50000,
+                     page_size     = 10000,
+                     min_tile_size = 0.01,
+                     max_workers   = 5,
+                     return_complete = False,
+                     serviceUrl    = 'https://m2m.cr.usgs.gov/api/api/json/stable/'):
+    """
+    Returns all scenes matching the bounds and time range, beyond the scene-search limit
+    of max_results records per query.
     
-    results_df = EE_convert_api_responses_to_dataframe(scenes['results'])
-    return results_df
+    Results are fetched in pages of page_size records with startingNumber. Where a query 
+    matches more than max_results scenes, the bounds are split into quadrants, or the 
+    time range in half once tiles are smaller than min_tile_size degrees, and each part 
+    is searched recursively. Pages and tiles are requested concurrently with max_workers.
+    Scenes found in more than one tile are returned once, sorted by entityId.
+    
+    apiKey is an API key or a hipp.dataquery.M2MClient, which pools connections.
+    
+    Tiles with more than max_results scenes that can not be split further are truncated.
+    With return_complete, also returns whether no tile was truncated.
+    """
+    def search(tile, startingNumber):
+        payload = EE_scene_search_payload(*tile,
+                                          metadataType = metadataType,
+                                          maxResults   = min(page_size, max_results - startingNumber + 1),
+                                          datasetName  = datasetName,
+                                          startingNumber = startingNumber)
+        return EE_request(apiKey, 'scene-search', payload, serviceUrl)
+    
+    scenes = {}
+    complete = True
+    tile = (xmin,ymin,xmax,ymax,startDate,endDate)
+    with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as pool:
+        pending = {pool.submit(search, tile, 1) : (tile, 1)}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                tile, startingNumber = pending.pop(future)
+                result = future.result()
+                for scene in result['results']:
+                    scenes.setdefault(scene['entityId'], scene)
+                if startingNumber != 1:
+                    continue
+                
+                total = result['totalHits']
+                tiles = None
+                if total > max_results:
+                    tiles = _split_search_tile(tile, min_tile_size)
+                    if not tiles:
+                        complete = False
+                        print('WARNING: More than', max_results, 'scenes in', tile, 
+                              'which can not be split further. Results are incomplete.')
+                if tiles:
+                    for t in tiles:
+                        pending[pool.submit(search, t, 1)] = (t, 1)
+                else:
+                    for n in range(1 + page_size, min(total, max_results) + 1, page_size):
+                        pending[pool.submit(search, tile, n)] = (tile, n)
     
+    scenes = [scenes[k] for k in sorted(scenes)]
+    if return_complete:
+        return scenes, complete
+    return scenes
+
+def _split_search_tile(tile, min_tile_size):
+    """
+    Splits a search tile into spatial quadrants, or in time once smaller than min_tile_size.
+    Returns None if the tile can not be split.
+    """
+    xmin,ymin,xmax,ymax,startDate,endDate = tile
+    if xmax - xmin > min_tile_size or ymax - ymin > min_tile_size:
+        x, y = (xmin + xmax) / 2, (ymin + ymax) / 2
+        return [(xmin,ymin,x,y,startDate,endDate),
+                (x,ymin,xmax,y,startDate,endDate),
+                (xmin,y,x,ymax,startDate,endDate),
+                (x,y,xmax,ymax,startDate,endDate)]
+    start, end = pd.Timestamp(startDate), pd.Timestamp(endDate)
+    if end > start:
+        middle = start + (end - start) / 2
+        middle = middle.floor('D')
+        return [(xmin,ymin,xmax,ymax,startDate,middle.strftime('%Y-%m-%d')),
+                (xmin,ymin,xmax,ymax,(middle + pd.Timedelta(days=1)).strftime('%Y-%m-%d'),endDate)]
+    
+class SceneSearchCache:
+    """
+    Local SQLite cache of scene-search results, keyed by dataset, metadataType, bounds 
+    and time range. Entries expire after ttl seconds.
+    
+    A query is answered from the most recent cached query with the same key, or from a 
+    complete cached query enclosing its bounds and time range, by filtering the cached 
+    scenes by their footprint and acquisition date locally.
+    """
+    def __init__(self,
+                 cache_file = 'input_data/scene_search_cache.sqlite',
+                 ttl        = 7*24*3600):
+        self.cache_file = cache_file
+        self.ttl        = ttl
+        directory = os.path.dirname(cache_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS queries (
+                                  id INTEGER PRIMARY KEY, datasetName TEXT, metadataType TEXT,
+                                  xmin REAL, ymin REAL, xmax REAL, ymax REAL,
+                                  startDate TEXT, endDate TEXT, 
+                                  maxResults INTEGER, complete INTEGER, created REAL)""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS scenes (
+                                  query_id INTEGER, position INTEGER, entityId TEXT,
+                                  xmin REAL, ymin REAL, xmax REAL, ymax REAL,
+                                  startDate TEXT, endDate TEXT, scene TEXT)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS scenes_query ON scenes (query_id, position)")
+    
+    def _connect(self):
+        # used as a context manager the connection commits or rolls back a transaction
+        return sqlite3.connect(self.cache_file, timeout = 60)
+    
+    def get(self,
+            xmin,ymin,xmax,ymax,
+            startDate,endDate,
+            metadataType = 'full',
+            datasetName  = 'aerial_combin',
+            maxResults   = None):
+        """
+        Returns the cached scenes for a query, or None. Without maxResults, only complete
+        cached queries are used.
+        """
+        xmin, xmax = sorted([xmin, xmax])
+        ymin, ymax = sorted([ymin, ymax])
+        with self._connect() as connection:
+            query = connection.execute("""SELECT id FROM queries 
+                                          WHERE datasetName = ? AND metadataType IS ? AND created > ?
+                                          AND complete = 1
+                                          AND xmin <= ? AND ymin <= ? AND xmax >= ? AND ymax >= ?
+                                          AND startDate <= ? AND endDate >= ?
+                                          ORDER BY created DESC LIMIT 1""",
+                                       (datasetName, metadataType, time.time() - self.ttl,
+                                        xmin, ymin, xmax, ymax, startDate, endDate)).fetchone()
+            if query:
+                rows = connection.execute("""SELECT scene FROM scenes 
+                                             WHERE query_id = ?
+                                             AND (xmin IS NULL OR 
+                                                  (xmax >= ? AND ymax >= ? AND xmin <= ? AND ymin <= ?))
+                                             AND (startDate IS NULL OR 
+                                                  (endDate >= ? AND startDate <= ?))
+                                             ORDER BY position""",
+                                          (query[0], xmin, ymin, xmax, ymax, 
+                                           startDate, endDate)).fetchall()
+                scenes = [json.loads(row[0]) for row in rows]
+                return scenes[:maxResults] if maxResults else scenes
+            
+            if not maxResults:
+                return None
+            query = connection.execute("""SELECT id FROM queries 
+                                          WHERE datasetName = ? AND metadataType IS ? AND created > ?
+                                          AND maxResults = ?
+                                          AND xmin = ? AND ymin = ? AND xmax = ? AND ymax = ?
+                                          AND startDate = ? AND endDate = ?
+                                          ORDER BY created DESC LIMIT 1""",
+                                       (datasetName, metadataType, time.time() - self.ttl, maxResults,
+                                        xmin, ymin, xmax, ymax, startDate, endDate)).fetchone()
+            if query:
+                rows = connection.execute("SELECT scene FROM scenes WHERE query_id = ? ORDER BY position",
+                                          (query[0],)).fetchall()
+                return [json.loads(row[0]) for row in rows]
+    
+    def put(self,
+            scenes,
+            xmin,ymin,xmax,ymax,
+            startDate,endDate,
+            metadataType = 'full',
+            datasetName  = 'aerial_combin',
+            maxResults   = None,
+            complete     = True):
+        """
+        Stores the scenes returned for a query. complete indicates the scenes are all 
+        scenes matching the query, not limited by maxResults.
+        """
+        xmin, xmax = sorted([xmin, xmax])
+        ymin, ymax = sorted([ymin, ymax])
+        with self._connect() as connection:
+            connection.execute("DELETE FROM scenes WHERE query_id IN (SELECT id FROM queries WHERE created <= ?)",
+                               (time.time() - self.ttl,))
+            connection.execute("DELETE FROM queries WHERE created <= ?", (time.time() - self.ttl,))
+            query_id = connection.execute("""INSERT INTO queries (datasetName, metadataType, 
+                                             xmin, ymin, xmax, ymax, startDate, endDate, 
+                                             maxResults, complete, created)
+                                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                          (datasetName, metadataType, xmin, ymin, xmax, ymax,
+                                           startDate, endDate, maxResults, int(bool(complete)),
+                                           time.time())).lastrowid
+            connection.executemany("INSERT INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   [(query_id, i, scene['entityId']) + \
+                                    _scene_footprint(scene) + \
+                                    _scene_dates(scene) + \
+                                    (json.dumps(scene),) for i, scene in enumerate(scenes)])
+
+def _scene_metadata(scene, field_names):
+    values = {}
+    for field in scene.get('metadata') or []:
+        if field['fieldName'] in field_names:
+            values[field['fieldName']] = field['value']
+    return values
+
+def _scene_footprint(scene):
+    """
+    Returns the bounds (xmin, ymin, xmax, ymax) of a scene from its spatialBounds, or 
+    from the corner and center coordinates in its metadata. Unknown bounds are NaN.
+    """
+    coordinates = []
+    bounds = scene.get('spatialBounds') or scene.get('spatialCoverage')
+    if bounds:
+        coordinates = np.array(bounds['coordinates'], dtype=float).reshape(-1, 2)
+    else:
+        fields = [('NW Corner Long dec', 'NW Corner Lat dec'),
+                  ('NE Corner Long dec', 'NE Corner Lat dec'),
+                  ('SE Corner Long dec', 'SE Corner Lat dec'),
+                  ('SW Corner Long dec', 'SW Corner Lat dec'),
+                  ('Center Longitude dec', 'Center Latitude dec')]
+        values = _scene_metadata(scene, [f for pair in fields for f in pair])
+        coordinates = [(float(values[x]), float(values[y])) for x, y in fields 
+                       if values.get(x) and values.get(y)]
+        coordinates = np.array(coordinates, dtype=float).reshape(-1, 2)
+    if not len(coordinates):
+        # stored as NULL, such scenes are returned for any sub-region
+        return (np.nan,) * 4
+    return tuple(float(v) for v in np.concatenate([coordinates.min(axis=0), coordinates.max(axis=0)]))
+
+def _scene_dates(scene):
+    """
+    Returns the (start, end) acquisition dates of a scene as YYYY-MM-DD.
+    """
+    temporal = scene.get('temporalCoverage')
+    if temporal:
+        return str(temporal['startDate'])[:10], str(temporal['endDate'])[:10]
+    date = _scene_metadata(scene, ['Acquisition Date']).get('Acquisition Date')
+    if date:
+        date = str(date).replace('/', '-')[:10]
+    return date, date
+
 def EE_sendRequest(url, data, apiKey = None):  
     json_data = json.dumps(data)
     
@@ -326,6 +1235,223 @@ def EE_sendRequest(url, data, apiKey = None):
     
     return output['data']
 
+def EE_request(apiKey, 
+               endpoint, 
+               payload,
+               serviceUrl = 'https://m2m.cr.usgs.gov/api/api/json/stable/'):
+    """
+    Sends an M2M request with a hipp.dataquery.M2MClient, or with EE_sendRequest() if 
+    apiKey is an API key.
+    """
+    if isinstance(apiKey, M2MClient):
+        return apiKey.request(endpoint, payload)
+    return EE_sendRequest(serviceUrl + endpoint, payload, apiKey)
+
+
+class M2MError(Exception):
+    """
+    Raised for errors returned by the EarthExplorer M2M API.
+    """
+    def __init__(self, error_code, error_message = None):
+        super().__init__(str(error_code) + ' - ' + str(error_message))
+        self.error_code    = error_code
+        self.error_message = error_message
+
+class M2MClient:
+    """
+    Client for the EarthExplorer M2M API for long running batch jobs.
+    
+    Requests share a pooled HTTP session and time out after timeout seconds. Failed
+    connections, server errors and rate limits are retried with exponential backoff. 
+    Other errors raise hipp.dataquery.M2MError, instead of exiting.
+    
+    The API key is obtained on first use and cached for api_key_ttl seconds, in memory and 
+    in api_key_cache if given. With username and password, the client logs in again when 
+    the key expires or is rejected, or if api_key_cache can not be read.
+    
+    Large entityId lists are split into chunks of chunk_size requested concurrently, see 
+    download_options(). The client can be passed as apiKey to EE_download_images_to_disk(),
+    EE_stageForDownload() and EE_pre_select_images().
+    
+        client = hipp.dataquery.M2MClient(username, password)
+        options = client.download_options(entityIds)
+    """
+    auth_error_codes = ['AUTH_INVALID', 'AUTH_KEY_INVALID', 'AUTH_UNAUTHROIZED', 'AUTH_UNAUTHORIZED']
+    retry_error_codes = ['RATE_LIMIT', 'RATE_LIMIT_USER_DL', 'UNKNOWN']
+    
+    def __init__(self,
+                 username = None,
+                 password = None,
+                 api_key = None,
+                 serviceUrl = 'https://m2m.cr.usgs.gov/api/api/json/stable/',
+                 api_key_cache = None,
+                 api_key_ttl = 7000,
+                 timeout = 60,
+                 retries = 5,
+                 backoff = 1,
+                 max_backoff = 60,
+                 max_workers = 5,
+                 chunk_size = 500):
+        self.username      = username
+        self.password      = password
+        self.serviceUrl    = serviceUrl
+        self.api_key_cache = api_key_cache
+        self.api_key_ttl   = api_key_ttl
+        self.timeout       = timeout
+        self.retries       = retries
+        self.backoff       = backoff
+        self.max_backoff   = max_backoff
+        self.max_workers   = max_workers
+        self.chunk_size    = chunk_size
+        
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = max_workers,
+                                                pool_maxsize = max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+        # held while logging in, so that concurrent requests wait for one login
+        self._lock          = threading.RLock()
+        self._api_key       = api_key
+        self._api_key_time  = time.time() if api_key else None
+        
+        if not api_key and api_key_cache and os.path.exists(api_key_cache):
+            try:
+                with open(api_key_cache) as f:
+                    cached = json.load(f)
+                if cached.get('username') == username:
+                    self._api_key, self._api_key_time = cached['api_key'], cached['time']
+            except (ValueError, KeyError) as e:
+                print('WARNING: Ignoring invalid API key cache', api_key_cache, '-', repr(e))
+    
+    @property
+    def api_key(self):
+        """
+        Returns a valid API key, logging in if there is none or it expired.
+        """
+        with self._lock:
+            expired = self._api_key_time is None or time.time() - self._api_key_time > self.api_key_ttl
+            if self._api_key and not (expired and self.password):
+                return self._api_key
+            return self.login()
+    
+    def login(self):
+        """
+        Logs in with username and password and returns the new API key.
+        """
+        if not self.username or not self.password:
+            raise M2MError('AUTH_INVALID', 'API key expired or rejected and no credentials to log in again')
+        with self._lock:
+            api_key = self._post('login', {'username' : self.username, 'password' : self.password})
+            self._api_key      = api_key
+            self._api_key_time = time.time()
+            if self.api_key_cache:
+                cache_file = pathlib.Path(self.api_key_cache)
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                # created readable by the owner only, before the key is written
+                fd = os.open(cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                if hasattr(os, 'fchmod'):
+                    # existing cache files keep their mode on open
+                    os.fchmod(fd, 0o600)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'username' : self.username, 
+                               'api_key'  : api_key, 
+                               'time'     : self._api_key_time}, f)
+        return api_key
+    
+    def logout(self):
+        if self._api_key:
+            self._post('logout', None, self._api_key)
+        with self._lock:
+            self._api_key      = None
+            self._api_key_time = None
+    
+    def _post(self, endpoint, payload, api_key = None):
+        """
+        Posts payload to endpoint with retries and returns the data of the response.
+        """
+        headers = {}
+        if api_key:
+            headers['X-Auth-Token'] = api_key
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.serviceUrl + endpoint,
+                                             data = json.dumps(payload),
+                                             headers = headers,
+                                             timeout = self.timeout)
+            except (requests.exceptions.ConnectionError, 
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                error = e
+            else:
+                with response:
+                    if response.status_code == 429 or response.status_code >= 500:
+                        error = M2MError('HTTP_' + str(response.status_code), response.reason)
+                    else:
+                        try:
+                            output = response.json()
+                        except ValueError:
+                            response.raise_for_status()
+                            raise M2MError('INVALID_RESPONSE', response.text[:200])
+                        if output.get('errorCode') is None:
+                            response.raise_for_status()
+                            return output['data']
+                        error = M2MError(output['errorCode'], output.get('errorMessage'))
+                        if error.error_code not in self.retry_error_codes:
+                            raise error
+            if attempt == self.retries:
+                raise error
+            wait_time = min(self.backoff * 2**attempt, self.max_backoff)
+            print('WARNING: M2M', endpoint, 'request failed -', error)
+            print('Retry', str(attempt+1)+'/'+str(self.retries), 'in', wait_time, 'seconds.')
+            time.sleep(wait_time)
+    
+    def request(self, endpoint, payload):
+        """
+        Sends an authenticated request to endpoint and returns the data of the response.
+        
+        Logs in again once if the API key was rejected.
+        """
+        api_key = self.api_key
+        try:
+            return self._post(endpoint, payload, api_key)
+        except M2MError as e:
+            if e.error_code not in self.auth_error_codes or not self.password:
+                raise
+            with self._lock:
+                if self._api_key == api_key:
+                    print('API key rejected, logging in again.')
+                    api_key = self.login()
+                else:
+                    # another request logged in already
+                    api_key = self._api_key
+            return self._post(endpoint, payload, api_key)
+    
+    def request_chunks(self, endpoint, payload, key, values):
+        """
+        Sends one request per chunk of values, with the chunk as payload[key], concurrently. 
+        
+        Returns the concatenated lists returned per chunk, in order of values.
+        """
+        values = list(values)
+        chunks = [values[i:i + self.chunk_size] for i in range(0, len(values), self.chunk_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.max_workers) as pool:
+            futures = [pool.submit(self.request, endpoint, dict(payload, **{key : chunk})) 
+                       for chunk in chunks]
+            results = []
+            for future in futures:
+                results.extend(future.result() or [])
+        return results
+    
+    def download_options(self, entityIds, datasetName = 'aerial_combin'):
+        """
+        Returns download options for entityIds, requested in concurrent chunks.
+        """
+        return self.request_chunks('download-options', 
+                                   {'datasetName' : datasetName}, 
+                                   'entityIds', 
+                                   entityIds)
+
 def EE_stageForDownload(apiKey,
                         entityIds,
                         label        = 'test_download',
@@ -352,9 +1478,11 @@ def EE_stageForDownload(apiKey,
     ee_requests = []
     # download datasets
     
-    payload = {'datasetName' : datasetName, 'entityIds' : entityIds}
-                        
-    downloadOptions = EE_sendRequest(serviceUrl + "download-options", payload, apiKey)
+    if isinstance(apiKey, M2MClient):
+        downloadOptions = apiKey.download_options(entityIds, datasetName = datasetName)
+    else:
+        payload = {'datasetName' : datasetName, 'entityIds' : entityIds}
+        downloadOptions = EE_sendRequest(serviceUrl + "download-options", payload, apiKey)
 
     # Aggregate a list of available products
     downloads = []
@@ -373,13 +1501,13 @@ def EE_stageForDownload(apiKey,
         payload = {'downloads' : downloads,
                    'label' : label}
         # Call the download to get the direct download urls
-        requestResults = EE_sendRequest(serviceUrl + "download-request", payload, apiKey)          
+        requestResults = EE_request(apiKey, "download-request", payload, serviceUrl)          
                         
         # PreparingDownloads has a valid link that can be used but data may not be immediately available
         # Call the download-retrieve method to get download that is available for immediate download
         if requestResults['preparingDownloads'] != None and len(requestResults['preparingDownloads']) > 0:
             payload = {'label' : label}
-            moreDownloadUrls = EE_sendRequest(serviceUrl + "download-retrieve", payload, apiKey)
+            moreDownloadUrls = EE_request(apiKey, "download-retrieve", payload, serviceUrl)
             
             downloadIds = []  
             
@@ -397,7 +1525,7 @@ def EE_stageForDownload(apiKey,
                 preparingDownloads = requestedDownloadsCount - len(downloadIds)
                 print(preparingDownloads, "images are not staged. Retry in 30 seconds.\n")
                 time.sleep(30)
-                moreDownloadUrls = EE_sendRequest(serviceUrl + "download-retrieve", payload, apiKey)
+                moreDownloadUrls = EE_request(apiKey, "download-retrieve", payload, serviceUrl)
                 for download in moreDownloadUrls['available']:                            
                     if download['downloadId'] not in downloadIds:
                         downloadIds.append(download['downloadId'])
@@ -447,7 +1575,7 @@ def EE_stageForDownload(apiKey,
         filenames_cal = []
         for req in filtered_reqs_cal:
             if req['entityId'] in entityIds:
-                name = req['entityId'][:11] + '.pdf' #one per roll
+                name = EE_download_file_name(req) #one per roll
                 if name not in filenames_cal:
                     urls_cal.append(req['url'])
                     filenames_cal.append(name)
@@ -457,10 +1585,7 @@ def EE_stageForDownload(apiKey,
         filenames_hi = []
         for req in filtered_reqs_hi:
             if req['entityId'] in entityIds:
-                if 'NAG' in req['entityId']:
-                    name = req['entityId'] + '.tif' #NAGAP images aren't zipped
-                else:
-                    name = req['entityId'] + '.tif.gz'
+                name = EE_download_file_name(req)
                 urls_hi.append(req['url'])
                 filenames_hi.append(name)
             
@@ -468,7 +1593,7 @@ def EE_stageForDownload(apiKey,
         filenames_med = []
         for req in filtered_reqs_med:
             if req['entityId'] in entityIds:
-                name = req['entityId'] + '.tif'
+                name = EE_download_file_name(req)
                 urls_med.append(req['url'])
                 filenames_med.append(name)
         
@@ -483,6 +1608,124 @@ def EE_stageForDownload(apiKey,
         print("None available for download")
         return None, None, None, None, None, None
 
+def EE_download_file_name(download):
+    """
+    Returns the file name for an EE download, with one calibration report per roll.
+    """
+    if download['productName'] == 'Camera Calibration File':
+        return download['entityId'][:11] + '.pdf'
+    if download['productName'] == 'High Resolution Product' and 'NAG' not in download['entityId']:
+        return download['entityId'] + '.tif.gz'
+    # NAGAP images aren't zipped
+    return download['entityId'] + '.tif'
+
+def EE_stream_downloads(apiKey,
+                        entityIds,
+                        output_directory  = 'input_data',
+                        product_names     = ['Camera Calibration File', 'High Resolution Product'],
+                        label             = 'download-sample',
+                        datasetName       = 'aerial_combin',
+                        max_workers       = 5,
+                        decompress        = False,
+                        min_poll_interval = 5,
+                        max_poll_interval = 120,
+                        max_wait          = 3600,
+                        engine            = None,
+                        serviceUrl        = 'https://m2m.cr.usgs.gov/api/api/json/stable/'):
+    """
+    Stages products for entityIds and downloads each one as soon as it is available.
+    
+    Products already available are downloaded right away, while download-retrieve is 
+    polled for the products being prepared. The poll interval starts at min_poll_interval
+    seconds, is reset whenever new products became available and otherwise doubles up to 
+    max_poll_interval. Products not available after max_wait seconds are reported and skipped.
+    
+    Only products in product_names are requested. apiKey is an API key or a 
+    hipp.dataquery.M2MClient. Returns list of downloaded files.
+    
+    With decompress, gzip compressed image products are decompressed while downloading.
+    Calibration reports and other products are downloaded as they are.
+    """
+    if isinstance(apiKey, M2MClient):
+        downloadOptions = apiKey.download_options(entityIds, datasetName = datasetName)
+    else:
+        payload = {'datasetName' : datasetName, 'entityIds' : entityIds}
+        downloadOptions = EE_request(apiKey, 'download-options', payload, serviceUrl)
+    
+    downloads = [{'entityId' : product['entityId'], 'productId' : product['id']} 
+                 for product in downloadOptions 
+                 if product['available'] and product['productName'] in product_names]
+    if not downloads:
+        print("None available for download")
+        return []
+    
+    payload = {'downloads' : downloads, 'label' : label}
+    requestResults = EE_request(apiKey, 'download-request', payload, serviceUrl)
+    
+    if engine is None:
+        engine = DownloadEngine(max_workers = max_workers)
+    pathlib.Path(output_directory).mkdir(parents=True, exist_ok=True)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers = max_workers)
+    
+    requestedIds = set(entityIds)
+    downloadIds = set()
+    staged = set()
+    file_names = set()
+    futures = {}
+    def submit(download):
+        if download['downloadId'] in downloadIds:
+            return
+        downloadIds.add(download['downloadId'])
+        if download['entityId'] not in requestedIds or download['productName'] not in product_names:
+            return
+        staged.add(download['downloadId'])
+        name = EE_download_file_name(download)
+        if name in file_names:
+            return
+        file_names.add(name)
+        future = pool.submit(download_image,
+                             output_directory,
+                             (download['url'], name),
+                             engine = engine,
+                             decompress = decompress and name.endswith('.gz'))
+        futures[future] = download['url']
+    
+    try:
+        for download in requestResults['availableDownloads']:
+            submit(download)
+        print(len(futures), 'products available for download,', 
+              len(requestResults['preparingDownloads'] or []), 'being prepared.')
+    
+        poll_interval = min_poll_interval
+        start = time.time()
+        while requestResults['preparingDownloads'] and len(staged) < len(downloads):
+            if time.time() - start > max_wait:
+                print('WARNING:', len(downloads) - len(staged), 'products not staged after', 
+                      max_wait, 'seconds. Moving on.')
+                break
+            time.sleep(poll_interval)
+            moreDownloadUrls = EE_request(apiKey, 'download-retrieve', {'label' : label}, serviceUrl)
+            n = len(staged)
+            for download in moreDownloadUrls['available']:
+                submit(download)
+            if len(staged) > n:
+                poll_interval = min_poll_interval
+            else:
+                poll_interval = min(poll_interval * 2, max_poll_interval)
+    
+        results = []
+        with tqdm(total=len(futures)) as pbar:
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results.append(future.result())
+                except (requests.exceptions.RequestException, DownloadError) as e:
+                    print('WARNING: Download failed for', futures[future], '-', e)
+                pbar.update(1)
+    finally:
+        # after an error, queued downloads are cancelled and running ones complete
+        pool.shutdown(cancel_futures = True)
+    return results
+
 
 ## ARCTICDATA.IO
 
@@ -518,11 +1761,25 @@ def NAGAP_pre_select_images(image_metadata,
                             month=None,
                             day=None,
                             output_directory=None,
-                            verbose=True):
+                            verbose=True,
+                            polygon=None):
     """
     bounds = (ULLON, ULLAT, LRLON, LRLAT)
     year   = 77 # e.g. for year 1977
+    polygon = shapely Polygon or sequence of (lon, lat) vertices
+    
+    image_metadata may be a hipp.dataquery.NAGAPMetadataStore, which is queried instead.
     """
+    if isinstance(image_metadata, NAGAPMetadataStore):
+        return image_metadata.query(bounds = bounds,
+                                    polygon = polygon,
+                                    roll = roll,
+                                    year = year,
+                                    month = month,
+                                    day = day,
+                                    output_directory = output_directory,
+                                    verbose = verbose)
+    
     print("Selecting images based on:")   
     
     if not isinstance(image_metadata, type(pd.DataFrame())):
@@ -540,6 +1797,10 @@ def NAGAP_pre_select_images(image_metadata,
                 (df['Latitude']>bounds[3]) & 
                 (df['Latitude']<bounds[1])]
     
+    if not isinstance(polygon,type(None)):
+        print('polygon:', polygon)
+        df = df[_NAGAP_contains(polygon, df['Longitude'].values, df['Latitude'].values)]
+    
     if not isinstance(roll,type(None)):
         print('roll:', roll)
         df = df[df['Roll'] == roll]
@@ -558,6 +1819,9 @@ def NAGAP_pre_select_images(image_metadata,
         
     df = df.reset_index(drop=True)
     
+    return _NAGAP_report_selection(df, output_directory)
+
+def _NAGAP_report_selection(df, output_directory=None):
     if len(list(set(df['Roll'].values))) > 1:
         print('NOTE: Filter results contain multiple camera rolls:')
         for i in sorted(list(set(df['Roll'].values))):
@@ -580,4 +1844,147 @@ def NAGAP_pre_select_images(image_metadata,
     
     else:
         return df
+
+def _NAGAP_contains(polygon, lons, lats):
+    import shapely
+    if not isinstance(polygon, shapely.Geometry):
+        polygon = shapely.Polygon(polygon)
+    return shapely.contains_xy(polygon, lons, lats)
+
+class NAGAPMetadataStore:
+    """
+    Typed, grid indexed NAGAP image metadata, created once from the metadata CSV with
+    NAGAPMetadataStore.build() and queried with query(), which returns the same DataFrame
+    as NAGAP_pre_select_images().
+    
+    The store is a parquet file sorted by grid cells of grid_size degrees, with float
+    coordinates and categorical Roll, Year, Month and Day columns. Queries look up the 
+    grid cells overlapping the bounds or polygon and filter the remaining rows by their
+    categorical codes.
+    """
+    categorical_columns = ['Roll', 'Year', 'Month', 'Day']
+    
+    def __init__(self, store_file = 'input_data/nagap_image_metadata.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(store_file)
+        self.store_file = store_file
+        self.grid_size  = float(table.schema.metadata[b'hipp_grid_size'])
+        self.df         = table.to_pandas()
+        self.columns    = [c for c in self.df.columns if not c.startswith('_')]
+        self.lons       = self.df['Longitude'].to_numpy()
+        self.lats       = self.df['Latitude'].to_numpy()
+        
+        cells = self.df[['_cell_x', '_cell_y']].to_numpy()
+        boundaries = np.flatnonzero((np.diff(cells, axis=0) != 0).any(axis=1)) + 1
+        self.cell_starts = np.concatenate([[0], boundaries]).astype(int)[:len(cells)]
+        self.cell_stops  = np.concatenate([boundaries, [len(cells)]]).astype(int)[:len(cells)]
+        self.cells       = cells[self.cell_starts]
+    
+    @classmethod
+    def build(cls,
+              image_metadata,
+              store_file = 'input_data/nagap_image_metadata.parquet',
+              grid_size  = 0.1):
+        """
+        Converts the NAGAP metadata CSV, or DataFrame, to a store at store_file.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        if not isinstance(image_metadata, type(pd.DataFrame())):
+            df = pd.read_csv(image_metadata, dtype=object)
+        else:
+            df = image_metadata.copy()
+        
+        df['Longitude'] = df['Longitude'].astype(float)
+        df['Latitude'] = df['Latitude'].astype(float)
+        for column in cls.categorical_columns:
+            df[column] = df[column].astype('category')
+        
+        # rows without coordinates are sorted to a cell of their own, never queried by bounds
+        with np.errstate(invalid='ignore'):
+            df['_cell_x'] = np.nan_to_num(np.floor(df['Longitude'].values / grid_size),
+                                          nan=np.iinfo(np.int32).min).astype(np.int32)
+            df['_cell_y'] = np.nan_to_num(np.floor(df['Latitude'].values / grid_size),
+                                          nan=np.iinfo(np.int32).min).astype(np.int32)
+        df['_row'] = np.arange(len(df))
+        df = df.sort_values(['_cell_x', '_cell_y', '_row'], kind='stable').reset_index(drop=True)
+        
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'hipp_grid_size'] = str(grid_size).encode()
+        table = table.replace_schema_metadata(metadata)
+        
+        directory = os.path.dirname(store_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_file = store_file + '.tmp'
+        pq.write_table(table, tmp_file)
+        os.replace(tmp_file, store_file)
+        return cls(store_file)
+    
+    def _rows_in_bounds(self, xmin, ymin, xmax, ymax):
+        x0, x1 = np.floor(np.array([xmin, xmax]) / self.grid_size)
+        y0, y1 = np.floor(np.array([ymin, ymax]) / self.grid_size)
+        selected = (self.cells[:,0] >= x0) & (self.cells[:,0] <= x1) & \
+                   (self.cells[:,1] >= y0) & (self.cells[:,1] <= y1)
+        ranges = [np.arange(a, b) for a, b in zip(self.cell_starts[selected], self.cell_stops[selected])]
+        rows = np.concatenate(ranges) if ranges else np.array([], dtype=int)
+        lons, lats = self.lons[rows], self.lats[rows]
+        return rows[(lons > xmin) & (lons < xmax) & (lats > ymin) & (lats < ymax)]
+    
+    def _filter_category(self, rows, column, value):
+        categories = self.df[column].cat.categories
+        if value not in categories:
+            return rows[:0]
+        codes = self.df[column].cat.codes.to_numpy()
+        return rows[codes[rows] == categories.get_loc(value)]
+    
+    def query(self,
+              bounds=None,
+              polygon=None,
+              roll=None,
+              year=None,
+              month=None,
+              day=None,
+              output_directory=None,
+              verbose=True):
+        """
+        bounds = (ULLON, ULLAT, LRLON, LRLAT)
+        year   = 77 # e.g. for year 1977
+        polygon = shapely Polygon or sequence of (lon, lat) vertices
+        """
+        print("Selecting images based on:")
+        
+        rows = np.arange(len(self.df))
+        if not isinstance(bounds,type(None)):
+            print('bounds:', bounds)
+            rows = self._rows_in_bounds(bounds[0], bounds[3], bounds[2], bounds[1])
+        
+        if not isinstance(polygon,type(None)):
+            print('polygon:', polygon)
+            import shapely
+            if not isinstance(polygon, shapely.Geometry):
+                polygon = shapely.Polygon(polygon)
+            polygon_rows = self._rows_in_bounds(*polygon.bounds)
+            polygon_rows = polygon_rows[_NAGAP_contains(polygon, 
+                                                        self.lons[polygon_rows], 
+                                                        self.lats[polygon_rows])]
+            rows = np.intersect1d(rows, polygon_rows)
+        
+        filters = [('roll', 'Roll', roll, str),
+                   ('year', 'Year', year, str),
+                   ('month', 'Month', month, lambda v: str(v).zfill(2)),
+                   ('day', 'Day', day, lambda v: str(v).zfill(2))]
+        for name, column, value, to_category in filters:
+            if not isinstance(value,type(None)):
+                print(name + ':', value)
+                rows = self._filter_category(rows, column, to_category(value))
+        
+        rows = rows[np.argsort(self.df['_row'].to_numpy()[rows], kind='stable')]
+        df = self.df[self.columns].iloc[rows].reset_index(drop=True)
+        for column in df.columns:
+            if column not in ['Longitude', 'Latitude']:
+                df[column] = df[column].astype(object)
         
+        return _NAGAP_report_selection(df, output_directory)
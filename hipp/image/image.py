@@ -3,6 +3,10 @@ import cv2
 import numpy as np
 from skimage import exposure
 from skimage import transform as tf
+import threading
+
+import hipp.image
+import hipp.io
 
 """
 Library for image processing functions. 
@@ -60,11 +64,144 @@ def crop_about_point(image_array,
     return cropped_array
     
 def img_linear_stretch(img_gray,
-                       min_max = (0.1, 99.9)):
-    p_min, p_max = np.percentile(img_gray, min_max)
+                       min_max = (0.1, 99.9),
+                       statistics = None):
+    """
+    Stretches intensities between the min_max percentiles to the full range of the dtype.
+    
+    For 8 bit images the percentiles are derived from the histogram, which gives the same
+    result as np.percentile() without sorting the pixels. statistics of img_gray from 
+    hipp.image.compute_image_statistics() are used if provided.
+    """
+    if statistics is None and img_gray.dtype == np.uint8:
+        statistics = hipp.image.compute_image_statistics(img_gray)
+    if statistics is not None:
+        p_min, p_max = hipp.image.percentiles_from_histogram(statistics['histogram'], min_max)
+    else:
+        p_min, p_max = np.percentile(img_gray, min_max)
     img_rescale = exposure.rescale_intensity(img_gray, in_range=(p_min, p_max))
     return img_rescale
+
+def compute_image_statistics(image_array):
+    """
+    Computes the 256 bin histogram, minimum and maximum of an 8 bit image array.
+    Percentiles can be derived with hipp.image.percentiles_from_histogram().
+    """
+    histogram = cv2.calcHist([image_array], [0], None, [256], [0, 256]).ravel().astype(np.int64)
+    values = np.flatnonzero(histogram)
+    statistics = {'histogram' : histogram,
+                  'min'       : int(values[0])  if values.size else None,
+                  'max'       : int(values[-1]) if values.size else None}
+    return statistics
+
+_image_statistics = {}
+_image_statistics_lock = threading.Lock()
+_image_statistics_max_entries = 10000
+
+def read_image_statistics(image_file,
+                          image_array = None,
+                          sidecar = False,
+                          clahe_enhancement = False):
+    """
+    Returns hipp.image.compute_image_statistics() of an 8 bit image file.
+    
+    Statistics are computed once and cached in memory by file path, size and modification
+    time. Pass image_array if the image was already read. With sidecar, statistics are also 
+    written to <image_file>.stats.npz and reused by other processes while the image file 
+    is unchanged.
+    
+    With clahe_enhancement, the statistics are those of the image after 
+    hipp.image.clahe_equalize_image() with default parameters, as stretched for detection,
+    and image_array is the equalized image if given. These are cached separately, in 
+    <image_file>.clahe.stats.npz with sidecar.
+    """
+    stat = os.stat(image_file)
+    key = (os.path.abspath(image_file), stat.st_size, stat.st_mtime_ns, clahe_enhancement)
+    with _image_statistics_lock:
+        if key in _image_statistics:
+            return _image_statistics[key]
+    
+    sidecar_file = str(image_file) + ('.clahe.stats.npz' if clahe_enhancement else '.stats.npz')
+    statistics = None
+    if sidecar and os.path.exists(sidecar_file):
+        with np.load(sidecar_file) as f:
+            if tuple(int(v) for v in f['key']) == key[1:3]:
+                statistics = {'histogram' : f['histogram'],
+                              'min'       : int(f['min']),
+                              'max'       : int(f['max'])}
     
+    if statistics is None:
+        if image_array is None:
+            image_array = hipp.io.read_image(image_file)
+            if clahe_enhancement:
+                image_array = hipp.image.clahe_equalize_image(image_array)
+        statistics = hipp.image.compute_image_statistics(image_array)
+        if sidecar:
+            np.savez(sidecar_file,
+                     key       = np.array(key[1:3]),
+                     histogram = statistics['histogram'],
+                     min       = statistics['min'],
+                     max       = statistics['max'])
+    
+    with _image_statistics_lock:
+        _image_statistics[key] = statistics
+        if len(_image_statistics) > _image_statistics_max_entries:
+            # drop the oldest entry
+            del _image_statistics[next(iter(_image_statistics))]
+    return statistics
+
+def percentiles_from_histogram(histogram,
+                               q):
+    """
+    Computes percentiles of 8 bit pixel values from their histogram, equal to 
+    np.percentile() with linear interpolation on the pixels.
+    """
+    histogram = np.asarray(histogram)
+    q = np.true_divide(np.asanyarray(q, dtype=float), 100)
+    n = histogram.sum()
+    
+    # ranks in the sorted pixel values, as computed by np.percentile()
+    virtual_indexes  = (n - 1) * q
+    previous_indexes = np.floor(virtual_indexes)
+    next_indexes     = previous_indexes + 1
+    above_bounds = virtual_indexes >= n - 1
+    previous_indexes[above_bounds] = n - 1
+    next_indexes[above_bounds]     = n - 1
+    below_bounds = virtual_indexes < 0
+    previous_indexes[below_bounds] = 0
+    next_indexes[below_bounds]     = 0
+    gamma = virtual_indexes - np.where(above_bounds, -1, previous_indexes)
+    
+    cumulative = np.cumsum(histogram)
+    previous = np.searchsorted(cumulative, previous_indexes, side='right').astype(np.uint8)
+    next     = np.searchsorted(cumulative, next_indexes, side='right').astype(np.uint8)
+    
+    # linear interpolation as np.percentile()
+    difference = np.subtract(next, previous)
+    percentiles = np.add(previous, difference * gamma)
+    percentiles = np.where(gamma >= 0.5, np.subtract(next, difference * (1 - gamma)), percentiles)
+    return percentiles
+    
+def perceptual_hash(image_array,
+                    hash_size = 8):
+    """
+    Computes the DCT based perceptual hash of a grayscale image array. 
+    
+    The image is reduced to 4*hash_size pixels square and each of the hash_size**2 lowest
+    frequency DCT coefficients is compared to their median. Returns the bits as integer. 
+    Hashes of rescaled or recompressed copies of an image differ in few bits, see 
+    hipp.image.hamming_distance().
+    """
+    size = 4 * hash_size
+    resized = cv2.resize(image_array, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+    dct = cv2.dct(resized)[:hash_size, :hash_size].ravel()
+    # exclude the DC coefficient, which only reflects mean brightness
+    bits = dct > np.median(dct[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming_distance(hash_1, hash_2):
+    return bin(hash_1 ^ hash_2).count('1')
+
 def threshold_and_add_noise(image_array,
                             threshold=50):
     mask = image_array > threshold
@@ -1,11 +1,20 @@
+import cv2
 import glob
 import gzip
+import json
 import os
 import pathlib
 import shutil
+import struct
 from subprocess import Popen, PIPE, STDOUT
 from tqdm import tqdm
 import concurrent
+import datetime
+import numpy as np
+import pandas as pd
+import threading
+import uuid
+import warnings
 
 import hipp.io
 
@@ -15,8 +24,9 @@ Library interface with command line and file system.
 """
 
 def gunzip_dir(input_directory,
-               keep    = False,
-               verbose = False):
+               keep        = False,
+               verbose     = False,
+               max_workers = 10):
     print('gunzipping files in', input_directory)
     files = sorted(glob.glob(os.path.join(input_directory,'*.gz')))
     calls = []
@@ -28,7 +38,7 @@ def gunzip_dir(input_directory,
 #         hipp.io.run_command(call, verbose = verbose)
             
     with tqdm(total=len(calls)) as pbar:
-        pool = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
         futures = {pool.submit(hipp.io.run_command, x): x for x in calls}
         for future in concurrent.futures.as_completed(futures):
             r = future.result()
@@ -45,11 +55,12 @@ def gzip_file(fn):
         shutil.copyfileobj(f_in, f_out)
     
 def gzip_dir(input_directory,
-               keep    = False):
+               keep        = False,
+               max_workers = 10):
     print('gzipping files in', input_directory)
     files = sorted(glob.glob(os.path.join(input_directory,'*.gz')))
     with tqdm(total=len(files)) as pbar:
-        pool = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
         futures = {pool.submit(gzip_file, x): x for x in files}
         for future in concurrent.futures.as_completed(futures):
             r = future.result()
@@ -102,4 +113,321 @@ def run_command(command, verbose=False, log_directory=None, shell=False):
         while p.poll() is None:
             line = (p.stdout.readline()).decode('ASCII').rstrip('\n')
             if verbose == True:
-                print(line)
\ No newline at end of file
+                print(line)
+
+def _tiff_orientation_entry(f):
+    """
+    Returns byte order, file offset and value of the orientation tag in the first IFD of an
+    open TIFF file, or None if the file is not a TIFF or has no orientation tag.
+    """
+    header = f.read(16)
+    byte_order = {b'II': '<', b'MM': '>'}.get(header[:2])
+    if not byte_order:
+        return None
+    version = struct.unpack(byte_order + 'H', header[2:4])[0]
+    if version == 42:
+        ifd_offset = struct.unpack(byte_order + 'I', header[4:8])[0]
+        count_format, entry_format, entry_size = 'H', 'HHI', 12
+    elif version == 43:
+        ifd_offset = struct.unpack(byte_order + 'Q', header[8:16])[0]
+        count_format, entry_format, entry_size = 'Q', 'HHQ', 20
+    else:
+        return None
+    
+    f.seek(ifd_offset)
+    count_size = struct.calcsize(count_format)
+    n_entries = struct.unpack(byte_order + count_format, f.read(count_size))[0]
+    entries = f.read(n_entries * entry_size)
+    for i in range(n_entries):
+        entry = entries[i*entry_size:(i+1)*entry_size]
+        tag, tag_type, count = struct.unpack(byte_order + entry_format, entry[:entry_size//2 + 2])
+        if tag == 274 and tag_type == 3:
+            value_offset = ifd_offset + count_size + i*entry_size + entry_size//2 + 2
+            value = struct.unpack(byte_order + 'H', entry[entry_size//2 + 2:entry_size//2 + 4])[0]
+            return byte_order, value_offset, value
+
+def read_tiff_orientation(image_file):
+    """
+    Returns the TIFF orientation tag value of image_file, 1 (top left origin) if not set.
+    """
+    with open(image_file, 'rb') as f:
+        entry = _tiff_orientation_entry(f)
+    if entry:
+        return entry[2]
+    return 1
+
+def normalize_tiff_origin(image_file):
+    """
+    Sets the TIFF orientation tag of image_file to 1 (top left origin) in place, without
+    reading or rewriting the image data, so that all readers see the stored pixel grid.
+    
+    Returns the original orientation, to be applied when reading the image, see 
+    hipp.io.write_image_manifest() and hipp.io.read_image().
+    """
+    with open(image_file, 'r+b') as f:
+        entry = _tiff_orientation_entry(f)
+        if not entry or entry[2] == 1:
+            return 1
+        byte_order, value_offset, orientation = entry
+        f.seek(value_offset)
+        f.write(struct.pack(byte_order + 'H', 1))
+    return orientation
+
+def apply_orientation(image_array, orientation):
+    """
+    Transforms an image array from stored to displayed orientation, as defined by the
+    TIFF orientation tag values 1 to 8.
+    """
+    if orientation in [None, 1]:
+        return image_array
+    transforms = {2: lambda a: a[:, ::-1],
+                  3: lambda a: a[::-1, ::-1],
+                  4: lambda a: a[::-1],
+                  5: lambda a: a.swapaxes(0, 1),
+                  6: lambda a: a.swapaxes(0, 1)[:, ::-1],
+                  7: lambda a: a.swapaxes(0, 1)[::-1, ::-1],
+                  8: lambda a: a.swapaxes(0, 1)[::-1]}
+    return np.ascontiguousarray(transforms[orientation](image_array))
+
+def invert_image(image_array):
+    """
+    Inverts image polarity relative to the image maximum, using a lookup table for 8 bit images.
+    """
+    maximum = image_array.max()
+    if image_array.dtype == np.uint8:
+        lut = (int(maximum) - np.arange(256)).clip(0, 255).astype(np.uint8)
+        return cv2.LUT(image_array, lut)
+    return maximum - image_array
+
+_image_manifests = {}
+_image_manifests_lock = threading.Lock()
+
+def write_image_manifest(image_directory,
+                         entries,
+                         file_name = 'image_manifest.json'):
+    """
+    Records how images in image_directory are to be read, merged with existing entries.
+    
+    entries is a dictionary of image file name -> {'orientation' : TIFF orientation, 
+    'invert' : True to invert polarity}. Returns the manifest file.
+    """
+    manifest_file = os.path.join(image_directory, file_name)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    manifest.update(entries)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+    return manifest_file
+
+def read_image_manifest(image_directory,
+                        file_name = 'image_manifest.json'):
+    """
+    Returns the image manifest of image_directory, or an empty dictionary.
+    
+    Manifests are cached until the file changes.
+    """
+    manifest_file = os.path.join(image_directory, file_name)
+    try:
+        mtime = os.stat(manifest_file).st_mtime_ns
+    except OSError:
+        return {}
+    with _image_manifests_lock:
+        cached = _image_manifests.get(manifest_file)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    with _image_manifests_lock:
+        _image_manifests[manifest_file] = (mtime, manifest)
+    return manifest
+
+def _image_manifest_entry(image_file):
+    image_file = os.path.abspath(str(image_file))
+    return hipp.io.read_image_manifest(os.path.dirname(image_file)).get(os.path.basename(image_file))
+
+def apply_image_manifest(image_array, image_file):
+    """
+    Applies orientation and polarity recorded for image_file in the image manifest of its
+    directory to image_array.
+    """
+    entry = _image_manifest_entry(image_file)
+    if not entry:
+        return image_array
+    image_array = hipp.io.apply_orientation(image_array, entry.get('orientation', 1))
+    if entry.get('invert'):
+        image_array = hipp.io.invert_image(image_array)
+    return image_array
+
+def read_image(image_file,
+               flags = cv2.IMREAD_GRAYSCALE):
+    """
+    Reads an image with cv2.imread and applies the orientation and polarity recorded in 
+    the image manifest of its directory, if any, see hipp.io.write_image_manifest().
+    
+    Returns None if the image could not be read.
+    """
+    image_array = cv2.imread(str(image_file), flags)
+    if image_array is None:
+        return None
+    return hipp.io.apply_image_manifest(image_array, image_file)
+
+def read_image_shape(image_file):
+    """
+    Returns the height and width of an image as read by hipp.io.read_image(), from the 
+    file header without reading the pixels.
+    """
+    import rasterio
+    
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=rasterio.errors.NotGeoreferencedWarning)
+        with rasterio.open(image_file) as src:
+            shape = (src.height, src.width)
+    entry = _image_manifest_entry(image_file)
+    if entry and entry.get('orientation', 1) in [5, 6, 7, 8]:
+        # orientations 5 to 8 swap rows and columns
+        shape = shape[::-1]
+    return shape
+
+
+class ResultsStore:
+    """
+    Columnar store of fiducial marker proxy detection results, with one row per image.
+    
+    Results are written as Parquet files to <directory>/<roll>/<run>-<id>.parquet, one file 
+    per roll and run, so rolls can be appended as they complete, concurrently from several 
+    processes or nodes, and a history of runs accumulates in the same directory. Files are 
+    written under a temporary name and renamed, so readers never see partial results.
+    
+    All files share the schema in ResultsStore.fields. Read subsets with 
+    ResultsStore.read(columns=..., rolls=...).
+    
+    Requires pyarrow.
+    """
+    positions = ['left','top','right','bottom']
+    fields = ([('run',       'string'),
+               ('roll',      'string'),
+               ('file_name', 'string')] +
+              [('detected_' + p + s, 'float64') for p in positions for s in ['_y','_x']] +
+              [('detected_' + p + '_score', 'float64') for p in positions] +
+              [('proxy_' + p + s, 'float64') for p in positions for s in ['_y','_x']] +
+              [('principal_point_y',   'int64'),
+               ('principal_point_x',   'int64'),
+               ('distance_left_right', 'float64'),
+               ('distance_top_bottom', 'float64'),
+               ('intersection_angle',  'float64'),
+               ('image_square_dim',    'int64')])
+    
+    def __init__(self, directory):
+        self.directory = directory
+    
+    @classmethod
+    def schema(cls):
+        import pyarrow as pa
+        return pa.schema([(name, pa.type_for_alias(dtype)) for name, dtype in cls.fields])
+    
+    @staticmethod
+    def new_run():
+        """
+        Returns a run identifier based on the current UTC time.
+        """
+        return datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    
+    def rolls(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted([d.name for d in os.scandir(self.directory) if d.is_dir()])
+    
+    def append(self, roll, df):
+        """
+        Writes a DataFrame with the store's columns for one roll. Returns the file path.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        table = pa.Table.from_pandas(df[[name for name, dtype in self.fields]], 
+                                     schema = self.schema(), 
+                                     preserve_index = False)
+        
+        roll_directory = os.path.join(self.directory, roll)
+        pathlib.Path(roll_directory).mkdir(parents=True, exist_ok=True)
+        run = df['run'].iloc[0] if len(df) else self.new_run()
+        out = os.path.join(roll_directory, run + '-' + uuid.uuid4().hex[:8] + '.parquet')
+        tmp = out + '.tmp'
+        pq.write_table(table, tmp)
+        os.replace(tmp, out)
+        return out
+    
+    def append_roll(self,
+                    roll,
+                    detected_df,
+                    proxy_locations_df,
+                    principal_points,
+                    distances,
+                    intersection_angles,
+                    image_square_dim,
+                    run = None):
+        """
+        Writes the results of hipp.batch.compute_proxy_crop_parameters() for one roll,
+        with rows ordered as in detected_df. Returns the file path.
+        """
+        n = len(detected_df)
+        locations = np.array(detected_df['match_locations'].tolist(), dtype=float).reshape(n, -1)
+        scores    = np.array(detected_df['scores'].tolist(), dtype=float).reshape(n, -1)
+        
+        df = pd.DataFrame({'run'       : [run or self.new_run()] * n,
+                           'roll'      : [roll] * n,
+                           'file_name' : [os.path.basename(f) for f in detected_df['file_names']]})
+        for i, p in enumerate(self.positions):
+            df['detected_' + p + '_y'] = locations[:, 2*i]
+            df['detected_' + p + '_x'] = locations[:, 2*i+1]
+        for i, p in enumerate(self.positions):
+            df['detected_' + p + '_score'] = scores[:, i]
+        for p in self.positions:
+            df['proxy_' + p + '_y'] = proxy_locations_df[p + '_y'].values.astype(float)
+            df['proxy_' + p + '_x'] = proxy_locations_df[p + '_x'].values.astype(float)
+        
+        principal_points = np.array(principal_points, dtype=np.int64).reshape(n, 2)
+        distances        = np.array(distances, dtype=float).reshape(n, 2)
+        df['principal_point_y']   = principal_points[:, 0]
+        df['principal_point_x']   = principal_points[:, 1]
+        df['distance_left_right'] = distances[:, 0]
+        df['distance_top_bottom'] = distances[:, 1]
+        df['intersection_angle']  = np.array(intersection_angles, dtype=float)
+        df['image_square_dim']    = image_square_dim
+        
+        return self.append(roll, df)
+    
+    def read(self,
+             columns = None,
+             rolls = None,
+             runs = None):
+        """
+        Reads results into a DataFrame. 
+        
+        Only the given columns are read and only the files of the given rolls are opened.
+        runs optionally selects results from a list of runs.
+        """
+        import pyarrow.dataset as ds
+        
+        if rolls is None:
+            rolls = self.rolls()
+        files = []
+        for roll in rolls:
+            files.extend(sorted(glob.glob(os.path.join(self.directory, roll, '*.parquet'))))
+        
+        schema = self.schema()
+        if columns is None:
+            columns = schema.names
+        if not files:
+            return schema.empty_table().select(columns).to_pandas()
+        
+        dataset = ds.dataset(files, schema=schema, format='parquet')
+        expression = None
+        if runs is not None:
+            expression = ds.field('run').isin(list(runs))
+        return dataset.to_table(columns = list(columns), 
+                                filter = expression).to_pandas()
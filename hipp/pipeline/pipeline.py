@@ -0,0 +1,331 @@
+import collections
+import concurrent.futures
+import cv2
+import numpy as np
+import os
+import pathlib
+import shutil
+import tempfile
+
+import hipp.core
+import hipp.image
+import hipp.io
+import hipp.pipeline
+
+"""
+Library for composable, generator based image processing pipelines.
+
+Stages pass frames held in memory downstream, so custom pipelines such as
+
+    pipeline = hipp.pipeline.Pipeline(hipp.pipeline.ReadStage(workers=2),
+                                      hipp.pipeline.DetectFiducialProxiesStage(templates, workers=8),
+                                      hipp.pipeline.CropStage(),
+                                      hipp.pipeline.EnhanceStage(workers=8),
+                                      hipp.pipeline.WriteStage('input_data/cropped_images'))
+    for frame in pipeline.run(hipp.pipeline.frames_from_files(image_files)):
+        print(frame.metadata['output_file'])
+
+never write intermediate files to disk, except for frames CropStage holds back beyond
+its max_held limit.
+"""
+
+class Frame:
+    """
+    Image array and metadata passed between pipeline stages.
+    """
+    def __init__(self, name, array=None, metadata=None):
+        self.name     = name
+        self.array    = array
+        self.metadata = metadata if metadata is not None else {}
+    
+    def __repr__(self):
+        shape = None if self.array is None else self.array.shape
+        return 'Frame(name={!r}, shape={}, metadata={})'.format(self.name, shape, sorted(self.metadata))
+
+
+class Stage:
+    """
+    Base class for pipeline stages.
+    
+    Subclasses implement process(), which receives one Frame and returns the processed 
+    Frame, or None to drop it from the pipeline. With workers > 1 frames are processed 
+    concurrently in a thread pool, while preserving input order downstream. At most 
+    2 * workers frames are held in memory by a stage at any time.
+    """
+    def __init__(self, workers=1):
+        self.workers = workers
+    
+    def process(self, frame):
+        raise NotImplementedError
+    
+    def flush(self):
+        """
+        Called once the input is exhausted. Yields frames held back by the stage.
+        """
+        return iter(())
+    
+    def __call__(self, frames):
+        if self.workers <= 1:
+            for frame in frames:
+                frame = self.process(frame)
+                if frame is not None:
+                    yield frame
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+                pending = collections.deque()
+                for frame in frames:
+                    pending.append(pool.submit(self.process, frame))
+                    if len(pending) >= 2*self.workers:
+                        frame = pending.popleft().result()
+                        if frame is not None:
+                            yield frame
+                while pending:
+                    frame = pending.popleft().result()
+                    if frame is not None:
+                        yield frame
+        
+        for frame in self.flush():
+            yield frame
+
+
+class Pipeline:
+    """
+    Chains stages into a single generator.
+    """
+    def __init__(self, *stages):
+        self.stages = list(stages)
+    
+    def run(self, frames):
+        for stage in self.stages:
+            frames = stage(frames)
+        return frames
+
+
+class ReadStage(Stage):
+    """
+    Reads the image at frame.metadata['file_name'] into frame.array.
+    """
+    def __init__(self, flags=cv2.IMREAD_GRAYSCALE, workers=1):
+        super().__init__(workers=workers)
+        self.flags = flags
+    
+    def process(self, frame):
+        frame.array = hipp.io.read_image(frame.metadata['file_name'], self.flags)
+        if frame.array is None:
+            print('WARNING: Unable to read', frame.metadata['file_name'])
+            return None
+        return frame
+
+
+class EnhanceStage(Stage):
+    """
+    Applies CLAHE and/or linear histogram stretch to frame.array.
+    
+    Frames with metadata['file_name'] are assumed to hold the image as read by ReadStage,
+    and the stretch reuses its cached statistics, see hipp.image.read_image_statistics().
+    """
+    def __init__(self, 
+                 clahe_enhancement = True,
+                 stretch_histogram = True,
+                 workers = 1):
+        super().__init__(workers=workers)
+        self.clahe_enhancement = clahe_enhancement
+        self.stretch_histogram = stretch_histogram
+    
+    def process(self, frame):
+        if self.clahe_enhancement:
+            frame.array = hipp.image.clahe_equalize_image(frame.array)
+        if self.stretch_histogram:
+            statistics = None
+            if 'file_name' in frame.metadata and frame.array.dtype == np.uint8 and frame.array.ndim == 2:
+                statistics = hipp.image.read_image_statistics(frame.metadata['file_name'],
+                                                              image_array = frame.array,
+                                                              clahe_enhancement = self.clahe_enhancement)
+            frame.array = hipp.image.img_linear_stretch(frame.array, statistics = statistics)
+        return frame
+
+
+class DetectFiducialProxiesStage(Stage):
+    """
+    Detects midside fiducial marker proxies with hipp.core.detect_fiducial_proxies_in_array().
+    
+    Stores proxy locations in padded image coordinates under metadata['match_locations'] 
+    and quality scores under metadata['scores']. frame.array is left unchanged.
+    """
+    def __init__(self,
+                 templates,
+                 buffer_distance = 250,
+                 workers = 1):
+        super().__init__(workers=workers)
+        self.templates       = templates
+        self.buffer_distance = buffer_distance
+    
+    def process(self, frame):
+        matches, quality_scores = hipp.core.detect_fiducial_proxies_in_array(frame.array,
+                                                                             self.templates,
+                                                                             buffer_distance = self.buffer_distance)
+        frame.metadata['match_locations'] = matches
+        frame.metadata['scores']          = quality_scores
+        return frame
+
+
+class CropStage(Stage):
+    """
+    Pads frame.array and crops it to a square about the principal point.
+    
+    The principal point is taken from metadata['principal_point'] (y,x in padded image
+    coordinates) if present. Otherwise it is estimated from metadata['match_locations']
+    using running statistics per metadata['roll'], see hipp.core.StreamingRollStatistics.
+    Frames are held back until the statistics of their roll are stable, then cropped with
+    the parameters available at that time. If image_square_dim is not specified it is 
+    derived from the statistics as well.
+    
+    At most max_held held back frames are kept in memory. The arrays of further frames are
+    written to spill_directory, a temporary directory by default, until they are released.
+    """
+    def __init__(self,
+                 image_square_dim = None,
+                 buffer_distance = 250,
+                 threshold_px = 50,
+                 missing_proxy = None,
+                 min_samples = 5,
+                 tolerance_px = 2,
+                 max_held = 16,
+                 spill_directory = None,
+                 workers = 1):
+        super().__init__(workers=workers)
+        self.image_square_dim = image_square_dim
+        self.buffer_distance  = buffer_distance
+        self.threshold_px     = threshold_px
+        self.missing_proxy    = missing_proxy
+        self.min_samples      = min_samples
+        self.tolerance_px     = tolerance_px
+        self.max_held         = max_held
+        self.spill_directory  = spill_directory
+        self.statistics       = {}
+        self.spilled          = 0
+        self._held            = collections.OrderedDict()
+        self._spill_files     = {}
+    
+    def __call__(self, frames):
+        # statistics are updated in input order before frames are handed to the workers
+        return super().__call__(self._release(frames))
+    
+    def _statistics(self, frame):
+        roll = frame.metadata.get('roll')
+        if roll not in self.statistics:
+            self.statistics[roll] = hipp.core.StreamingRollStatistics(threshold_px = self.threshold_px,
+                                                                      missing_proxy = self.missing_proxy,
+                                                                      min_samples = self.min_samples,
+                                                                      tolerance_px = self.tolerance_px)
+        return self.statistics[roll]
+    
+    def _crop_parameters(self, frame, final=False):
+        # once the input is exhausted, use whatever statistics are available
+        return self._statistics(frame).crop_parameters(frame.name, require_stable = not final)
+    
+    def _hold(self, frame):
+        self._held[frame.name] = frame
+        if len(self._held) - len(self._spill_files) > self.max_held:
+            if not self.spill_directory:
+                self.spill_directory = tempfile.mkdtemp(prefix='hipp_crop_')
+            spill_file = os.path.join(self.spill_directory, str(len(self._spill_files)) + '_' + 
+                                      os.path.basename(frame.name) + '.npy')
+            np.save(spill_file, frame.array)
+            frame.array = None
+            self._spill_files[frame.name] = spill_file
+            self.spilled += 1
+    
+    def _unhold(self, frame):
+        del self._held[frame.name]
+        spill_file = self._spill_files.pop(frame.name, None)
+        if spill_file:
+            frame.array = np.load(spill_file)
+            os.remove(spill_file)
+        return frame
+    
+    def _release(self, frames):
+        spill_directory = self.spill_directory
+        try:
+            for frame in frames:
+                if 'principal_point' in frame.metadata:
+                    yield frame
+                    continue
+                
+                self._statistics(frame).add((frame.metadata['match_locations'],
+                                             frame.metadata['scores'],
+                                             frame.name))
+                self._hold(frame)
+                for name, held_frame in list(self._held.items()):
+                    crop_parameters = self._crop_parameters(held_frame)
+                    if crop_parameters:
+                        held_frame = self._unhold(held_frame)
+                        held_frame.metadata['principal_point'], image_square_dim = crop_parameters
+                        held_frame.metadata.setdefault('image_square_dim', image_square_dim)
+                        yield held_frame
+            
+            for name, held_frame in list(self._held.items()):
+                crop_parameters = self._crop_parameters(held_frame, final=True)
+                held_frame = self._unhold(held_frame)
+                if not crop_parameters:
+                    print('WARNING: Unable to estimate principal point for:', name)
+                    continue
+                held_frame.metadata['principal_point'], image_square_dim = crop_parameters
+                held_frame.metadata.setdefault('image_square_dim', image_square_dim)
+                yield held_frame
+        finally:
+            for spill_file in self._spill_files.values():
+                os.remove(spill_file)
+            self._spill_files.clear()
+            if self.spill_directory and not spill_directory:
+                # temporary directory created by this run
+                shutil.rmtree(self.spill_directory, ignore_errors=True)
+                self.spill_directory = None
+    
+    def process(self, frame):
+        image_square_dim = self.image_square_dim or frame.metadata['image_square_dim']
+        frame.metadata['image_square_dim'] = image_square_dim
+        image_array = hipp.core.pad_image(frame.array,
+                                          buffer_distance = self.buffer_distance)
+        frame.array = hipp.image.crop_about_point(image_array,
+                                                  frame.metadata['principal_point'],
+                                                  image_square_dim = image_square_dim)
+        return frame
+
+
+class WriteStage(Stage):
+    """
+    Writes frame.array to output_directory and stores the file name under 
+    metadata['output_file'].
+    """
+    def __init__(self,
+                 output_directory = 'input_data/cropped_images',
+                 extension = None,
+                 workers = 1):
+        super().__init__(workers=workers)
+        self.output_directory = output_directory
+        self.extension        = extension
+        pathlib.Path(output_directory).mkdir(parents=True, exist_ok=True)
+    
+    def process(self, frame):
+        path, basename, extension = hipp.io.split_file(frame.metadata.get('file_name', frame.name))
+        out = os.path.join(self.output_directory, basename + (self.extension or extension))
+        cv2.imwrite(out, frame.array)
+        frame.metadata['output_file'] = out
+        return frame
+
+
+def frames_from_files(image_files,
+                      roll_from_file_name = None):
+    """
+    Yields empty frames for a list of image files, to be read by hipp.pipeline.ReadStage.
+    
+    roll_from_file_name is an optional function returning the roll for a file name, 
+    e.g. lambda f: pathlib.Path(f).stem[:-4] for EE images.
+    """
+    for image_file in image_files:
+        image_file = pathlib.Path(image_file).as_posix()
+        metadata = {'file_name' : image_file}
+        if roll_from_file_name:
+            metadata['roll'] = roll_from_file_name(image_file)
+        yield hipp.pipeline.Frame(image_file, metadata=metadata)
@@ -1,17 +1,18 @@
 import concurrent
-import cv2
-import matplotlib.pyplot as plt
 import multiprocessing
 import numpy as np
 import os
 import pathlib
 import psutil
 
+import hipp.image
 import hipp.io
 import hipp.plot
 
 """
 Library for common plotting functions.
+
+matplotlib is imported by the plotting functions when first called.
 """
 
 def iter_plot_proxies(images,
@@ -19,11 +20,23 @@ def iter_plot_proxies(images,
                       principal_points,
                       buffer_distance = 250,
                       output_directory='qc/proxy_detection',
-                      verbose=True):
+                      verbose=True,
+                      qc_writer=None):
+    """
+    Plots detected proxies and principal point on each image.
     
+    Plots are rendered in a process pool, or queued to qc_writer, a hipp.qc.QCWriter, if 
+    provided. Images with a missing proxy are submitted as failures to the writer's policy.
+    """
     locations_no_buffer        = proxy_locations_df.iloc[:,1:] - buffer_distance
     locations_no_buffer        = locations_no_buffer.values.tolist()
     principal_points_no_buffer = np.array(principal_points) - buffer_distance
+    
+    if qc_writer:
+        for i in zip(images,locations_no_buffer,principal_points_no_buffer):
+            qc_writer.submit(hipp.plot.plot_proxies, i, output_directory,
+                             failed = bool(np.isnan(i[1]).any()))
+        return
 
     pool = multiprocessing.Pool(processes=psutil.cpu_count(logical=False))
     for i in zip(images,locations_no_buffer,principal_points_no_buffer):
@@ -32,13 +45,20 @@ def iter_plot_proxies(images,
     pool.join()
 
 def plot_histogram(image_array,
-                   figsize=(10, 5)):
+                   figsize=(10, 5),
+                   statistics=None):
+    """
+    Plots the 256 bin histogram of an 8 bit image array, using its statistics from 
+    hipp.image.compute_image_statistics() or hipp.image.read_image_statistics() if provided.
+    """
+    import matplotlib.pyplot as plt
+    
+    if statistics is None:
+        statistics = hipp.image.compute_image_statistics(image_array)
     
     fig, ax = plt.subplots(figsize=figsize)
     
-    n, bins, patches = ax.hist(image_array.ravel()[::40],
-                        bins=256, 
-                        range=(0,256))
+    ax.stairs(statistics['histogram'], np.arange(257), fill=True)
     plt.show()
 
 def plot_images(image_arrays,
@@ -49,6 +69,7 @@ def plot_images(image_arrays,
                 title=None,
                 labels=None,
                 output_file_name=None):
+    import matplotlib.pyplot as plt
 
     plt.figure(figsize=figsize)
 
@@ -83,10 +104,27 @@ def plot_images(image_arrays,
         
         plt.savefig(output_file_name)
         
-def plot_restitution_qc(qc_df):
+def plot_restitution_qc(qc_df,
+                        output_directory = 'qc/restitution/',
+                        qc_writer = None,
+                        show = True):
+    """
+    Plots image restitution qc metrics before and after transform.
+    
+    With a hipp.qc.QCWriter as qc_writer, the plots are saved in the background and not shown.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
     
-    output_directory = 'qc/restitution/'
-    print('Image restitution qc plots in '+output_directory )
+    if qc_writer:
+        qc_writer.submit(hipp.plot.plot_restitution_qc, qc_df.copy(), 
+                         output_directory = output_directory,
+                         show = False,
+                         always = True)
+        return
+    
+    if show:
+        print('Image restitution qc plots in '+output_directory )
     p = pathlib.Path(output_directory)
     p.mkdir(parents=True, exist_ok=True)
     
@@ -108,7 +146,12 @@ def plot_restitution_qc(qc_df):
                    'corner_angle_diff']
     
     for i in np.arange(1,5):
-        fig,ax = plt.subplots(figsize=(12,5))
+        if show:
+            fig,ax = plt.subplots(figsize=(12,5))
+        else:
+            # not managed by pyplot, safe to render outside of the main thread
+            fig = Figure(figsize=(12,5))
+            ax = fig.subplots()
         key1 = qc_df.iloc[:,i].name
         key2 = qc_df.iloc[:,i+4].name
         qc_df[[key1,key2]].plot(ax=ax)
@@ -119,11 +162,12 @@ def plot_restitution_qc(qc_df):
         ax.set_title(titles.pop(0))
 
         out = os.path.join(output_directory,output_names.pop(0)+'.png')
-        plt.savefig(out)
+        fig.savefig(out)
         # plt.close()
 
 def plot_proxies(data,
                  output_directory=None):
+    from matplotlib.figure import Figure
     
     image_file        = data[0]
     proxies           = np.array(data[1])
@@ -142,18 +186,19 @@ def plot_proxies(data,
     
     path, name, ext = hipp.io.split_file(image_file)
     
-    image_array = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+    image_array = hipp.io.read_image(image_file)
         
-    fig,ax = plt.subplots(figsize=(10,10))
+    # not managed by pyplot, safe to render in worker threads
+    fig = Figure(figsize=(10,10))
+    ax = fig.subplots()
     ax.imshow(image_array,cmap='gray')
     ax.scatter(proxies_x,proxies_y,color='lime',marker='.')
     ax.scatter(principal_point_x,principal_point_y,color='red', marker='.')
-    plt.tight_layout()
+    fig.tight_layout()
     
     output_file_name = os.path.join(output_directory, name+'.png')
     
     fig.savefig(output_file_name)
-    plt.close(fig)
     return output_file_name
 
 ## some helper functions
@@ -1,6 +1,16 @@
 from collections.abc import Iterable
+import concurrent.futures
+import cv2
 import numpy as np
+import pandas as pd
+import psutil
+import queue
+import threading
+from tqdm import tqdm
+import warnings
 
+import hipp.image
+import hipp.io
 import hipp.qc
 import hipp.math
 
@@ -91,4 +101,359 @@ def convert_coordinates(coordinates,
     # swap coordinate system origin to prinicpal point
     coordinates_mm = (coordinates_mm - principal_point_mm) * scanning_resolution_mm
     
-    return coordinates_mm, principal_point_mm
\ No newline at end of file
+    return coordinates_mm, principal_point_mm
+
+def read_frame_thumbnail(image_file,
+                         decimation = 16):
+    """
+    Reads the first band of an image at 1/decimation resolution as 8 bit array, averaging
+    pixels. Internal overviews are used if present. Orientation and polarity recorded in 
+    the image manifest are applied, see hipp.io.read_image().
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+    
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=rasterio.errors.NotGeoreferencedWarning)
+        with rasterio.open(image_file) as src:
+            out_shape = (max(src.height // decimation, 1), 
+                         max(src.width  // decimation, 1))
+            thumbnail = src.read(1, out_shape=out_shape, resampling=Resampling.average)
+    
+    if thumbnail.dtype != np.uint8:
+        thumbnail = (thumbnail.astype(float) / np.iinfo(thumbnail.dtype).max * 255).astype(np.uint8)
+    return hipp.io.apply_image_manifest(thumbnail, image_file)
+
+def compute_frame_statistics(image_file,
+                             decimation = 16,
+                             border_fraction = 0.05):
+    """
+    Computes cheap statistics from a thumbnail of an image, see hipp.qc.read_frame_thumbnail().
+    
+    Returns dictionary with the histogram based dynamic range (1st to 99th percentile), 
+    fraction of dark (< 10) and bright (> 245) pixels, the fraction of Canny edge pixels 
+    after smoothing and the mean intensity of the image border and center. The perceptual
+    hash of the thumbnail is included as hexadecimal string, see hipp.image.perceptual_hash().
+    """
+    thumbnail = hipp.qc.read_frame_thumbnail(image_file, decimation = decimation)
+    
+    histogram = np.bincount(thumbnail.ravel(), minlength=256)
+    cdf = np.cumsum(histogram) / histogram.sum()
+    
+    edges = cv2.Canny(cv2.GaussianBlur(thumbnail, (5,5), 0), 50, 150)
+    
+    b = max(int(min(thumbnail.shape) * border_fraction), 1)
+    border = np.ones(thumbnail.shape, dtype=bool)
+    border[b:-b, b:-b] = False
+    
+    statistics = {'file_names'      : str(image_file),
+                  'phash'           : '{:016x}'.format(hipp.image.perceptual_hash(thumbnail)),
+                  'mean'            : thumbnail.mean(),
+                  'std'             : thumbnail.std(),
+                  'dynamic_range'   : int(np.searchsorted(cdf, 0.99) - np.searchsorted(cdf, 0.01)),
+                  'dark_fraction'   : histogram[:10].sum() / histogram.sum(),
+                  'bright_fraction' : histogram[246:].sum() / histogram.sum(),
+                  'edge_density'    : np.count_nonzero(edges) / edges.size,
+                  'border_mean'     : thumbnail[border].mean(),
+                  'center_mean'     : thumbnail[~border].mean() if (~border).any() else np.nan}
+    return statistics
+
+def evaluate_frame_statistics(statistics,
+                              min_dynamic_range = 20,
+                              max_dark_fraction = 0.98,
+                              max_bright_fraction = 0.98,
+                              min_edge_density = 0.001,
+                              min_border_contrast = None):
+    """
+    Evaluates output of hipp.qc.compute_frame_statistics() for a single image. 
+    
+    Returns the reason to reject the image, or None if it passed. Set min_border_contrast
+    to also reject frames without contrast between image border and center, such as 
+    uniformly exposed leader film.
+    """
+    if statistics['dark_fraction'] > max_dark_fraction:
+        return 'dark'
+    if statistics['bright_fraction'] > max_bright_fraction:
+        return 'overexposed'
+    if statistics['dynamic_range'] < min_dynamic_range:
+        return 'blank'
+    if statistics['edge_density'] < min_edge_density:
+        return 'no structure'
+    if min_border_contrast is not None and \
+    abs(statistics['center_mean'] - statistics['border_mean']) < min_border_contrast:
+        return 'no frame border'
+    return None
+
+def triage_frames(image_files,
+                  decimation = 16,
+                  max_workers = None,
+                  verbose = True,
+                  duplicate_index = None,
+                  **kwargs):
+    """
+    Identifies blank, damaged or non-frame scans from thumbnail statistics before they 
+    are passed on to fiducial marker detection. kwargs are passed to 
+    hipp.qc.evaluate_frame_statistics().
+    
+    With a hipp.qc.DuplicateIndex, images that are near duplicates of an image in the index,
+    or of an earlier image in image_files, are rejected as well. Accepted images are added
+    to the index.
+    
+    Images that can not be read, such as truncated or empty files, are rejected as unreadable.
+    
+    Returns the list of accepted image files, in input order, and a DataFrame with the 
+    statistics and rejection reason of rejected image files.
+    """
+    import rasterio
+    
+    if not max_workers:
+        max_workers = max(psutil.cpu_count(logical=True)-1, 1)
+    
+    if verbose:
+        print("Triaging images...")
+    with tqdm(total=len(image_files), disable=not verbose) as pbar:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(hipp.qc.compute_frame_statistics, 
+                                   image_file,
+                                   decimation = decimation) for image_file in image_files]
+            for future in concurrent.futures.as_completed(futures):
+                pbar.update(1)
+    
+    accepted = []
+    rejected = []
+    for image_file, future in zip(image_files, futures):
+        try:
+            statistics = future.result()
+        except (OSError, rasterio.errors.RasterioError) as e:
+            rejected.append({'file_names' : str(image_file), 'reason' : 'unreadable'})
+            if verbose:
+                print('WARNING: Unable to read', image_file, '-', e)
+            continue
+        reason = hipp.qc.evaluate_frame_statistics(statistics, **kwargs)
+        if not reason and duplicate_index is not None:
+            matches = duplicate_index.add(str(image_file), int(statistics['phash'], 16))
+            if matches:
+                reason = 'duplicate of ' + matches[0][0]
+        if reason:
+            statistics['reason'] = reason
+            rejected.append(statistics)
+        else:
+            accepted.append(image_file)
+    
+    rejected_df = pd.DataFrame(rejected, columns = ['file_names', 'reason', 'phash', 'mean', 'std', 
+                                                    'dynamic_range', 'dark_fraction', 
+                                                    'bright_fraction', 'edge_density',
+                                                    'border_mean', 'center_mean'])
+    if verbose and rejected:
+        print('Rejected', len(rejected), 'of', len(image_files), 'images:')
+        for file_name, reason in zip(rejected_df['file_names'], rejected_df['reason']):
+            print(file_name, '-', reason)
+    
+    return accepted, rejected_df
+
+class DuplicateIndex:
+    """
+    Index of perceptual image hashes to find near duplicate frames, such as re-scans of 
+    the same negative under a different ID.
+    
+    Hashes within max_distance bits of each other, see hipp.image.hamming_distance(), are 
+    duplicates. Hashes are split into max_distance + 1 bands and indexed per band, so only 
+    hashes that match at least one band exactly are compared.
+    """
+    def __init__(self,
+                 max_distance = 6,
+                 hash_bits = 64):
+        self.max_distance = max_distance
+        self.hash_bits    = hash_bits
+        self.keys         = []
+        self.hashes       = []
+        
+        bands = max_distance + 1
+        self._band_bits = -(-hash_bits // bands)
+        self._buckets   = [{} for i in range(bands)]
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    def _bands(self, image_hash):
+        mask = (1 << self._band_bits) - 1
+        for i in range(len(self._buckets)):
+            yield i, (image_hash >> (i * self._band_bits)) & mask
+    
+    def query(self, image_hash):
+        """
+        Returns list of (key, distance) of indexed near duplicates, closest first.
+        """
+        candidates = set()
+        for i, band in self._bands(image_hash):
+            candidates.update(self._buckets[i].get(band, []))
+        
+        matches = []
+        for j in sorted(candidates):
+            distance = hipp.image.hamming_distance(image_hash, self.hashes[j])
+            if distance <= self.max_distance:
+                matches.append((self.keys[j], distance))
+        return sorted(matches, key=lambda m: m[1])
+    
+    def add(self, key, image_hash):
+        """
+        Adds the hash of an image if it is not a near duplicate of an indexed image.
+        
+        Returns the near duplicates found, see hipp.qc.DuplicateIndex.query().
+        """
+        matches = self.query(image_hash)
+        if not matches:
+            j = len(self.keys)
+            self.keys.append(key)
+            self.hashes.append(image_hash)
+            for i, band in self._bands(image_hash):
+                self._buckets[i].setdefault(band, []).append(j)
+        return matches
+    
+    def to_dataframe(self):
+        return pd.DataFrame({'key'   : self.keys,
+                             'phash' : ['{:016x}'.format(h) for h in self.hashes]})
+    
+    def save(self, output_file):
+        self.to_dataframe().to_csv(output_file, index=False)
+    
+    @classmethod
+    def load(cls, 
+             index_file,
+             max_distance = 6):
+        """
+        Loads an index written with hipp.qc.DuplicateIndex.save().
+        """
+        index = cls(max_distance = max_distance)
+        df = pd.read_csv(index_file, dtype=str)
+        for key, image_hash in zip(df['key'], df['phash']):
+            index.add(key, int(image_hash, 16))
+        return index
+
+
+class QCWriter:
+    """
+    Writes QC artifacts, such as plots and image chips, in background threads.
+    
+    Jobs are any function with arguments, e.g. cv2.imwrite or hipp.plot.plot_proxies, and 
+    are held in a queue of at most max_queue jobs. When the queue is full, jobs are dropped 
+    and counted, so that QC does not stall the processing workers, unless block is True.
+    
+    policy decides which submitted jobs are written:
+    
+        all          every job
+        every_nth    every nth job, and all failures
+        failures     only jobs submitted with failed = True
+        low_scores   jobs with a score below min_score, and all failures
+    
+    Use as context manager or call close() to wait for queued jobs to be written.
+    
+        with hipp.qc.QCWriter(policy = 'every_nth', every_n = 100) as qc_writer:
+            qc_writer.submit(cv2.imwrite, 'qc/chip.png', image_array, score = quality_score)
+    """
+    policies = ['all', 'every_nth', 'failures', 'low_scores']
+    
+    def __init__(self,
+                 policy = 'all',
+                 every_n = 10,
+                 min_score = 0.9,
+                 max_queue = 64,
+                 block = False,
+                 n_threads = 1,
+                 verbose = True):
+        if policy not in self.policies:
+            raise ValueError('policy must be one of ' + ', '.join(self.policies))
+        self.policy    = policy
+        self.every_n   = every_n
+        self.min_score = min_score
+        self.block     = block
+        self.verbose   = verbose
+        self.submitted = 0
+        self.written   = 0
+        self.skipped   = 0
+        self.dropped   = 0
+        self.errors    = []
+        
+        self._queue   = queue.Queue(maxsize=max_queue)
+        self._lock    = threading.Lock()
+        self._closed  = False
+        self._threads = [threading.Thread(target=self._work, daemon=True) for i in range(n_threads)]
+        for thread in self._threads:
+            thread.start()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def sample(self, score = None, failed = False):
+        """
+        Returns True if a job with score and failed status is written under the policy.
+        """
+        with self._lock:
+            self.submitted += 1
+            count = self.submitted
+        if self.policy == 'all':
+            return True
+        if self.policy == 'failures':
+            return bool(failed)
+        if failed:
+            return True
+        if self.policy == 'every_nth':
+            return (count - 1) % self.every_n == 0
+        return score is not None and not np.isnan(score) and score < self.min_score
+    
+    def submit(self, function, *args, score = None, failed = False, always = False, **kwargs):
+        """
+        Queues function(*args, **kwargs) if sampled by the policy, or always.
+        
+        Returns True if the job was queued.
+        """
+        if self._closed:
+            raise RuntimeError('QCWriter is closed')
+        if not always and not self.sample(score = score, failed = failed):
+            with self._lock:
+                self.skipped += 1
+            return False
+        try:
+            self._queue.put((function, args, kwargs), block = self.block)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        return True
+    
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            function, args, kwargs = job
+            try:
+                function(*args, **kwargs)
+                with self._lock:
+                    self.written += 1
+            except Exception as e:
+                with self._lock:
+                    self.errors.append(e)
+            self._queue.task_done()
+    
+    def close(self):
+        """
+        Waits for queued jobs to be written and stops the writer threads.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self.verbose and (self.dropped or self.errors):
+            print('QC writer wrote', self.written, 'artifacts,',
+                  'dropped', self.dropped, 'with full queue,',
+                  'failed on', len(self.errors))
+            for e in self.errors[:5]:
+                print('WARNING:', e)
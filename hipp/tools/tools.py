@@ -13,6 +13,7 @@ import xarray as xr
 hv.extension('bokeh')
 
 import hipp.image
+import hipp.io
 import hipp.tools
 
 import warnings
@@ -57,23 +58,32 @@ def point_picker(image_file_name,
     return df
 
 
+def read_raster(image_file_name):
+    """
+    Reads an image with hipp.io.read_image(), in the orientation used for detection and
+    cropping, as a linearly stretched xarray.DataArray with pixel center coordinates.
+    """
+    image_array = hipp.io.read_image(image_file_name)
+    height, width = image_array.shape
+    da = xr.DataArray(hipp.image.img_linear_stretch(image_array),
+                      dims = ('y', 'x'),
+                      coords = {'y' : np.arange(height) + 0.5,
+                                'x' : np.arange(width) + 0.5})
+    return da
+
 def hv_plot_raster(image_file_name):
     
-    src = rasterio.open(image_file_name)
+    da = hipp.tools.read_raster(image_file_name)
 
-    subplot_width  = hipp.tools.scale_down_number(src.shape[0])
-    subplot_height = hipp.tools.scale_down_number(src.shape[1])
+    subplot_width  = hipp.tools.scale_down_number(da.shape[0])
+    subplot_height = hipp.tools.scale_down_number(da.shape[1])
 
-    da = xr.open_rasterio(src)
-    
-    da.values = hipp.image.img_linear_stretch(da.values)
-
-    hv_image = da.sel(band=1).hvplot.image(rasterize=True,
-                                      width=subplot_width,
-                                      height=subplot_height,
-                                      flip_yaxis=True,
-                                      colorbar=False,
-                                      cmap='gray')
+    hv_image = da.hvplot.image(rasterize=True,
+                               width=subplot_width,
+                               height=subplot_height,
+                               flip_yaxis=True,
+                               colorbar=False,
+                               cmap='gray')
                                       
     return hv_image, subplot_width, subplot_height
     
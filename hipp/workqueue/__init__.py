@@ -0,0 +1 @@
+from .workqueue import *
\ No newline at end of file
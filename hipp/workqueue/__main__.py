@@ -0,0 +1,62 @@
+import argparse
+import functools
+import glob
+
+import hipp.workqueue
+
+"""
+Command line interface to the shared file system work queue.
+
+    python -m hipp.workqueue enqueue /shared/queue.sqlite '/shared/raw_images/*.tif'
+    python -m hipp.workqueue work /shared/queue.sqlite /shared/fiducials /shared/results
+    python -m hipp.workqueue status /shared/queue.sqlite
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description='Distribute fiducial proxy preprocessing of rolls across nodes.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    enqueue = subparsers.add_parser('enqueue', help='add one task per roll for the matched images')
+    enqueue.add_argument('database_file')
+    enqueue.add_argument('image_files', help='glob pattern matching the images to process')
+    
+    work = subparsers.add_parser('work', help='claim and process rolls until the queue is finished')
+    work.add_argument('database_file')
+    work.add_argument('template_directory', help='template library with one directory per roll')
+    work.add_argument('results_directory', help='shared results store directory, see hipp.io.ResultsStore')
+    work.add_argument('-o', '--output_directory', default='input_data/cropped_images')
+    work.add_argument('--buffer_distance', type=int, default=250)
+    work.add_argument('--threshold_px', type=int, default=50)
+    work.add_argument('--missing_proxy', default=None, choices=['left', 'top', 'right', 'bottom'])
+    work.add_argument('--lease_seconds', type=float, default=300)
+    
+    status = subparsers.add_parser('status', help='print number of tasks per status')
+    status.add_argument('database_file')
+    
+    args = parser.parse_args()
+    
+    if args.command == 'enqueue':
+        queue = hipp.workqueue.WorkQueue(args.database_file)
+        n = queue.add_images(glob.glob(args.image_files))
+        print('Added', n, 'tasks to', args.database_file)
+    
+    elif args.command == 'work':
+        function = functools.partial(hipp.workqueue.preprocess_roll_with_fiducial_proxies,
+                                     template_directory = args.template_directory,
+                                     results_directory = args.results_directory,
+                                     output_directory = args.output_directory,
+                                     buffer_distance = args.buffer_distance,
+                                     threshold_px = args.threshold_px,
+                                     missing_proxy = args.missing_proxy)
+        processed = hipp.workqueue.run_worker(args.database_file,
+                                              function,
+                                              lease_seconds = args.lease_seconds)
+        print('Processed', len(processed), 'tasks.')
+    
+    elif args.command == 'status':
+        queue = hipp.workqueue.WorkQueue(args.database_file)
+        for status, count in sorted(queue.counts().items()):
+            print(status, count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+import json
+import os
+import pandas as pd
+import pathlib
+import socket
+import sqlite3
+import threading
+import time
+
+import hipp.batch
+import hipp.io
+import hipp.workqueue
+
+"""
+Library to distribute processing across nodes through a work queue on a shared file system.
+
+The queue is a SQLite database. Workers on different nodes claim tasks, each holding the 
+images of a roll or a batch of frames, under a lease they renew with a heartbeat while 
+processing. Tasks of workers that stop sending heartbeats become available to other workers
+once their lease expires. Leases are compared against each worker's clock, so lease 
+durations should be well above the clock offset between nodes. SQLite relies on POSIX file 
+locks, which the shared file system has to support.
+"""
+
+class Task:
+    """
+    A claimed task. payload holds the list of image files to process.
+    """
+    def __init__(self, task_id, roll, payload, attempts):
+        self.task_id  = task_id
+        self.roll     = roll
+        self.payload  = payload
+        self.attempts = attempts
+    
+    def __repr__(self):
+        return 'Task(task_id={}, roll={!r}, images={})'.format(self.task_id, self.roll, len(self.payload))
+
+
+class WorkQueue:
+    """
+    SQLite backed work queue shared by several worker processes.
+    """
+    def __init__(self, 
+                 database_file, 
+                 max_attempts = 3,
+                 timeout = 60):
+        self.database_file = database_file
+        self.max_attempts  = max_attempts
+        self.timeout       = timeout
+        pathlib.Path(database_file).parent.mkdir(parents=True, exist_ok=True)
+        connection = self._connect()
+        try:
+            connection.execute('''CREATE TABLE IF NOT EXISTS tasks (
+                                  task_id       INTEGER PRIMARY KEY,
+                                  roll          TEXT,
+                                  payload       TEXT,
+                                  status        TEXT DEFAULT 'pending',
+                                  worker        TEXT,
+                                  lease_expires REAL,
+                                  attempts      INTEGER DEFAULT 0,
+                                  result        TEXT,
+                                  error         TEXT,
+                                  updated       REAL)''')
+            connection.execute('CREATE INDEX IF NOT EXISTS status_index ON tasks (status, lease_expires)')
+        finally:
+            connection.close()
+    
+    def _connect(self):
+        # autocommit mode, transactions are opened explicitly where needed
+        connection = sqlite3.connect(self.database_file, 
+                                     timeout = self.timeout, 
+                                     isolation_level = None)
+        return connection
+    
+    def add_tasks(self, tasks):
+        """
+        Adds list of (roll, image files) tasks. Returns number of tasks added.
+        """
+        now = time.time()
+        rows = [(roll, json.dumps(list(images)), now) for roll, images in tasks]
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany('INSERT INTO tasks (roll, payload, updated) VALUES (?, ?, ?)', rows)
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        return len(rows)
+    
+    def add_images(self,
+                   image_files,
+                   frames_per_task = None,
+                   roll_from_file_name = None):
+        """
+        Shards image files by roll and adds one task per roll, or per batch of 
+        frames_per_task frames within a roll. 
+        
+        The roll defaults to the EE roll name, i.e. the file name without the 4 digit frame number.
+        """
+        if not roll_from_file_name:
+            roll_from_file_name = lambda f: pathlib.Path(f).stem[:-4]
+        
+        rolls = {}
+        for image_file in sorted(image_files):
+            image_file = pathlib.Path(image_file).as_posix()
+            rolls.setdefault(roll_from_file_name(image_file), []).append(image_file)
+        
+        tasks = []
+        for roll, images in rolls.items():
+            step = frames_per_task or len(images)
+            for i in range(0, len(images), step):
+                tasks.append((roll, images[i:i+step]))
+        return self.add_tasks(tasks)
+    
+    def claim(self, 
+              worker, 
+              lease_seconds = 300):
+        """
+        Claims the next pending task, or a task whose lease expired. Returns None if there 
+        is no task to claim.
+        
+        Tasks whose lease expired on their last allowed attempt are marked failed.
+        """
+        now = time.time()
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('''UPDATE tasks SET status = 'failed', lease_expires = NULL, updated = ?,
+                                  error = COALESCE(error, 'Lease expired on last attempt')
+                                  WHERE status = 'claimed' AND lease_expires < ? AND attempts >= ?''',
+                               (now, now, self.max_attempts))
+            row = connection.execute('''SELECT task_id, roll, payload, attempts FROM tasks
+                                        WHERE (status = 'pending' OR (status = 'claimed' AND lease_expires < ?))
+                                        AND attempts < ?
+                                        ORDER BY task_id LIMIT 1''', (now, self.max_attempts)).fetchone()
+            if row is None:
+                connection.execute('COMMIT')
+                return None
+            task_id, roll, payload, attempts = row
+            connection.execute('''UPDATE tasks SET status = 'claimed', worker = ?, lease_expires = ?, 
+                                  attempts = attempts + 1, updated = ? WHERE task_id = ?''',
+                               (worker, now + lease_seconds, now, task_id))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+        return hipp.workqueue.Task(task_id, roll, json.loads(payload), attempts + 1)
+    
+    def heartbeat(self, 
+                  task_id, 
+                  worker, 
+                  lease_seconds = 300):
+        """
+        Renews the lease on a claimed task. Returns False if the worker no longer holds the lease.
+        """
+        now = time.time()
+        connection = self._connect()
+        try:
+            cursor = connection.execute('''UPDATE tasks SET lease_expires = ?, updated = ? 
+                                           WHERE task_id = ? AND worker = ? AND status = 'claimed' ''',
+                                        (now + lease_seconds, now, task_id, worker))
+            return cursor.rowcount == 1
+        finally:
+            connection.close()
+    
+    def complete(self, 
+                 task_id, 
+                 worker, 
+                 result = None):
+        """
+        Marks task as done. Returns False if the worker no longer held the lease.
+        """
+        connection = self._connect()
+        try:
+            cursor = connection.execute('''UPDATE tasks SET status = 'done', result = ?, lease_expires = NULL, updated = ? 
+                                           WHERE task_id = ? AND worker = ? AND status = 'claimed' ''',
+                                        (json.dumps(result), time.time(), task_id, worker))
+            return cursor.rowcount == 1
+        finally:
+            connection.close()
+    
+    def fail(self, 
+             task_id, 
+             worker, 
+             error):
+        """
+        Releases a task after an error. The task is retried until max_attempts is reached.
+        """
+        connection = self._connect()
+        try:
+            connection.execute('''UPDATE tasks SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                                  error = ?, lease_expires = NULL, updated = ? 
+                                  WHERE task_id = ? AND worker = ? AND status = 'claimed' ''',
+                               (self.max_attempts, str(error), time.time(), task_id, worker))
+        finally:
+            connection.close()
+    
+    def counts(self):
+        """
+        Returns dictionary of number of tasks per status.
+        """
+        connection = self._connect()
+        try:
+            rows = connection.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        finally:
+            connection.close()
+        return dict(rows)
+    
+    def is_finished(self):
+        """
+        True once no task is pending or claimed anymore, including tasks with expired leases
+        that exhausted their attempts.
+        """
+        now = time.time()
+        connection = self._connect()
+        try:
+            row = connection.execute('''SELECT COUNT(*) FROM tasks 
+                                        WHERE status = 'pending' 
+                                        OR (status = 'claimed' AND (lease_expires >= ? OR attempts < ?))''',
+                                     (now, self.max_attempts)).fetchone()
+        finally:
+            connection.close()
+        return row[0] == 0
+    
+    def to_dataframe(self):
+        connection = self._connect()
+        try:
+            df = pd.read_sql_query('SELECT * FROM tasks ORDER BY task_id', connection)
+        finally:
+            connection.close()
+        return df
+
+
+def default_worker_id():
+    return socket.gethostname() + ':' + str(os.getpid())
+
+def run_worker(database_file,
+               function,
+               worker = None,
+               lease_seconds = 300,
+               heartbeat_interval = None,
+               poll_interval = 5,
+               max_attempts = 3,
+               verbose = True):
+    """
+    Claims and processes tasks until the queue is finished.
+    
+    function is called with a hipp.workqueue.Task and returns a json serializable result, 
+    which is stored with the task. Exceptions mark the task as failed for this attempt.
+    The lease is renewed every heartbeat_interval seconds, by default a third of lease_seconds.
+    
+    Returns list of processed task ids.
+    """
+    worker = worker or hipp.workqueue.default_worker_id()
+    heartbeat_interval = heartbeat_interval or lease_seconds / 3
+    queue = hipp.workqueue.WorkQueue(database_file, max_attempts=max_attempts)
+    processed = []
+    
+    while True:
+        task = queue.claim(worker, lease_seconds=lease_seconds)
+        if task is None:
+            if queue.is_finished():
+                break
+            # other workers hold leases that may still expire
+            time.sleep(poll_interval)
+            continue
+        
+        if verbose:
+            print(worker, 'claimed', task)
+        
+        stop = threading.Event()
+        def heartbeat():
+            while not stop.wait(heartbeat_interval):
+                if not queue.heartbeat(task.task_id, worker, lease_seconds=lease_seconds):
+                    print('WARNING:', worker, 'lost lease on', task)
+                    return
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        
+        try:
+            result = function(task)
+        except Exception as e:
+            stop.set()
+            thread.join()
+            print('WARNING:', worker, 'failed on', task, '-', repr(e))
+            queue.fail(task.task_id, worker, repr(e))
+            continue
+        
+        stop.set()
+        thread.join()
+        if queue.complete(task.task_id, worker, result):
+            processed.append(task.task_id)
+        elif verbose:
+            print('WARNING:', worker, 'completed', task, 'after losing its lease')
+    
+    return processed
+
+def preprocess_roll_with_fiducial_proxies(task,
+                                          template_directory,
+                                          results_directory,
+                                          output_directory = 'input_data/cropped_images',
+                                          buffer_distance = 250,
+                                          threshold_px = 50,
+                                          missing_proxy = None,
+                                          stretch_histogram = True,
+                                          clahe_enhancement = True,
+                                          qc_plots = False,
+                                          qc_plots_output_directory = 'qc/proxy_detection'):
+    """
+    Task function for hipp.workqueue.run_worker() that preprocesses the images of one roll
+    with hipp.batch.schedule_roll_preprocessing(), matching templates by roll name.
+    
+    Appends the roll's results to a hipp.io.ResultsStore in results_directory on the shared 
+    file system and returns the final square image dimensions. Tasks must hold complete rolls, as crop
+    parameters are derived from statistics over the roll. Tasks holding part of a roll, added with 
+    frames_per_task, raise ValueError, as do tasks without results for their roll.
+    """
+    images = [pathlib.Path(i) for i in task.payload]
+    roll_images = [i for i in images[0].parent.glob('*' + images[0].suffix) if i.stem[:-4] == task.roll]
+    missing = set(i.as_posix() for i in roll_images) - set(i.as_posix() for i in images)
+    if missing:
+        raise ValueError('Task holds ' + str(len(images)) + ' of ' + str(len(images) + len(missing)) + 
+                         ' images of roll ' + task.roll + '. Add complete rolls without frames_per_task.')
+    roll_templates = hipp.batch.find_roll_template_directories(images, template_directory)
+    roll_templates = {r: v for r, v in roll_templates.items() if r == task.roll}
+    
+    results, failed = hipp.batch.schedule_roll_preprocessing(roll_templates,
+                                                             buffer_distance = buffer_distance,
+                                                             threshold_px = threshold_px,
+                                                             stretch_histogram = stretch_histogram,
+                                                             clahe_enhancement = clahe_enhancement,
+                                                             output_directory = output_directory,
+                                                             verbose = False,
+                                                             missing_proxy = missing_proxy,
+                                                             qc_plots = qc_plots,
+                                                             qc_plots_output_directory = qc_plots_output_directory)
+    if task.roll in failed:
+        raise RuntimeError(failed[task.roll])
+    
+    result = results.get(task.roll)
+    if result is None:
+        raise ValueError('No results for roll ' + str(task.roll) + '. Check that its images and templates exist.')
+    hipp.io.ResultsStore(results_directory).append_roll(task.roll,
+                                                        result['detected_df'],
+                                                        result['proxy_locations_df'],
+                                                        result['principal_points'],
+                                                        result['distances'],
+                                                        result['intersection_angles'],
+                                                        result['image_square_dim'])
+    
+    return {'image_square_dim' : result['image_square_dim']}
@@ -0,0 +1,91 @@
+import os
+import threading
+
+import pytest
+
+import hipp.batch
+import hipp.core
+import hipp.qc
+
+
+def test_failed_roll_does_not_stop_other_rolls(synthetic_rolls, tmp_path, monkeypatch):
+    image_files, template_directory = synthetic_rolls(['AR1ROLLA001', 'AR1ROLLB002'])
+    with open(image_files[-1], 'wb') as f:
+        f.write(b'not a tiff')
+
+    events = []
+    lock = threading.Lock()
+    def record(stage, function):
+        def wrapper(*args, **kwargs):
+            image_file = args[0] if stage == 'detect' else args[0][0]
+            with lock:
+                events.append((stage, os.path.basename(image_file)))
+            return function(*args, **kwargs)
+        return wrapper
+    monkeypatch.setattr(hipp.core, 'detect_fiducial_proxies',
+                        record('detect', hipp.core.detect_fiducial_proxies))
+    monkeypatch.setattr(hipp.core, 'crop_image_from_file',
+                        record('crop', hipp.core.crop_image_from_file))
+
+    progress_bars = []
+    class tqdm(hipp.batch.batch.tqdm):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            progress_bars.append(self)
+    monkeypatch.setattr(hipp.batch.batch, 'tqdm', tqdm)
+
+    roll_templates = hipp.batch.find_roll_template_directories(image_files, template_directory)
+    results, failed = hipp.batch.schedule_roll_preprocessing(roll_templates,
+                                                             buffer_distance = 100,
+                                                             output_directory = str(tmp_path / 'cropped'),
+                                                             qc_plots = False,
+                                                             verbose = False,
+                                                             max_workers = 1)
+
+    assert list(results) == ['AR1ROLLA001']
+    assert list(failed) == ['AR1ROLLB002']
+    assert 'AR1ROLLB0020003.tif' in failed['AR1ROLLB002']
+    assert sorted(os.listdir(tmp_path / 'cropped')) == [os.path.basename(f) for f in image_files[:4]]
+
+    # cropping of the first roll is prioritized over detection in the second roll
+    first_crop = events.index(('crop', 'AR1ROLLA0010000.tif'))
+    assert first_crop < events.index(('detect', 'AR1ROLLB0020003.tif'))
+    assert all(stage == 'detect' for stage, f in events[:first_crop])
+    # the progress bar completes without the skipped crops of the failed roll
+    assert progress_bars[0].n == progress_bars[0].total == 12
+
+def test_roll_without_templates_is_reported(synthetic_rolls, tmp_path):
+    image_files, template_directory = synthetic_rolls(['AR1ROLLA001'], n = 2)
+    roll_templates = hipp.batch.find_roll_template_directories(image_files, template_directory)
+    roll_templates['AR1ROLLC003'] = ([image_files[0]], None)
+
+    results, failed = hipp.batch.schedule_roll_preprocessing(roll_templates,
+                                                             buffer_distance = 100,
+                                                             output_directory = str(tmp_path / 'cropped'),
+                                                             qc_plots = False,
+                                                             verbose = False)
+
+    assert list(results) == ['AR1ROLLA001']
+    assert list(failed) == ['AR1ROLLC003']
+    assert results['AR1ROLLA001']['image_square_dim'] > 0
+
+
+def test_duplicate_index_requires_triage(tmp_path):
+    with pytest.raises(ValueError):
+        hipp.batch.preprocess_with_fiducial_proxies(str(tmp_path),
+                                                    str(tmp_path),
+                                                    duplicate_index = hipp.qc.DuplicateIndex())
+
+def test_failed_directory_is_reported(synthetic_rolls, tmp_path, monkeypatch):
+    image_files, template_directory = synthetic_rolls(['AR1ROLLA001'], n = 2)
+    def compute_proxy_crop_parameters(*args, **kwargs):
+        raise ValueError('Could not compute distance between any fiducial proxies and principal point.')
+    monkeypatch.setattr(hipp.batch, 'compute_proxy_crop_parameters', compute_proxy_crop_parameters)
+
+    assert hipp.batch.preprocess_with_fiducial_proxies(os.path.dirname(image_files[0]),
+                                                       os.path.join(template_directory, 'AR1ROLLA001'),
+                                                       buffer_distance = 100,
+                                                       output_directory = str(tmp_path / 'cropped'),
+                                                       qc_df = False,
+                                                       qc_plots = False,
+                                                       verbose = False) is None
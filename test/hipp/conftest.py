@@ -0,0 +1,56 @@
+import cv2
+import numpy as np
+import pytest
+
+import hipp.core
+import hipp.image
+
+
+FRAME_SHAPE = (500, 540)
+
+def synthetic_frame(rng, shift = (0, 0)):
+    """
+    Frame with a dark border and a bright notch at the midside of each edge, offset by shift.
+    """
+    H, W = FRAME_SHAPE
+    image = rng.normal(120, 10, (H, W)).clip(0, 255).astype(np.uint8)
+    image[:, :20] = image[:, -20:] = image[:20] = image[-20:] = 10
+    cy, cx = H//2 + shift[0], W//2 + shift[1]
+    image[cy-20:cy+20, 20:55] = 240
+    image[20:55, cx-20:cx+20] = 240
+    image[cy-20:cy+20, W-55:W-20] = 240
+    image[H-55:H-20, cx-20:cx+20] = 240
+    return image
+
+@pytest.fixture
+def synthetic_rolls(tmp_path):
+    """
+    Writes n frames per roll to tmp_path/raw and a template set per roll, matching the roll
+    name, to tmp_path/templates. Returns the sorted image files and the template directory.
+    """
+    def write(rolls, n = 4, buffer_distance = 100, seed = 0):
+        rng = np.random.default_rng(seed)
+        H, W = FRAME_SHAPE
+        B = buffer_distance
+        (tmp_path / 'raw').mkdir(exist_ok=True)
+        image_files = []
+        for roll in rolls:
+            for i in range(n):
+                image_file = str(tmp_path / 'raw' / '{}{:04d}.tif'.format(roll, i))
+                cv2.imwrite(image_file, synthetic_frame(rng, rng.integers(-4, 4, 2)))
+                image_files.append(image_file)
+        
+        image = hipp.image.img_linear_stretch(hipp.image.clahe_equalize_image(synthetic_frame(rng)))
+        image = hipp.core.pad_image(image, B)
+        cy, cx = H//2 + B, W//2 + B
+        templates = {'L': image[cy-60:cy+60, B:B+70],
+                     'T': image[B:B+70, cx-60:cx+60],
+                     'R': image[cy-60:cy+60, B+W-70:B+W],
+                     'B': image[B+H-70:B+H, cx-60:cx+60]}
+        for roll in rolls:
+            template_directory = tmp_path / 'templates' / roll
+            template_directory.mkdir(parents=True, exist_ok=True)
+            for name, template in templates.items():
+                cv2.imwrite(str(template_directory / (name + '.tif')), template)
+        return sorted(image_files), str(tmp_path / 'templates')
+    return write
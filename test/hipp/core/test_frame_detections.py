@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+import hipp.core
+
+
+def detections_df():
+    return pd.DataFrame({'match_locations': [[(10., 20.), (30., 40.), (50., 60.), (70., 80.)],
+                                             [(11., 21.), None,       (51., 61.), (71., 81.)],
+                                             [(12., 22.), (32., 42.), (52., 62.), (72., 82.)]],
+                         'scores':          [[0.9, 0.8, 0.7, 0.6]] * 3,
+                         'file_names':      ['AR1ROLLA0010001.tif',
+                                             'AR1ROLLA0010002.tif',
+                                             'AR1ROLLB0020001.tif']})
+
+def test_round_trip_through_dataframes():
+    detections = hipp.core.FrameDetections.from_dataframe(detections_df())
+
+    assert detections.locations.shape == (3, 4, 2)
+    assert detections.locations.dtype == np.float32
+    assert np.isnan(detections.locations[1, 1]).all()
+    assert list(detections.roll_names) == ['AR1ROLLA001', 'AR1ROLLB002']
+
+    split_df = detections.to_split_dataframe()
+    assert list(split_df.columns) == ['file_names', 'left_y', 'left_x', 'top_y', 'top_x',
+                                      'right_y', 'right_x', 'bottom_y', 'bottom_x']
+    assert np.shares_memory(split_df['left_y'].to_numpy(), detections.locations)
+
+    restored = hipp.core.FrameDetections.from_split_dataframe(split_df)
+    assert np.array_equal(restored.locations, detections.locations, equal_nan=True)
+    assert detections.to_dataframe()['match_locations'][2] == detections_df()['match_locations'][2]
+
+def test_select_by_roll_and_file_name():
+    detections = hipp.core.FrameDetections.from_dataframe(detections_df())
+
+    assert len(detections.roll('AR1ROLLA001')) == 2
+    assert detections.index('AR1ROLLB0020001.tif') == 2
+    assert [(roll, len(d)) for roll, d in detections.iter_rolls()] == [('AR1ROLLA001', 2), ('AR1ROLLB002', 1)]
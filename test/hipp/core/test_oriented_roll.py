@@ -0,0 +1,69 @@
+import cv2
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+import hipp.batch
+import hipp.core
+import hipp.io
+
+hipp_tools = pytest.importorskip('hipp.tools')
+
+
+def pick_innermost_points(image_file, point_count = 4):
+    """
+    Picks the innermost point of the bright notch at each edge, from left to bottom, in the
+    raster shown by the point picker.
+    """
+    da = hipp.tools.read_raster(image_file)
+    H, W = da.shape
+    ys, xs = np.nonzero(da.values > 200)
+    y, x = da.y.values[ys], da.x.values[xs]
+    regions = [x < W/4, y < H/4, x > 3*W/4, y > 3*H/4]
+    points = [(x[regions[0]].max(),  y[regions[0]].mean()),
+              (x[regions[1]].mean(), y[regions[1]].max()),
+              (x[regions[2]].min(),  y[regions[2]].mean()),
+              (x[regions[3]].mean(), y[regions[3]].min())]
+    return pd.DataFrame(points[:point_count], columns = ['x', 'y'])
+
+def preprocess(image_directory, tmp_path, name):
+    template_directory = str(tmp_path / name / 'templates')
+    hipp.core.create_midside_fiducial_proxies_template(sorted(image_directory.glob('*.tif'))[0],
+                                                       output_directory = template_directory,
+                                                       buffer_distance = 40,
+                                                       threshold = 255)
+    output_directory = tmp_path / name / 'cropped'
+    image_square_dim = hipp.batch.preprocess_with_fiducial_proxies(str(image_directory),
+                                                                   template_directory,
+                                                                   buffer_distance = 100,
+                                                                   output_directory = str(output_directory),
+                                                                   qc_df = False,
+                                                                   qc_plots = False,
+                                                                   verbose = False)
+    return image_square_dim, sorted(output_directory.glob('*.tif'))
+
+def test_templates_and_crops_follow_manifest_orientation(synthetic_rolls, tmp_path, monkeypatch):
+    monkeypatch.setattr(hipp.tools, 'point_picker', pick_innermost_points)
+    image_files, _ = synthetic_rolls(['AR1ROLLA001'])
+    displayed = tmp_path / 'raw'
+    stored = tmp_path / 'stored'
+    stored.mkdir()
+    for image_file in image_files:
+        image_array = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+        name = os.path.basename(image_file)
+        # stored so that orientation 6 displays image_array
+        cv2.imwrite(str(stored / name), np.ascontiguousarray(image_array[:, ::-1].swapaxes(0, 1)))
+        hipp.io.write_image_manifest(str(stored), {name : {'orientation' : 6, 'invert' : False}})
+    assert hipp.io.read_image_shape(str(stored / name)) == image_array.shape
+    # exceeds the bottom of the displayed frame only
+    H, W = image_array.shape
+    assert hipp.core.validate_square_dim([str(stored / name)], 100, [(H - 50, W // 2)], 500) == 450
+
+    expected_dim, expected_files = preprocess(displayed, tmp_path, 'expected')
+    image_square_dim, cropped_files = preprocess(stored, tmp_path, 'oriented')
+
+    assert image_square_dim == expected_dim
+    assert len(cropped_files) == 4
+    for expected_file, cropped_file in zip(expected_files, cropped_files):
+        assert np.array_equal(cv2.imread(str(cropped_file)), cv2.imread(str(expected_file)))
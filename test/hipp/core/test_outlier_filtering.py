@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+import hipp.core
+
+
+def detections(locations, rolls):
+    return pd.DataFrame({'match_locations': [[tuple(p) for p in image] for image in locations],
+                         'file_names': ['AR1ROLL{}001{:04d}.tif'.format(roll, i) for i, roll in enumerate(rolls)]})
+
+def test_offset_proxies_match_per_cell_threshold():
+    rng = np.random.default_rng(0)
+    locations = rng.normal(1000, 40, (300, 4, 2))
+    locations[rng.random((300, 4, 2)) < 0.01] = np.nan
+    df = hipp.core.nan_offset_fiducial_proxies(detections(locations, ['A'] * 300))
+
+    expected = locations.reshape(-1, 8).copy()
+    for i in range(8):
+        offsets = expected[:, i] - np.median(locations.reshape(-1, 8)[:, i])
+        expected[np.abs(offsets) > 50, i] = np.nan
+    assert np.array_equal(df.iloc[:, 1:].values, expected, equal_nan=True)
+
+def test_offset_proxies_grouped_by_roll():
+    locations = np.full((6, 4, 2), 1000.)
+    locations[3:] += 200
+    locations[1, 0, 0] += 20
+    df = detections(locations, ['A'] * 3 + ['B'] * 3)
+
+    # median of the two rolls combined is offset from both
+    assert hipp.core.nan_offset_fiducial_proxies(df).iloc[:, 1:].isna().all().all()
+    assert not hipp.core.nan_offset_fiducial_proxies(df, group_by_roll = True).iloc[:, 1:].isna().any().any()
+
+    mask = hipp.core.nan_offset_fiducial_proxies(df,
+                                                 method = 'mad',
+                                                 min_offset_px = 5,
+                                                 group_by_roll = True).iloc[:, 1:].isna().values
+    assert mask.sum() == 1
+    assert mask[1, 0]
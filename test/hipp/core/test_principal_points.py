@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+import hipp.core
+
+
+def random_proxy_locations(seed, n = 2000):
+    rng = np.random.default_rng(seed)
+    locations = rng.normal(1000, 300, (n, 8)).round(1)
+    locations[rng.random((n, 8)) < 0.3] = np.nan
+    return locations
+
+def test_proxy_array_matches_per_image_estimate():
+    keys = ['left_y','left_x','top_y','top_x','right_y','right_x','bottom_y','bottom_x']
+    locations = random_proxy_locations(7)
+    df = pd.DataFrame(locations, columns=keys)
+
+    principal_points, distances, intersection_angles = \
+        hipp.core.compute_principal_points_from_proxy_array(locations.reshape(-1,4,2))
+
+    with np.errstate(all='ignore'):
+        for i, row in df.iterrows():
+            principal_point, row_distances, intersection_angle = \
+                hipp.core.estimate_principal_point_from_proxies(row)
+            assert np.array_equal(np.array(principal_point, dtype=float), principal_points[i], equal_nan=True)
+            assert np.array_equal(np.array(row_distances, dtype=float), distances[i], equal_nan=True)
+            # np.arctan may differ from math.atan in the last digit
+            assert np.allclose(np.array([intersection_angle], dtype=float), intersection_angles[i:i+1],
+                               rtol=1e-12, atol=0, equal_nan=True)
+
+def test_fiducial_array_matches_per_image_estimate():
+    rng = np.random.default_rng(1)
+    locations = rng.normal(1000, 300, (500, 4, 2)).round(2)
+    scores = rng.random((500, 4)) * 0.05 + 0.9
+    fiducial_locations_df = pd.DataFrame([[tuple(p) for p in image] for image in locations])
+    quality_scores_df = pd.DataFrame(scores)
+
+    principal_points_df = hipp.core.compute_principal_points(fiducial_locations_df, quality_scores_df)
+
+    median_scores = [quality_scores_df.iloc[:,i].median() for i in range(4)]
+    for i in range(len(locations)):
+        principal_point = hipp.core.compute_principal_point(fiducial_locations_df.iloc[i].values,
+                                                            quality_scores_df.iloc[i].values,
+                                                            median_scores)
+        assert principal_points_df.principal_point.iloc[i] == principal_point
@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+
+import hipp.batch
+import hipp.core
+
+
+def detection(location, file_name):
+    return [tuple(p) for p in np.reshape(location, (4, 2))], None, file_name
+
+def test_running_statistics_match_batch():
+    rng = np.random.default_rng(3)
+    locations = rng.normal([300, 20, 20, 300, 300, 580, 580, 300], 3, (200, 8)).round(1)
+    locations[rng.random((200, 8)) < 0.01] += 200
+    locations[150, 0] = np.nan
+
+    statistics = hipp.core.StreamingRollStatistics()
+    for i, location in enumerate(locations):
+        statistics.add(detection(location, str(i)))
+        if i % 25 == 0 or i == len(locations) - 1:
+            medians = np.median(locations[:i+1], axis=0)
+            assert np.array_equal(statistics.medians(), medians, equal_nan=True)
+
+            filtered = locations[:i+1].copy()
+            with np.errstate(invalid='ignore'):
+                filtered[np.abs(filtered - medians) > 50] = np.nan
+            assert np.array_equal(statistics.proxy_locations(), filtered, equal_nan=True)
+            _, distances, _ = hipp.core.compute_principal_points_from_proxy_array(filtered.reshape(-1, 4, 2))
+            assert statistics.minimum_distance() == np.nanmin(distances)
+
+def test_square_dim_committed_once_stable():
+    statistics = hipp.core.StreamingRollStatistics(min_samples = 3)
+    location = np.array([300, 20, 20, 300, 300, 580, 600, 300], dtype=float)
+    # left/right distance shrinks over the first frames
+    for i, right_x in enumerate([590, 588, 586, 584, 584, 584, 584]):
+        statistics.add(detection(np.where(np.arange(8) == 5, right_x, location), str(i)))
+        assert statistics.crop_parameters(str(i)) is None
+        assert statistics.image_square_dim is None
+
+    statistics.add(detection(np.where(np.arange(8) == 5, 584, location), '7'))
+    principal_point, image_square_dim = statistics.crop_parameters('7')
+    assert image_square_dim == 564
+    assert principal_point == (305, 301)
+
+    # committed dimensions are kept for the rest of the roll
+    statistics.add(detection(np.where(np.arange(8) == 5, 570, location), '8'))
+    assert statistics.crop_parameters('8')[1] == 564
+
+def test_only_changed_frames_are_recropped(synthetic_rolls, tmp_path, monkeypatch):
+    image_files, template_directory = synthetic_rolls(['AR1ROLLA001', 'AR1ROLLB002'], n = 8)
+
+    crops = []
+    crop_image_from_file = hipp.core.crop_image_from_file
+    def record(*args, **kwargs):
+        crops.append(os.path.basename(args[0][0]))
+        return crop_image_from_file(*args, **kwargs)
+    monkeypatch.setattr(hipp.core, 'crop_image_from_file', record)
+
+    def preprocess(output_directory, streaming_statistics):
+        roll_templates = hipp.batch.find_roll_template_directories(image_files, template_directory)
+        return hipp.batch.schedule_roll_preprocessing(roll_templates,
+                                                      buffer_distance = 100,
+                                                      output_directory = str(tmp_path / output_directory),
+                                                      qc_plots = False,
+                                                      verbose = False,
+                                                      max_workers = 1,
+                                                      streaming_statistics = streaming_statistics,
+                                                      streaming_min_samples = 3)
+
+    # provisional principal points of two frames of roll B are off by a pixel
+    changed = ['AR1ROLLB0020005.tif', 'AR1ROLLB0020006.tif']
+    crop_parameters = hipp.core.StreamingRollStatistics.crop_parameters
+    def provisional_crop_parameters(self, file_name, require_stable=True):
+        result = crop_parameters(self, file_name, require_stable = require_stable)
+        if result and os.path.basename(file_name) in changed:
+            (y, x), image_square_dim = result
+            result = (y + 1, x), image_square_dim
+        return result
+    monkeypatch.setattr(hipp.core.StreamingRollStatistics, 'crop_parameters', provisional_crop_parameters)
+
+    results, failed = preprocess('streaming', True)
+    streaming_crops = crops[:]
+    del crops[:]
+    preprocess('batch', False)
+
+    assert not failed
+    assert len(streaming_crops) == 16 + len(changed)
+    assert sorted(f for f in set(streaming_crops) if streaming_crops.count(f) > 1) == changed
+    assert sorted(os.listdir(tmp_path / 'streaming')) == [os.path.basename(f) for f in image_files]
+    for f in os.listdir(tmp_path / 'batch'):
+        assert open(tmp_path / 'batch' / f, 'rb').read() == open(tmp_path / 'streaming' / f, 'rb').read()
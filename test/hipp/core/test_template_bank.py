@@ -0,0 +1,24 @@
+import os
+
+import hipp.core
+
+
+def test_templates_are_loaded_once_and_matched_by_roll(synthetic_rolls, tmp_path, monkeypatch):
+    image_files, template_directory = synthetic_rolls(['AR1ROLLA001', 'AR1ROLLB002'], n = 1)
+
+    loaded = []
+    load = hipp.core.load_midside_fiducial_proxy_templates
+    def record(template_directory):
+        loaded.append(os.path.basename(template_directory))
+        return load(template_directory)
+    monkeypatch.setattr(hipp.core, 'load_midside_fiducial_proxy_templates', record)
+
+    bank = hipp.core.TemplateBank(template_directory)
+    templates = bank.for_roll('AR1ROLLB002')
+
+    assert len(templates) == 4
+    assert bank.for_roll('AR1ROLLB002') is templates
+    assert bank.get(os.path.join(template_directory, 'AR1ROLLB002')) is templates
+    assert bank.for_roll('AR1ROLLC003') is None
+    assert loaded == ['AR1ROLLB002']
+    assert [os.path.basename(t) for t in bank.template_sets()] == ['AR1ROLLA001', 'AR1ROLLB002']
@@ -0,0 +1,49 @@
+import cv2
+import json
+import numpy as np
+
+import hipp.core
+
+
+def write_roll(directory, roll, n = 4):
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        image = rng.normal(120, 10, (400, 400)).clip(0, 255).astype(np.uint8)
+        image[170:230, 20:60] = 240
+        image[20:60, 170:230] = 240
+        image[170:230, 340:380] = 240
+        image[340:380, 170:230] = 240
+        cv2.imwrite(str(directory / '{}{:04d}.tif'.format(roll, i)), image)
+
+def write_template_set(directory, notch):
+    directory.mkdir(parents=True)
+    for name, shape in zip(['L', 'T', 'R', 'B'], [(80, 40), (40, 80), (80, 40), (40, 80)]):
+        template = np.full(shape, 10, dtype=np.uint8)
+        if notch:
+            template[10:-10, 10:-10] = 240
+        else:
+            template[::4] = 240
+        cv2.imwrite(str(directory / (name + '.tif')), template)
+
+def test_selects_best_template_set_and_caches_decision(tmp_path):
+    write_roll(tmp_path, 'AR1ROLLC003')
+    write_template_set(tmp_path / 'templates' / 'notch', notch = True)
+    write_template_set(tmp_path / 'templates' / 'stripes', notch = False)
+    cache_file = str(tmp_path / 'selection.json')
+
+    selector = hipp.core.TemplateSelector(str(tmp_path / 'templates'),
+                                          cache_file = cache_file,
+                                          downsample = 2,
+                                          buffer_distance = 100,
+                                          verbose = False)
+    images = sorted(tmp_path.glob('*.tif'))
+    template_dir = selector.select('AR1ROLLC003', images)
+
+    assert template_dir.endswith('templates/notch')
+    assert len(selector.sample_frames(images)) == 3
+    with open(cache_file) as f:
+        assert json.load(f)['AR1ROLLC003']['template_directory'] == template_dir
+
+    # decision is reused without reading images
+    cached = hipp.core.TemplateSelector(str(tmp_path / 'templates'), cache_file = cache_file)
+    assert cached.select('AR1ROLLC003', []) == template_dir
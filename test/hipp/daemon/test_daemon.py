@@ -0,0 +1,54 @@
+import os
+import shutil
+import threading
+import time
+
+import hipp.daemon
+
+
+def test_watch_folder_processes_new_images(synthetic_rolls, tmp_path):
+    image_files, template_directory = synthetic_rolls(['AR1ROLLA001'], n = 6)
+    watch_directory = tmp_path / 'watch'
+    watch_directory.mkdir()
+    # template set without template files
+    os.makedirs(os.path.join(template_directory, 'AR1ROLLD004'))
+
+    daemon = hipp.daemon.WatchFolderDaemon(str(watch_directory),
+                                           template_directory,
+                                           output_directory = str(tmp_path / 'cropped'),
+                                           EE_find_matching_template = True,
+                                           buffer_distance = 100,
+                                           min_samples = 2,
+                                           poll_interval = 0.05,
+                                           log_file = str(tmp_path / 'log.csv'),
+                                           verbose = False)
+    stop_event = threading.Event()
+    thread = threading.Thread(target = daemon.run, kwargs = {'stop_event': stop_event})
+    thread.start()
+    try:
+        for image_file in image_files:
+            shutil.copy(image_file, watch_directory)
+        with open(watch_directory / 'AR1ROLLA0010099.tif', 'wb') as f:
+            f.write(b'not a tiff')
+        # no template set for this roll
+        shutil.copy(image_files[0], watch_directory / 'AR1ROLLC0030000.tif')
+        shutil.copy(image_files[0], watch_directory / 'AR1ROLLD0040000.tif')
+
+        deadline = time.time() + 30
+        while len(daemon.results) + len(daemon.failed) < 9 and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop_event.set()
+        thread.join()
+
+    results_df = daemon.results_df()
+    assert sorted(os.path.basename(f) for f in results_df['file_name']) == \
+           [os.path.basename(f) for f in image_files]
+    assert sorted(os.listdir(tmp_path / 'cropped')) == [os.path.basename(f) for f in image_files]
+    assert results_df['image_square_dim'].nunique() == 1
+    assert sorted(os.path.basename(f) for f in daemon.failed) == ['AR1ROLLA0010099.tif',
+                                                                  'AR1ROLLC0030000.tif',
+                                                                  'AR1ROLLD0040000.tif']
+    assert 'No matching templates' in daemon.failed[(watch_directory / 'AR1ROLLC0030000.tif').as_posix()]
+    assert 'L.tif' in daemon.failed[(watch_directory / 'AR1ROLLD0040000.tif').as_posix()]
+    assert len(open(tmp_path / 'log.csv').readlines()) == 7
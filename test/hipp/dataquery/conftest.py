@@ -0,0 +1,79 @@
+import http.server
+import json
+import threading
+
+import pytest
+
+
+class MockM2M:
+    """
+    Mock EarthExplorer M2M API. Endpoints are served by functions in handlers, taking the
+    request payload and returning the response data. Files are served at url + name.
+    """
+    def __init__(self):
+        self.requests = []
+        self.handlers = {}
+        self.api_keys = set()
+        self.logins   = 0
+        self.failures = {}
+        self.files    = {}
+        self.lock     = threading.Lock()
+        self.handlers['login'] = self.login
+
+    def login(self, payload):
+        self.logins += 1
+        api_key = 'key-{}'.format(self.logins)
+        self.api_keys.add(api_key)
+        return api_key
+
+    def expire_api_keys(self):
+        self.api_keys.clear()
+
+    def respond(self, endpoint, api_key, payload):
+        with self.lock:
+            self.requests.append((endpoint, api_key, payload))
+            if self.failures.get(endpoint):
+                self.failures[endpoint] -= 1
+                return 503, None
+            if endpoint != 'login' and api_key not in self.api_keys:
+                return 200, {'data': None, 'errorCode': 'AUTH_KEY_INVALID', 'errorMessage': 'expired'}
+            if endpoint not in self.handlers:
+                return 404, None
+        return 200, {'data': self.handlers[endpoint](payload), 'errorCode': None, 'errorMessage': None}
+
+
+@pytest.fixture
+def m2m():
+    mock = MockM2M()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            status, body = mock.respond(self.path.strip('/'), self.headers.get('X-Auth-Token'), payload)
+            body = json.dumps(body).encode() if body else b''
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            with mock.lock:
+                mock.requests.append(('GET', None, self.path))
+            body = mock.files.get(self.path.strip('/'))
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    mock.url = 'http://127.0.0.1:{}/'.format(httpd.server_address[1])
+    yield mock
+    httpd.shutdown()
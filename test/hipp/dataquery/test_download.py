@@ -0,0 +1,135 @@
+import gzip
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+
+import hipp.dataquery
+
+
+DATA = os.urandom(300000)
+GZ   = gzip.compress(DATA)
+# two gzip members, as written by concatenating gzip files
+MULTI_MEMBER_GZ = gzip.compress(DATA[:100000]) + gzip.compress(DATA[100000:])
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves DATA with Range support. The first response per path is cut off halfway.
+    Paths ending in .gz are served gzip compressed, except /corrupt.tif.gz, and 
+    /multi.tif.gz in two gzip members.
+    """
+    requests = []
+    
+    def do_GET(self):
+        RangeHandler.requests.append((self.path, self.headers.get('Range')))
+        if self.path == '/missing.tif':
+            self.send_error(404)
+            return
+        data = GZ if self.path.endswith('.gz') and self.path != '/corrupt.tif.gz' else DATA
+        if self.path == '/multi.tif.gz':
+            data = MULTI_MEMBER_GZ
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data)-1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        if [p for p, r in RangeHandler.requests].count(self.path) == 1:
+            self.wfile.write(data[start:len(data)//2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+    
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    RangeHandler.requests = []
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    httpd.shutdown()
+
+def test_resumes_dropped_download(server, tmp_path):
+    engine = hipp.dataquery.DownloadEngine(backoff = 0, chunk_size = 10000)
+    output_file = str(tmp_path / 'image.tif')
+    engine.download(server + '/image.tif', output_file, checksum = hashlib.md5(DATA).hexdigest())
+
+    assert open(output_file, 'rb').read() == DATA
+    assert not os.path.exists(output_file + '.part')
+    assert RangeHandler.requests == [('/image.tif', None), ('/image.tif', 'bytes=150000-')]
+
+def test_decompresses_gzip_stream(server, tmp_path):
+    engine = hipp.dataquery.DownloadEngine(backoff = 0, chunk_size = 10000)
+    output_file = hipp.dataquery.download_image(str(tmp_path),
+                                                (server + '/image.tif.gz', 'image.tif.gz'),
+                                                engine = engine,
+                                                checksum = hashlib.md5(GZ).hexdigest(),
+                                                decompress = True)
+
+    assert os.path.basename(output_file) == 'image.tif'
+    assert open(output_file, 'rb').read() == DATA
+    assert os.listdir(tmp_path) == ['image.tif']
+    # interrupted gzip stream is downloaded again from the start
+    assert RangeHandler.requests == [('/image.tif.gz', None), ('/image.tif.gz', None)]
+
+def test_decompresses_all_gzip_members(server, tmp_path):
+    engine = hipp.dataquery.DownloadEngine(backoff = 0, chunk_size = 10000)
+    output_file = hipp.dataquery.download_image(str(tmp_path),
+                                                (server + '/multi.tif.gz', 'multi.tif.gz'),
+                                                engine = engine,
+                                                checksum = hashlib.md5(MULTI_MEMBER_GZ).hexdigest(),
+                                                decompress = True)
+
+    assert open(output_file, 'rb').read() == DATA
+
+def test_corrupt_gzip_stream_not_retried(server, tmp_path):
+    engine = hipp.dataquery.DownloadEngine(backoff = 0, chunk_size = 10000)
+    with pytest.raises(hipp.dataquery.DecompressionError):
+        hipp.dataquery.download_image(str(tmp_path),
+                                      (server + '/corrupt.tif.gz', 'corrupt.tif.gz'),
+                                      engine = engine,
+                                      decompress = True)
+
+    assert os.listdir(tmp_path) == []
+    assert RangeHandler.requests == [('/corrupt.tif.gz', None)]
+
+def test_checksum_mismatch_and_client_errors(server, tmp_path):
+    engine = hipp.dataquery.DownloadEngine(backoff = 0, retries = 2)
+    output_file = str(tmp_path / 'image.tif')
+    with pytest.raises(hipp.dataquery.DownloadError):
+        engine.download(server + '/image.tif', output_file, checksum = 'd41d8cd98f00b204e9800998ecf8427e')
+    assert not os.path.exists(output_file)
+
+    RangeHandler.requests = []
+    with pytest.raises(hipp.dataquery.requests.exceptions.HTTPError):
+        engine.download(server + '/missing.tif', str(tmp_path / 'missing.tif'))
+    assert len(RangeHandler.requests) == 1
+
+def test_thread_downloads(server, tmp_path):
+    urls = [server + '/{}.tif'.format(i) for i in range(4)] + [server + '/missing.tif']
+    file_names = ['image_{}'.format(i) for i in range(5)]
+    results = hipp.dataquery.thread_downloads(str(tmp_path), urls, file_names, max_workers = 2,
+                                              engine = hipp.dataquery.DownloadEngine(backoff = 0))
+
+    assert sorted(os.path.basename(f) for f in results) == ['image_{}.tif'.format(i) for i in range(4)]
+    assert all(open(f, 'rb').read() == DATA for f in results)
+
+def test_thread_downloads_decompresses_only_gzip(server, tmp_path):
+    urls = [server + '/0.tif.gz', server + '/report.pdf', server + '/1.tif']
+    file_names = ['image_0.tif.gz', 'report.pdf', 'image_1.tif']
+    results = hipp.dataquery.thread_downloads(str(tmp_path), urls, file_names, max_workers = 3,
+                                              engine = hipp.dataquery.DownloadEngine(backoff = 0),
+                                              decompress = True)
+
+    assert sorted(os.path.basename(f) for f in results) == ['image_0.tif', 'image_1.tif', 'report.pdf']
+    assert all(open(f, 'rb').read() == DATA for f in results)
+    assert sorted(os.listdir(tmp_path)) == ['image_0.tif', 'image_1.tif', 'report.pdf']
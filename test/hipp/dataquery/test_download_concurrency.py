@@ -0,0 +1,91 @@
+import http.server
+import threading
+import time
+
+import pytest
+
+import hipp.dataquery
+
+
+DATA = bytes(50000)
+
+class ThrottlingHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves DATA slowly, at most max_active requests at a time, responding 429 beyond that.
+    """
+    max_active = 100
+    active = 0
+    peak = 0
+    throttled = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = ThrottlingHandler
+        with cls.lock:
+            if cls.active >= cls.max_active:
+                cls.throttled += 1
+                self.send_error(429)
+                return
+            cls.active += 1
+            cls.peak = max(cls.peak, cls.active)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(DATA)))
+        self.end_headers()
+        for i in range(0, len(DATA), 10000):
+            time.sleep(0.02)
+            if i + 10000 >= len(DATA):
+                # the request is over before the client receives the last chunk
+                with cls.lock:
+                    cls.active -= 1
+            self.wfile.write(DATA[i:i+10000])
+            self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    ThrottlingHandler.max_active = 100
+    ThrottlingHandler.active = ThrottlingHandler.peak = ThrottlingHandler.throttled = 0
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ThrottlingHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    httpd.shutdown()
+
+def download(server, tmp_path, controller, n = 20):
+    engine = hipp.dataquery.DownloadEngine(backoff = 0.01, retries = 10, chunk_size = 10000, controller = controller)
+    return hipp.dataquery.thread_downloads(str(tmp_path),
+                                           [server + '/{}.tif'.format(i) for i in range(n)],
+                                           ['{}.tif'.format(i) for i in range(n)],
+                                           engine = engine)
+
+def test_concurrency_grows_with_throughput(server, tmp_path):
+    controller = hipp.dataquery.ConcurrencyController(initial_limit = 1, max_limit = 6, interval = 0.1)
+    files = download(server, tmp_path, controller, n = 40)
+
+    assert len(files) == 40
+    assert max(limit for t, limit, rate in controller.history) > 2
+    assert ThrottlingHandler.peak <= 6
+    assert controller.total_bytes == 40 * len(DATA)
+
+def test_concurrency_backs_off_when_throttled(server, tmp_path):
+    ThrottlingHandler.max_active = 2
+    controller = hipp.dataquery.ConcurrencyController(initial_limit = 8, max_limit = 8, interval = 0.05)
+    files = download(server, tmp_path, controller)
+
+    assert len(files) == 20
+    assert ThrottlingHandler.throttled > 0
+    assert controller.limit < 8
+
+def test_host_and_bandwidth_limits(server, tmp_path):
+    controller = hipp.dataquery.ConcurrencyController(initial_limit = 8,
+                                                      max_limit = 8,
+                                                      per_host_limit = 2,
+                                                      max_bandwidth = 2e5)
+    start = time.monotonic()
+    files = download(server, tmp_path, controller, n = 6)
+
+    assert len(files) == 6
+    assert ThrottlingHandler.peak <= 2
+    assert time.monotonic() - start >= 6 * len(DATA) / 2e5 * 0.9
@@ -0,0 +1,59 @@
+import os
+import stat
+
+import pytest
+
+import hipp.dataquery
+
+
+def download_options(payload):
+    return [{'entityId': e, 'id': 'product-' + e, 'available': True} for e in payload['entityIds']]
+
+def test_download_options_in_concurrent_chunks(m2m):
+    m2m.handlers['download-options'] = download_options
+    m2m.failures['download-options'] = 1
+    client = hipp.dataquery.M2MClient('user', 'password', serviceUrl = m2m.url,
+                                      chunk_size = 3, backoff = 0)
+    entity_ids = ['AR1{:012d}'.format(i) for i in range(10)]
+
+    options = client.download_options(entity_ids)
+
+    assert [o['entityId'] for o in options] == entity_ids
+    chunks = [tuple(p['entityIds']) for e, k, p in m2m.requests if e == 'download-options']
+    # one chunk was retried
+    assert len(chunks) == 5
+    assert sorted(len(c) for c in set(chunks)) == [1, 3, 3, 3]
+    assert m2m.logins == 1
+
+def test_login_again_when_api_key_expires(m2m, tmp_path):
+    m2m.handlers['download-options'] = download_options
+    cache = str(tmp_path / 'api_key.json')
+    client = hipp.dataquery.M2MClient('user', 'password', serviceUrl = m2m.url, api_key_cache = cache)
+    client.download_options(['AR1000000000001'])
+    if os.name == 'posix':
+        assert stat.S_IMODE(os.stat(cache).st_mode) == 0o600
+
+    m2m.expire_api_keys()
+    cached = hipp.dataquery.M2MClient('user', 'password', serviceUrl = m2m.url, api_key_cache = cache)
+    assert cached.api_key == 'key-1'
+    assert cached.download_options(['AR1000000000001'])[0]['available']
+    assert m2m.logins == 2
+
+def test_login_when_api_key_cache_is_corrupt(m2m, tmp_path):
+    m2m.handlers['download-options'] = download_options
+    cache = tmp_path / 'api_key.json'
+    cache.write_text('{"username": "user", "api_')
+    client = hipp.dataquery.M2MClient('user', 'password', serviceUrl = m2m.url, api_key_cache = str(cache))
+    assert client.download_options(['AR1000000000001'])[0]['available']
+    assert m2m.logins == 1
+
+def test_errors_raise_instead_of_exiting(m2m):
+    m2m.failures['download-options'] = 10
+    client = hipp.dataquery.M2MClient(api_key = 'key-0', serviceUrl = m2m.url, retries = 1, backoff = 0)
+    with pytest.raises(hipp.dataquery.M2MError):
+        client.download_options(['AR1000000000001'])
+
+    m2m.failures.clear()
+    with pytest.raises(hipp.dataquery.M2MError) as e:
+        client.request('download-options', {'entityIds': []})
+    assert e.value.error_code == 'AUTH_KEY_INVALID'
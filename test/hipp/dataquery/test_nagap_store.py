@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+import hipp.dataquery
+
+
+def nagap_metadata(n = 2000):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({'fileName': ['NAGAP_{}_{:03d}.tif'.format(i // 100, i % 100) for i in range(n)],
+                         'Roll': ['{}V{}'.format(74 + i % 4, i // 500) for i in range(n)],
+                         'Year': [str(74 + i % 4) for i in range(n)],
+                         'Month': [str(rng.integers(6, 10)).zfill(2) for i in range(n)],
+                         'Day': [str(rng.integers(1, 29)).zfill(2) for i in range(n)],
+                         'Longitude': rng.uniform(-150, -120, n).round(5).astype(str),
+                         'Latitude': rng.uniform(46, 62, n).round(5).astype(str),
+                         'pid_tiff': ['pid{}'.format(i) for i in range(n)]},
+                        dtype = object)
+
+def test_store_matches_pre_select(tmp_path):
+    csv_file = str(tmp_path / 'nagap_image_metadata.csv')
+    nagap_metadata().to_csv(csv_file, index=False)
+    store = hipp.dataquery.NAGAPMetadataStore.build(csv_file, str(tmp_path / 'nagap.parquet'), grid_size = 0.5)
+
+    queries = [{},
+               {'bounds': (-140.3, 58.1, -130.7, 50.2)},
+               {'bounds': (-140.3, 58.1, -130.7, 50.2), 'year': 75, 'month': 7},
+               {'roll': '76V1', 'day': 3},
+               {'year': 80}]
+    for query in queries:
+        expected = hipp.dataquery.NAGAP_pre_select_images(csv_file, **query)
+        pd.testing.assert_frame_equal(store.query(**query), expected)
+        pd.testing.assert_frame_equal(hipp.dataquery.NAGAP_pre_select_images(store, **query), expected)
+
+def test_store_polygon_query(tmp_path):
+    store = hipp.dataquery.NAGAPMetadataStore.build(nagap_metadata(), str(tmp_path / 'nagap.parquet'))
+    triangle = [(-140, 50), (-125, 50), (-140, 60)]
+
+    df = store.query(polygon = triangle)
+    lons, lats = df['Longitude'].values, df['Latitude'].values
+    assert len(df) > 0
+    assert ((lons > -140) & (lats > 50) & (lats - 50 < (-125 - lons) * 10 / 15)).all()
+    pd.testing.assert_frame_equal(df, hipp.dataquery.NAGAP_pre_select_images(nagap_metadata(), polygon = triangle))
@@ -0,0 +1,85 @@
+import numpy as np
+
+import hipp.dataquery
+
+
+def catalog(n = 100):
+    rng = np.random.default_rng(0)
+    return [{'entityId': 'AR1ROLLA001{:04d}'.format(i),
+             'metadata': [{'fieldName': 'Entity  ID', 'value': 'AR1ROLLA001{:04d}'.format(i)},
+                          {'fieldName': 'Center Longitude dec', 'value': str(rng.uniform(-114.5, -113.0))},
+                          {'fieldName': 'Center Latitude dec', 'value': str(rng.uniform(48.2, 49.2))},
+                          {'fieldName': 'Acquisition Date', 'value': '1966/0{}/15'.format(i % 9 + 1)}]}
+            for i in range(n)]
+
+def matches(scene, xmin, ymin, xmax, ymax, startDate, endDate):
+    values = {f['fieldName']: f['value'] for f in scene['metadata']}
+    date = values['Acquisition Date'].replace('/', '-')
+    return xmin <= float(values['Center Longitude dec']) <= xmax and \
+           ymin <= float(values['Center Latitude dec']) <= ymax and \
+           startDate <= date <= endDate
+
+def test_sub_region_served_from_cache(m2m, tmp_path):
+    scenes = catalog()
+    def scene_search(payload):
+        spatial = payload['sceneFilter']['spatialFilter']
+        acquisition = payload['sceneFilter']['acquisitionFilter']
+        xmin, xmax = sorted([spatial['lowerLeft']['longitude'], spatial['upperRight']['longitude']])
+        hits = [s for s in scenes if matches(s, xmin, spatial['lowerLeft']['latitude'],
+                                             xmax, spatial['upperRight']['latitude'],
+                                             acquisition['start'], acquisition['end'])]
+        results = hits[:payload['maxResults']]
+        return {'results': results, 'recordsReturned': len(results), 'totalHits': len(hits)}
+    m2m.handlers['scene-search'] = scene_search
+    m2m.api_keys.add('key-0')
+    client = hipp.dataquery.M2MClient(api_key = 'key-0', serviceUrl = m2m.url)
+    cache = hipp.dataquery.SceneSearchCache(str(tmp_path / 'cache.sqlite'))
+
+    def search_count():
+        return sum(e == 'scene-search' for e, k, p in m2m.requests)
+
+    df = hipp.dataquery.EE_pre_select_images(client, -114.5, 48.2, -113.0, 49.2,
+                                             '1966-01-01', '1966-12-31',
+                                             complete = True, cache = cache)
+    assert len(df) == 100
+    assert search_count() == 1
+
+    sub_region = (-114.0, 48.5, -113.5, 49.0, '1966-03-01', '1966-06-30')
+    df = hipp.dataquery.EE_pre_select_images(client, *sub_region, maxResults = 1000, cache = cache)
+    assert list(df.entityId) == [s['entityId'] for s in scenes if matches(s, *sub_region)]
+    assert search_count() == 1
+
+    # a query limited by maxResults only serves itself
+    hipp.dataquery.EE_pre_select_images(client, -115, 48, -113, 50, '1966-01-01', '1966-12-31',
+                                        maxResults = 10, cache = cache)
+    hipp.dataquery.EE_pre_select_images(client, -115, 48, -113, 50, '1966-01-01', '1966-12-31',
+                                        maxResults = 10, cache = cache)
+    hipp.dataquery.EE_pre_select_images(client, *sub_region, metadataType = 'summary', 
+                                        maxResults = 1000, cache = cache)
+    assert search_count() == 3
+
+    expired = hipp.dataquery.SceneSearchCache(cache.cache_file, ttl = 0)
+    assert expired.get(*sub_region) is None
+
+def test_incomplete_search_not_cached_as_complete(m2m, tmp_path):
+    scenes = catalog(10)
+    # more hits than a single search returns, in a tile that can not be split
+    m2m.handlers['scene-search'] = lambda payload: {'results': scenes, 'recordsReturned': len(scenes),
+                                                    'totalHits': 60000}
+    m2m.api_keys.add('key-0')
+    client = hipp.dataquery.M2MClient(api_key = 'key-0', serviceUrl = m2m.url)
+    cache = hipp.dataquery.SceneSearchCache(str(tmp_path / 'cache.sqlite'))
+
+    def search_count():
+        return sum(e == 'scene-search' for e, k, p in m2m.requests)
+
+    query = (-114.005, 48.5, -114.0, 48.505, '1966-06-15', '1966-06-15')
+    results, complete = hipp.dataquery.EE_search_scenes(client, *query, return_complete = True)
+    assert len(results) == 10 and not complete
+    n = search_count()
+
+    for i in range(2):
+        df = hipp.dataquery.EE_pre_select_images(client, *query, complete = True, cache = cache)
+        assert len(df) == 10
+    assert cache.get(*query) is None
+    assert search_count() == 3 * n
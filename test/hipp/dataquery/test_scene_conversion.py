@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+import hipp.dataquery
+
+
+def scene(i, photo_id = True):
+    fields = {'Entity  ID': 'AR1ROLLA00100{:02d}'.format(i),
+              'Roll': 'ROLLA',
+              'Photo ID': 'P{}'.format(i),
+              'Focal Length': '152.4 mm',
+              'Center Latitude dec': '48.{}'.format(i),
+              'Center Longitude dec': '-121.{}'.format(i),
+              'Unmapped Field': 'x'}
+    if not photo_id:
+        del fields['Photo ID']
+    return {'metadata': [{'fieldName': k, 'value': v, 'id': k} for k, v in fields.items()]}
+
+def test_columnar_conversion(tmp_path):
+    scenes = [scene(0), scene(1, photo_id = False), scene(2)]
+    df = hipp.dataquery.EE_convert_api_responses_to_dataframe(scenes)
+
+    assert list(df.columns) == ['entityId', 'roll', 'imageId', 'focalLength', 'centerLat', 'centerLon']
+    assert df['entityId'].dtype == object
+    assert df['centerLat'].dtype == np.float64
+    assert df['focalLength'].tolist() == [152.4] * 3
+    assert df['imageId'].isna().tolist() == [False, True, False]
+
+    parquet_file = str(tmp_path / 'scenes.parquet')
+    hipp.dataquery.EE_convert_api_responses_to_dataframe(iter(scenes), parquet_file = parquet_file, batch_size = 2)
+    stored = pd.read_parquet(parquet_file)
+    assert stored['entityId'].tolist() == df['entityId'].tolist()
+    assert stored['centerLon'].tolist() == df['centerLon'].tolist()
+
+def test_parquet_keeps_fields_first_seen_in_later_batches(tmp_path):
+    scenes = [scene(0, photo_id = False), scene(1, photo_id = False), scene(2)]
+    parquet_file = str(tmp_path / 'scenes.parquet')
+    hipp.dataquery.EE_convert_api_responses_to_dataframe(iter(scenes), parquet_file = parquet_file, batch_size = 2)
+    stored = pd.read_parquet(parquet_file)
+
+    assert stored['imageId'].isna().tolist() == [True, True, False]
+    assert stored['imageId'][2] == 'P2'
+    assert stored['focalLength'].tolist() == [152.4] * 3
+    assert stored['altitudesFeet'].isna().all()
@@ -0,0 +1,46 @@
+import numpy as np
+
+import hipp.dataquery
+
+
+def scene_search(catalog, max_results):
+    def search(payload):
+        spatial = payload['sceneFilter']['spatialFilter']
+        acquisition = payload['sceneFilter']['acquisitionFilter']
+        longitudes = sorted([spatial['lowerLeft']['longitude'], spatial['upperRight']['longitude']])
+        latitudes = sorted([spatial['lowerLeft']['latitude'], spatial['upperRight']['latitude']])
+        hits = [s for s in catalog
+                if longitudes[0] <= s['x'] <= longitudes[1]
+                and latitudes[0] <= s['y'] <= latitudes[1]
+                and acquisition['start'] <= s['date'] <= acquisition['end']]
+        start = payload.get('startingNumber', 1)
+        count = min(payload['maxResults'], max_results - start + 1)
+        results = [{'entityId': s['entityId'], 'metadata': []} for s in hits[start - 1:start - 1 + count]]
+        return {'results': results, 'recordsReturned': len(results), 'totalHits': len(hits)}
+    return search
+
+def test_search_beyond_max_results(m2m):
+    rng = np.random.default_rng(0)
+    catalog = [{'entityId': 'AR1ROLLA001{:04d}'.format(i),
+                'x': rng.uniform(-114.5, -113.0),
+                'y': rng.uniform(48.2, 49.2),
+                'date': '1966-0{}-01'.format(i % 9 + 1)} for i in range(200)]
+    # a cluster of scenes at one location can only be split in time
+    catalog += [{'entityId': 'AR1ROLLB001{:04d}'.format(i),
+                 'x': -114.0, 'y': 48.5,
+                 'date': '1966-0{}-01'.format(i % 9 + 1)} for i in range(30)]
+    m2m.handlers['scene-search'] = scene_search(catalog, max_results = 20)
+    m2m.api_keys.add('key-0')
+    client = hipp.dataquery.M2MClient(api_key = 'key-0', serviceUrl = m2m.url)
+
+    scenes = hipp.dataquery.EE_search_scenes(client,
+                                             -114.5, 48.2, -113.0, 49.2,
+                                             '1966-01-01', '1966-12-31',
+                                             max_results = 20,
+                                             page_size = 8)
+
+    assert [s['entityId'] for s in scenes] == sorted(s['entityId'] for s in catalog)
+    payloads = [p for e, k, p in m2m.requests if e == 'scene-search']
+    assert any(p.get('startingNumber', 1) > 1 for p in payloads)
+    assert any(p['sceneFilter']['acquisitionFilter']['start'] != '1966-01-01' for p in payloads)
+    assert all(p['maxResults'] <= 8 for p in payloads)
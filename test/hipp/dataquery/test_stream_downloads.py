@@ -0,0 +1,100 @@
+import gzip
+import os
+import time
+
+import pytest
+
+import hipp.dataquery
+
+
+def test_downloads_start_while_staging(m2m, tmp_path):
+    entity_ids = ['AR1ROLLA00100{:02d}'.format(i) for i in range(4)]
+    for e in entity_ids:
+        m2m.files[e] = e.encode() * 100
+
+    def download_options(payload):
+        return [{'entityId': e, 'id': 'hi-' + e, 'available': True, 'productName': 'High Resolution Product'}
+                for e in payload['entityIds']]
+
+    def download(i):
+        return {'downloadId': i, 'entityId': entity_ids[i], 'url': m2m.url + entity_ids[i],
+                'productName': 'High Resolution Product', 'collectionName': 'Aerial Photo Single Frames'}
+
+    # one product is available right away, the others are staged one per poll
+    retrieved = [1]
+    def download_retrieve(payload):
+        retrieved.append(retrieved[-1] + 1)
+        return {'available': [download(i) for i in range(1, retrieved[-1])], 'requested': []}
+
+    m2m.handlers['download-options'] = download_options
+    m2m.handlers['download-request'] = lambda payload: {'availableDownloads': [download(0)],
+                                                        'preparingDownloads': [{}, {}, {}]}
+    m2m.handlers['download-retrieve'] = download_retrieve
+
+    client = hipp.dataquery.M2MClient(api_key = 'key-0', serviceUrl = m2m.url)
+    m2m.api_keys.add('key-0')
+    files = hipp.dataquery.EE_stream_downloads(client, entity_ids,
+                                               output_directory = str(tmp_path),
+                                               min_poll_interval = 0.01)
+
+    assert sorted(os.path.basename(f) for f in files) == sorted(e + '.tif.gz' for e in entity_ids)
+    events = [e for e, k, p in m2m.requests]
+    assert events.index('GET') < len(events) - 1 - events[::-1].index('download-retrieve')
+    assert events.count('download-retrieve') == 3
+
+def test_decompresses_only_image_products(m2m, tmp_path):
+    entity_ids = ['AR1ROLLA00100{:02d}'.format(i) for i in range(2)]
+    products = {'Camera Calibration File' : ('cal-', b'%PDF-1.4 calibration report'),
+                'High Resolution Product' : ('hi-',  b'image data')}
+    downloads = []
+    for e in entity_ids:
+        for product_name, (prefix, data) in products.items():
+            m2m.files[prefix + e] = gzip.compress(data) if prefix == 'hi-' else data
+            downloads.append({'downloadId': len(downloads), 'entityId': e, 'url': m2m.url + prefix + e,
+                              'productName': product_name})
+
+    m2m.handlers['download-options'] = lambda payload: [
+        {'entityId': d['entityId'], 'id': d['downloadId'], 'available': True, 'productName': d['productName']}
+        for d in downloads]
+    m2m.handlers['download-request'] = lambda payload: {'availableDownloads': downloads,
+                                                        'preparingDownloads': []}
+
+    client = hipp.dataquery.M2MClient(api_key = 'key-0', serviceUrl = m2m.url)
+    m2m.api_keys.add('key-0')
+    files = hipp.dataquery.EE_stream_downloads(client, entity_ids,
+                                               output_directory = str(tmp_path),
+                                               decompress = True)
+
+    assert sorted(os.path.basename(f) for f in files) == ['AR1ROLLA001.pdf'] + [e + '.tif' for e in entity_ids]
+    for f in files:
+        expected = products['Camera Calibration File' if f.endswith('.pdf') else 'High Resolution Product'][1]
+        assert open(f, 'rb').read() == expected
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(f) for f in files)
+
+def test_running_downloads_complete_when_polling_fails(m2m, tmp_path, monkeypatch):
+    entity_ids = ['AR1ROLLA00100{:02d}'.format(i) for i in range(2)]
+    m2m.files[entity_ids[0]] = b'image data'
+
+    download_image = hipp.dataquery.download_image
+    def slow_download_image(*args, **kwargs):
+        time.sleep(0.5)
+        return download_image(*args, **kwargs)
+    monkeypatch.setattr(hipp.dataquery.dataquery, 'download_image', slow_download_image)
+
+    m2m.handlers['download-options'] = lambda payload: [
+        {'entityId': e, 'id': 'hi-' + e, 'available': True, 'productName': 'High Resolution Product'}
+        for e in payload['entityIds']]
+    m2m.handlers['download-request'] = lambda payload: {
+        'availableDownloads': [{'downloadId': 0, 'entityId': entity_ids[0], 'url': m2m.url + entity_ids[0],
+                                'productName': 'High Resolution Product'}],
+        'preparingDownloads': [{}]}
+    m2m.failures['download-retrieve'] = 10
+
+    client = hipp.dataquery.M2MClient(api_key = 'key-0', serviceUrl = m2m.url, retries = 1, backoff = 0)
+    m2m.api_keys.add('key-0')
+    with pytest.raises(hipp.dataquery.M2MError):
+        hipp.dataquery.EE_stream_downloads(client, entity_ids,
+                                           output_directory = str(tmp_path),
+                                           min_poll_interval = 0.01)
+
+    assert os.listdir(tmp_path) == [entity_ids[0] + '.tif.gz']
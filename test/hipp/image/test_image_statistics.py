@@ -0,0 +1,70 @@
+import cv2
+import numpy as np
+import os
+
+import hipp.core
+import hipp.image
+import hipp.io
+
+
+def test_histogram_percentiles_match_numpy():
+    rng = np.random.default_rng(0)
+    for i in range(200):
+        image_array = rng.normal(rng.integers(0, 255), rng.integers(1, 60),
+                                 (rng.integers(1, 50), rng.integers(1, 50))).clip(0, 255).astype(np.uint8)
+        histogram = hipp.image.compute_image_statistics(image_array)['histogram']
+        for q in [(0.1, 99.9), (0, 100), (25, 75)]:
+            assert np.array_equal(hipp.image.percentiles_from_histogram(histogram, q),
+                                  np.percentile(image_array, q))
+
+def test_statistics_cached_in_sidecar(tmp_path):
+    image_file = str(tmp_path / 'image.tif')
+    image_array = np.random.default_rng(1).integers(20, 200, (100, 120)).astype(np.uint8)
+    cv2.imwrite(image_file, image_array)
+
+    statistics = hipp.image.read_image_statistics(image_file, sidecar = True)
+    assert statistics['histogram'].sum() == image_array.size
+    assert (statistics['min'], statistics['max']) == (image_array.min(), image_array.max())
+    assert (tmp_path / 'image.tif.stats.npz').exists()
+    assert hipp.image.read_image_statistics(image_file) is statistics
+
+def test_statistics_reloaded_from_sidecar(tmp_path, monkeypatch):
+    image_file = str(tmp_path / 'image.tif')
+    image_array = np.random.default_rng(2).integers(20, 200, (100, 120)).astype(np.uint8)
+    cv2.imwrite(image_file, image_array)
+    statistics = hipp.image.read_image_statistics(image_file, sidecar = True)
+
+    hipp.image.image._image_statistics.clear()
+    def read_image(image_file):
+        raise AssertionError('statistics should be read from the sidecar')
+    monkeypatch.setattr(hipp.io, 'read_image', read_image)
+
+    reloaded = hipp.image.read_image_statistics(image_file, sidecar = True)
+    assert reloaded is not statistics
+    assert np.array_equal(reloaded['histogram'], statistics['histogram'])
+    assert (reloaded['min'], reloaded['max']) == (statistics['min'], statistics['max'])
+
+def test_detection_reuses_enhanced_statistics(synthetic_rolls, monkeypatch):
+    image_files, template_directory = synthetic_rolls(['AR1ROLLA001'], n = 1)
+    templates = hipp.core.load_midside_fiducial_proxy_templates(os.path.join(template_directory, 'AR1ROLLA001'))
+    image_array = hipp.io.read_image(image_files[0])
+    expected = hipp.core.detect_fiducial_proxies_in_array(image_array, templates, buffer_distance = 100)
+
+    calls = []
+    compute_image_statistics = hipp.image.compute_image_statistics
+    def count(image_array):
+        calls.append(image_array.shape)
+        return compute_image_statistics(image_array)
+    monkeypatch.setattr(hipp.image, 'compute_image_statistics', count)
+
+    for i in range(2):
+        matches, quality_scores, _ = hipp.core.detect_fiducial_proxies(image_files[0], templates, buffer_distance = 100)
+        assert matches == expected[0]
+        assert np.array_equal(quality_scores, expected[1])
+    assert len(calls) == 1
+
+    statistics = hipp.image.read_image_statistics(image_files[0], clahe_enhancement = True)
+    assert np.array_equal(statistics['histogram'],
+                          compute_image_statistics(hipp.image.clahe_equalize_image(image_array))['histogram'])
+    assert not np.array_equal(statistics['histogram'], 
+                              hipp.image.read_image_statistics(image_files[0])['histogram'])
@@ -0,0 +1,48 @@
+import cv2
+import numpy as np
+import struct
+
+import hipp.io
+
+
+def write_tiff(image_file, image_array, orientation):
+    """
+    Writes an uncompressed 8 bit grayscale TIFF with orientation tag.
+    """
+    height, width = image_array.shape
+    tags = [(256, 3, width), (257, 3, height), (258, 3, 8), (259, 3, 1), (262, 3, 1),
+            (273, 4, 8), (274, 3, orientation), (277, 3, 1), (278, 3, height), (279, 4, image_array.size)]
+    ifd_offset = 8 + image_array.size
+    with open(image_file, 'wb') as f:
+        f.write(b'II' + struct.pack('<HI', 42, ifd_offset))
+        f.write(image_array.tobytes())
+        f.write(struct.pack('<H', len(tags)))
+        for tag, tag_type, value in tags:
+            f.write(struct.pack('<HHI', tag, tag_type, 1))
+            if tag_type == 4:
+                f.write(struct.pack('<I', value))
+            else:
+                f.write(struct.pack('<HH', value, 0))
+        f.write(struct.pack('<I', 0))
+
+def test_normalize_origin_in_tags_and_apply_when_read(tmp_path):
+    image_array = np.random.default_rng(0).integers(0, 200, (6, 9)).astype(np.uint8)
+    image_file = str(tmp_path / 'image.tif')
+    write_tiff(image_file, image_array, orientation = 3)
+    displayed = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+    assert np.array_equal(displayed, image_array[::-1, ::-1])
+
+    assert hipp.io.normalize_tiff_origin(image_file) == 3
+    assert hipp.io.read_tiff_orientation(image_file) == 1
+    assert np.array_equal(cv2.imread(image_file, cv2.IMREAD_GRAYSCALE), image_array)
+
+    hipp.io.write_image_manifest(str(tmp_path), {'image.tif': {'orientation': 3, 'invert': False}})
+    assert np.array_equal(hipp.io.read_image(image_file), displayed)
+
+    hipp.io.write_image_manifest(str(tmp_path), {'image.tif': {'orientation': 3, 'invert': True}})
+    assert np.array_equal(hipp.io.read_image(image_file), displayed.max() - displayed)
+
+def test_apply_orientation():
+    image_array = np.arange(6).reshape(2, 3)
+    assert hipp.io.apply_orientation(image_array, 6).tolist() == [[3, 0], [4, 1], [5, 2]]
+    assert hipp.io.apply_orientation(image_array, 8).tolist() == [[2, 5], [1, 4], [0, 3]]
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+import hipp.core
+import hipp.io
+
+
+def roll_results(roll, n, offset = 0):
+    file_names = ['{}{:04d}.tif'.format(roll, i) for i in range(n)]
+    detected_df = pd.DataFrame({'match_locations': [[(100.+i, 50.), (50., 100.), (100., 150.), (150., 100.)] for i in range(n)],
+                                'scores':          [[0.9, 0.8, 0.7, 0.6]] * n,
+                                'file_names':      file_names})
+    proxy_locations_df = hipp.core.nan_offset_fiducial_proxies(detected_df)
+    principal_points = [np.array([100 + offset, 100]) for i in range(n)]
+    distances = [100., 100.] * n
+    intersection_angles = [90.] * n
+    return detected_df, proxy_locations_df, principal_points, distances, intersection_angles, 100
+
+def test_append_and_read_subsets(tmp_path):
+    store = hipp.io.ResultsStore(str(tmp_path / 'results'))
+    store.append_roll('AR1ROLLA001', *roll_results('AR1ROLLA001', 3), run = 'run1')
+    store.append_roll('AR1ROLLB002', *roll_results('AR1ROLLB002', 2), run = 'run1')
+    store.append_roll('AR1ROLLA001', *roll_results('AR1ROLLA001', 3, offset = 1), run = 'run2')
+
+    assert store.rolls() == ['AR1ROLLA001', 'AR1ROLLB002']
+
+    df = store.read()
+    assert len(df) == 8
+    assert [name for name, dtype in hipp.io.ResultsStore.fields] == list(df.columns)
+
+    df = store.read(columns = ['file_name', 'principal_point_y'], rolls = ['AR1ROLLA001'], runs = ['run2'])
+    assert list(df.columns) == ['file_name', 'principal_point_y']
+    assert list(df['principal_point_y']) == [101] * 3
+    assert df['principal_point_y'].dtype == np.int64
+
+def test_read_empty_store(tmp_path):
+    df = hipp.io.ResultsStore(str(tmp_path / 'results')).read(columns = ['roll', 'image_square_dim'])
+    assert len(df) == 0
+    assert list(df.columns) == ['roll', 'image_square_dim']
@@ -0,0 +1,41 @@
+import os
+
+import cv2
+
+import hipp.batch
+import hipp.core
+import hipp.pipeline
+
+
+def test_pipeline_crops_roll_with_bounded_memory(synthetic_rolls, tmp_path):
+    image_files, template_directory = synthetic_rolls(['AR1ROLLA001'], n = 8)
+    templates = hipp.core.load_midside_fiducial_proxy_templates(os.path.join(template_directory, 'AR1ROLLA001'))
+
+    crop_stage = hipp.pipeline.CropStage(buffer_distance = 100,
+                                         min_samples = 5,
+                                         max_held = 2)
+    pipeline = hipp.pipeline.Pipeline(hipp.pipeline.ReadStage(workers = 2),
+                                      hipp.pipeline.DetectFiducialProxiesStage(templates,
+                                                                               buffer_distance = 100,
+                                                                               workers = 2),
+                                      crop_stage,
+                                      hipp.pipeline.EnhanceStage(workers = 2),
+                                      hipp.pipeline.WriteStage(str(tmp_path / 'cropped')))
+    frames = list(pipeline.run(hipp.pipeline.frames_from_files(image_files,
+                                                               roll_from_file_name = lambda f: f[-15:-8])))
+
+    assert [f.name for f in frames] == image_files
+    assert crop_stage.spilled > 0
+    assert crop_stage.spill_directory is None
+
+    roll_templates = hipp.batch.find_roll_template_directories(image_files, template_directory)
+    results, failed = hipp.batch.schedule_roll_preprocessing(roll_templates,
+                                                             buffer_distance = 100,
+                                                             output_directory = str(tmp_path / 'batch'),
+                                                             qc_plots = False,
+                                                             verbose = False)
+    image_square_dim = results['AR1ROLLA001']['image_square_dim']
+    for frame, principal_point in zip(frames, results['AR1ROLLA001']['principal_points']):
+        assert frame.metadata['principal_point'] == tuple(principal_point)
+        assert frame.metadata['image_square_dim'] == image_square_dim
+        assert cv2.imread(frame.metadata['output_file'], cv2.IMREAD_GRAYSCALE).shape == (image_square_dim,) * 2
@@ -0,0 +1,42 @@
+import cv2
+import numpy as np
+
+import hipp.image
+import hipp.qc
+
+
+def structured_image(rng, shape = (600, 650)):
+    image_array = cv2.GaussianBlur(rng.random(shape).astype(np.float32), (0, 0), 30)
+    image_array = (image_array - image_array.min()) / (image_array.max() - image_array.min())
+    return (image_array * 255).astype(np.uint8)
+
+def rescan(image_array, rng):
+    rows, cols = image_array.shape
+    transform = cv2.getRotationMatrix2D((cols / 2, rows / 2), 0.5, 1.01)
+    image_array = cv2.warpAffine(image_array, transform, (cols, rows))
+    image_array = image_array.astype(int) + rng.integers(-8, 8, image_array.shape)
+    return cv2.resize(image_array.clip(0, 255).astype(np.uint8), None, fx = 0.5, fy = 0.5,
+                      interpolation = cv2.INTER_AREA)
+
+def test_index_flags_rescans_only():
+    rng = np.random.default_rng(0)
+    images = [structured_image(rng) for i in range(20)]
+
+    index = hipp.qc.DuplicateIndex(max_distance = 8)
+    for i, image_array in enumerate(images):
+        assert index.add('original_' + str(i), hipp.image.perceptual_hash(image_array)) == []
+
+    for i, image_array in enumerate(images):
+        matches = index.add('rescan_' + str(i), hipp.image.perceptual_hash(rescan(image_array, rng)))
+        assert matches[0][0] == 'original_' + str(i)
+
+    assert len(index) == 20
+
+def test_save_and_load(tmp_path):
+    index = hipp.qc.DuplicateIndex()
+    index.add('a', 0x0f0f0f0f0f0f0f0f)
+    index.add('b', 0xf0f0f0f0f0f0f0f0)
+    index.save(str(tmp_path / 'index.csv'))
+
+    index = hipp.qc.DuplicateIndex.load(str(tmp_path / 'index.csv'))
+    assert index.query(0x0f0f0f0f0f0f0f0e) == [('a', 1)]
@@ -0,0 +1,37 @@
+import threading
+
+import hipp.qc
+
+
+def test_sampling_policies():
+    writer = hipp.qc.QCWriter(policy = 'every_nth', every_n = 3)
+    assert [writer.sample() for i in range(7)] == [True, False, False, True, False, False, True]
+    assert writer.sample(failed = True)
+    writer.close()
+
+    writer = hipp.qc.QCWriter(policy = 'low_scores', min_score = 0.8)
+    assert [writer.sample(score = s) for s in [0.9, 0.7, None]] == [False, True, False]
+    writer.close()
+
+    writer = hipp.qc.QCWriter(policy = 'failures')
+    assert not writer.sample(score = 0.1)
+    assert writer.sample(failed = True)
+    writer.close()
+
+def test_writes_in_background_and_drops_when_full():
+    release = threading.Event()
+    written = []
+
+    writer = hipp.qc.QCWriter(max_queue = 1, verbose = False)
+    assert writer.submit(release.wait)
+    # wait for the writer thread to pick up the blocking job
+    while writer._queue.unfinished_tasks and not writer._queue.empty():
+        pass
+    assert writer.submit(written.append, 1)
+    assert not writer.submit(written.append, 2)
+
+    release.set()
+    writer.close()
+    assert written == [1]
+    assert writer.dropped == 1
+    assert writer.written == 2
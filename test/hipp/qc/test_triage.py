@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+
+import hipp.qc
+
+
+def make_frame(rng):
+    frame = np.full((800, 800), 40, np.uint8)
+    frame[40:-40, 40:-40] = rng.normal(120, 10, (720, 720)).clip(0, 255).astype(np.uint8)
+    cv2.rectangle(frame, (200, 200), (600, 600), 230, 8)
+    cv2.circle(frame, (400, 400), 120, 10, -1)
+    return frame
+
+
+def test_blank_and_dark_frames_rejected(tmp_path):
+    rng = np.random.default_rng(0)
+    frame = make_frame(rng)
+
+    image_files = {'frame' : frame,
+                   'blank' : np.full((800, 800), 128, np.uint8),
+                   'dark'  : rng.integers(0, 8, (800, 800)).astype(np.uint8)}
+    for name, image_array in image_files.items():
+        cv2.imwrite(str(tmp_path / (name + '.tif')), image_array)
+
+    accepted, rejected_df = hipp.qc.triage_frames([str(tmp_path / (name + '.tif')) for name in image_files],
+                                                  decimation = 4,
+                                                  verbose = False)
+
+    assert accepted == [str(tmp_path / 'frame.tif')]
+    assert list(rejected_df['reason']) == ['blank', 'dark']
+
+
+def test_unreadable_frames_rejected(tmp_path):
+    rng = np.random.default_rng(0)
+    cv2.imwrite(str(tmp_path / 'frame.tif'), make_frame(rng))
+    data = open(tmp_path / 'frame.tif', 'rb').read()
+    with open(tmp_path / 'truncated.tif', 'wb') as f:
+        f.write(data[:len(data)//2])
+    open(tmp_path / 'empty.tif', 'wb').close()
+
+    image_files = [str(tmp_path / (name + '.tif')) for name in ['empty', 'frame', 'truncated']]
+    accepted, rejected_df = hipp.qc.triage_frames(image_files, decimation = 4, verbose = False)
+
+    assert accepted == [str(tmp_path / 'frame.tif')]
+    assert list(rejected_df['file_names']) == [image_files[0], image_files[2]]
+    assert list(rejected_df['reason']) == ['unreadable', 'unreadable']
@@ -0,0 +1,108 @@
+import json
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import hipp.batch
+import hipp.workqueue
+
+
+def write_task_file(output_directory, task):
+    time.sleep(0.05)
+    out = os.path.join(output_directory, str(task.task_id) + '.txt')
+    # exclusive creation fails if a task is processed twice
+    with open(out, 'x') as f:
+        f.write('\n'.join(task.payload))
+    return out
+
+def worker(database_file, output_directory, worker_id):
+    hipp.workqueue.run_worker(database_file,
+                              lambda task: write_task_file(output_directory, task),
+                              worker = worker_id,
+                              lease_seconds = 10,
+                              poll_interval = 0.1,
+                              verbose = False)
+
+def test_rolls_processed_once_by_several_processes(tmp_path):
+    database_file = str(tmp_path / 'queue.sqlite')
+    queue = hipp.workqueue.WorkQueue(database_file)
+    image_files = ['AR1ROLL{:04d}{:04d}.tif'.format(roll, frame) for roll in range(12) for frame in range(3)]
+    assert queue.add_images(image_files) == 12
+    
+    processes = [multiprocessing.Process(target=worker, 
+                                         args=(database_file, str(tmp_path), 'node'+str(i))) for i in range(3)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join(60)
+        assert p.exitcode == 0
+    
+    assert queue.counts() == {'done': 12}
+    assert len(list(tmp_path.glob('*.txt'))) == 12
+    assert queue.to_dataframe()['worker'].nunique() > 1
+
+def test_frame_batches(tmp_path):
+    queue = hipp.workqueue.WorkQueue(str(tmp_path / 'queue.sqlite'))
+    image_files = ['AR1ROLL0001{:04d}.tif'.format(frame) for frame in range(10)]
+    assert queue.add_images(image_files, frames_per_task=4) == 3
+    assert [len(p) for p in queue.to_dataframe()['payload'].map(json.loads)] == [4, 4, 2]
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    queue = hipp.workqueue.WorkQueue(str(tmp_path / 'queue.sqlite'))
+    queue.add_tasks([('roll', ['a.tif'])])
+    
+    task = queue.claim('node0', lease_seconds=0.2)
+    assert queue.claim('node1') is None
+    time.sleep(0.3)
+    
+    reclaimed = queue.claim('node1')
+    assert reclaimed.task_id == task.task_id
+    assert reclaimed.attempts == 2
+    assert not queue.heartbeat(task.task_id, 'node0')
+    assert not queue.complete(task.task_id, 'node0')
+    assert queue.complete(reclaimed.task_id, 'node1', {'ok': True})
+    assert queue.is_finished()
+
+def test_failed_task_retried_until_max_attempts(tmp_path):
+    queue = hipp.workqueue.WorkQueue(str(tmp_path / 'queue.sqlite'), max_attempts=2)
+    queue.add_tasks([('roll', ['a.tif'])])
+    
+    for i in range(2):
+        task = queue.claim('node0')
+        queue.fail(task.task_id, 'node0', 'error')
+    
+    assert queue.claim('node0') is None
+    assert queue.counts() == {'failed': 1}
+    assert queue.is_finished()
+
+def test_expired_lease_on_last_attempt_fails_task(tmp_path):
+    queue = hipp.workqueue.WorkQueue(str(tmp_path / 'queue.sqlite'), max_attempts=1)
+    queue.add_tasks([('roll', ['a.tif']), ('roll', ['b.tif'])])
+    
+    task = queue.claim('node0', lease_seconds=0.2)
+    time.sleep(0.3)
+    
+    other = queue.claim('node1')
+    assert other.task_id != task.task_id
+    df = queue.to_dataframe().set_index('task_id')
+    assert df.loc[task.task_id, 'status'] == 'failed'
+    assert df.loc[task.task_id, 'error'] == 'Lease expired on last attempt'
+    assert queue.complete(other.task_id, 'node1')
+    assert queue.counts() == {'done': 1, 'failed': 1}
+    assert queue.claim('node1') is None
+
+def test_roll_task_requires_complete_roll_with_results(tmp_path, monkeypatch):
+    image_files = [tmp_path / 'AR1ROLL0001{:04d}.tif'.format(frame) for frame in range(4)]
+    for image_file in image_files:
+        image_file.touch()
+    monkeypatch.setattr(hipp.batch, 'schedule_roll_preprocessing', lambda roll_templates, **kwargs: ({}, {}))
+
+    partial = hipp.workqueue.Task(1, 'AR1ROLL0001', [f.as_posix() for f in image_files[:2]], 1)
+    with pytest.raises(ValueError, match = '2 of 4 images'):
+        hipp.workqueue.preprocess_roll_with_fiducial_proxies(partial, str(tmp_path), str(tmp_path / 'results'))
+
+    complete = hipp.workqueue.Task(2, 'AR1ROLL0001', [f.as_posix() for f in image_files], 1)
+    with pytest.raises(ValueError, match = 'No results'):
+        hipp.workqueue.preprocess_roll_with_fiducial_proxies(complete, str(tmp_path), str(tmp_path / 'results'))